@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+How long the analyzer pauses its target, how much memory it adds there, and
+how fast its results travel and are read back.
+
+Every benchmark is run `repeat` times and reported as its median, with every
+sample kept, in a JSON file meant to be compared with the one an earlier
+version wrote:
+
+    python -m benchmarks run -o new.json
+    python -m benchmarks compare old.json new.json
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import click
+import pkg_resources
+
+from memory_analyzer import (
+    analysis_utils,
+    diff_utils,
+    memory_analyzer,
+    snapshot_file,
+)
+from memory_analyzer.frontend import frontend_utils
+
+from . import target
+
+RESULTS_VERSION = 1
+# Lines on the viewer's first screen.
+SCREEN_LINES = 50
+# Relative change past which compare flags a metric.
+THRESHOLD = 0.2
+
+
+class Results:
+    """
+    The samples of every metric, and why benchmarks were skipped.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.samples = {}
+        self.units = {}
+        self.skipped = {}
+
+    def add(self, name, value, unit="ms", higher_is_better=False):
+        self.samples.setdefault(name, []).append(value)
+        self.units[name] = (unit, higher_is_better)
+
+    def skip(self, benchmark, reason):
+        self.skipped[benchmark] = reason
+
+    def as_dict(self):
+        metrics = {}
+        for name, samples in self.samples.items():
+            unit, higher_is_better = self.units[name]
+            metrics[name] = {
+                "value": statistics.median(samples),
+                "unit": unit,
+                "higher_is_better": higher_is_better,
+                "samples": samples,
+            }
+        return {
+            "version": RESULTS_VERSION,
+            "memory_analyzer": memory_analyzer_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "params": self.params,
+            "metrics": metrics,
+            "skipped": self.skipped,
+        }
+
+
+def memory_analyzer_version():
+    try:
+        return pkg_resources.get_distribution("memory_analyzer").version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def peak_rss(pid):
+    """
+    The most memory `pid` ever had resident, in bytes.
+    """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+@contextmanager
+def heap_target(objects, types, depth, agent):
+    """
+    A target process holding the synthetic heap, once it is built.
+    """
+    command = [sys.executable, "-m", "benchmarks.target", "heap"]
+    command += ["--objects", str(objects), "--types", str(types)]
+    command += ["--depth", str(depth)]
+    if agent:
+        command.append("--agent")
+    proc = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    try:
+        if proc.stdout.readline().strip() != b"ready":
+            raise RuntimeError("The synthetic target did not start")
+        yield proc.pid
+    finally:
+        proc.stdin.close()
+        proc.wait(10)
+
+
+def analyze(pid, backend, output_file, template_out_path):
+    return memory_analyzer.analyze_memory_launcher(
+        pid,
+        num_refs=0,
+        specific_refs=[],
+        debug=False,
+        output_file=output_file,
+        executable=None,
+        template_out_path=template_out_path,
+        use_agent=backend == "agent",
+        backend="gdb" if backend == "agent" else backend,
+    )
+
+
+def bench_analysis(results, params, workdir):
+    """
+    Attach and GIL hold time, and the memory the probe adds to the target.
+    Returns the pages of the last analysis.
+    """
+    backend = params["backend"]
+    pages = None
+    with heap_target(
+        params["objects"], params["types"], params["depth"], backend == "agent"
+    ) as pid:
+        for _ in range(params["repeat"]):
+            rss = peak_rss(pid)
+            result = analyze(pid, backend, os.path.join(workdir, "out"), workdir)
+            if result.data is None:
+                results.skip("analysis", f"The {backend} analysis returned no data")
+                return None
+            results.add(
+                "analysis.end_to_end_ms", result.metadata["backend"]["elapsed_ms"]
+            )
+            results.add("analysis.attach_ms", attach_ms(result.metadata["timings"]))
+            results.add("analysis.gil_hold_ms", gil_hold_ms(result.metadata))
+            results.add(
+                "analysis.longest_pause_ms",
+                result.metadata["pause"]["longest_pause_ms"],
+            )
+            results.add(
+                "analysis.probe_overhead_bytes",
+                result.metadata.get("peak_overhead_bytes", 0),
+                "bytes",
+            )
+            results.add(
+                "analysis.target_peak_rss_growth_bytes",
+                peak_rss(pid) - rss,
+                "bytes",
+            )
+            results.add("analysis.rows", len(result.data), "rows")
+            for phase, ms in result.metadata["timings"].get("target", {}).items():
+                results.add(f"analysis.target_{phase}_ms", ms)
+            pages = [result] + result.metadata.pop("pages", [])
+    return pages
+
+
+def attach_ms(timings):
+    """
+    How long it took to get the payload running in the target: gdb's attach
+    and taking the GIL when gdb ran it, otherwise the wait for the results
+    less the time the payload spent working.
+    """
+    gdb = timings.get("gdb")
+    if gdb:
+        return gdb["attach"] + gdb.get("gil_ensure", 0)
+    analyzer = timings["analyzer"]
+    return (
+        analyzer["start"] + analyzer["wait"] - sum(timings.get("target", {}).values())
+    )
+
+
+def gil_hold_ms(metadata):
+    """
+    How long the payload held the target's GIL: every phase it timed in the
+    target, less the time its pause budget slept between slices.
+    """
+    pause = metadata["pause"]
+    held = sum(metadata["timings"].get("target", {}).values())
+    return held - (pause["elapsed_ms"] - pause["total_pause_ms"])
+
+
+def bench_backends(results, params, workdir):
+    """
+    How long every backend takes to attach, on a small heap so that only the
+    attach differs. Backends that cannot run here are skipped.
+    """
+    for backend in ["agent"] + list(analysis_utils.BACKENDS):
+        try:
+            with heap_target(1000, 10, 1, backend == "agent") as pid:
+                for _ in range(params["repeat"]):
+                    result = analyze(
+                        pid, backend, os.path.join(workdir, "out"), workdir
+                    )
+                    if result.data is None:
+                        raise RuntimeError("The analysis returned no data")
+                    results.add(
+                        f"attach.{backend}_ms", attach_ms(result.metadata["timings"])
+                    )
+        except (OSError, RuntimeError, SystemExit) as e:
+            results.skip(f"attach.{backend}", f"{type(e).__name__}: {e}")
+
+
+class PipeReader(analysis_utils.GDBObject):
+    """
+    Reads the FIFO as every backend does, from a writer sending synthetic
+    rows instead of an analysis.
+    """
+
+    backend = "pipe"
+
+    def __init__(self, rows, template_out_path):
+        super().__init__(os.getpid(), "", None, template_out_path)
+        self.rows = rows
+
+    def _start(self, debug):
+        return subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.target", "pipe", self.fifo]
+            + ["--rows", str(self.rows)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+
+
+def bench_pipe(results, params, workdir):
+    reader = PipeReader(params["pipe_rows"], workdir)
+    payload = sum(len(frame) for frame in target.frames(params["pipe_rows"]))
+    for _ in range(params["repeat"]):
+        result = reader.run_analysis()
+        if len(result.data or ()) != params["pipe_rows"]:
+            results.skip("pipe", "Rows were lost on the way")
+            return
+        # From the first frame, leaving out the writer's start up.
+        seconds = result.metadata["timings"]["analyzer"]["drain"] / 1000
+        results.add("pipe.throughput_mb_s", payload / seconds / 1e6, "MB/s", True)
+        results.add("pipe.rows_per_s", params["pipe_rows"] / seconds, "rows/s", True)
+
+
+def synthetic_pages(rows, pid=1, shift=0):
+    """
+    An analysis page of `rows` types, as a stand-in when there is no real one,
+    and to diff against.
+    """
+    return [
+        analysis_utils.RetrievedObjects(
+            pid=pid,
+            title=f"Analysis for {pid}",
+            data=[
+                [f"module.Synthetic{i}", i + shift, 64 * (i + shift)]
+                for i in range(rows)
+            ],
+        )
+    ]
+
+
+def bench_snapshots(results, params, workdir, pages):
+    """
+    Writing and reading snapshots, diffing two, and the viewer's first frame.
+    """
+    if pages is None:
+        pages = synthetic_pages(params["types"])
+    pid = pages[0].pid
+    previous = os.path.join(workdir, "previous.snapshot")
+    memory_analyzer.write_to_output_file(
+        previous, synthetic_pages(len(pages[0].data), pid, 1)
+    )
+    current = os.path.join(workdir, "current.snapshot")
+    for _ in range(params["repeat"]):
+        start = time.perf_counter()
+        memory_analyzer.write_to_output_file(current, pages)
+        results.add("snapshot.write_ms", elapsed_ms(start))
+        results.add("snapshot.bytes", os.path.getsize(current), "bytes")
+
+        start = time.perf_counter()
+        loaded = list(snapshot_file.read_pages(current))
+        results.add("snapshot.read_ms", elapsed_ms(start))
+
+        start = time.perf_counter()
+        diff_utils.diff_pages(loaded, analysis_utils.read_snapshot_pages(previous))
+        results.add("diff.ms", elapsed_ms(start))
+
+        # What `view` does before showing anything: open the file, lay out the
+        # first page and format the rows on screen.
+        start = time.perf_counter()
+        first = memory_analyzer.read_snapshot(current)[0]
+        frontend_utils.page_table(first)[0:SCREEN_LINES]
+        results.add("view.first_frame_ms", elapsed_ms(start))
+
+
+def run_benchmarks(params):
+    results = Results(params)
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            pages = bench_analysis(results, params, workdir)
+        except (OSError, RuntimeError, SystemExit) as e:
+            results.skip("analysis", f"{type(e).__name__}: {e}")
+            pages = None
+        bench_backends(results, params, workdir)
+        bench_pipe(results, params, workdir)
+        bench_snapshots(results, params, workdir, pages)
+    return results
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """
+    [name, old value, new value, relative change, regressed] for every metric
+    in both results.
+    """
+    rows = []
+    for name, metric in sorted(new["metrics"].items()):
+        if name not in old["metrics"]:
+            continue
+        before, after = old["metrics"][name]["value"], metric["value"]
+        change = (after - before) / before if before else 0.0
+        worse = -change if metric["higher_is_better"] else change
+        # Row counts only describe the workload.
+        regressed = metric["unit"] != "rows" and worse > threshold
+        rows.append([name, before, after, change, regressed])
+    return rows
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--objects", default=100000, help="Objects in the synthetic target.")
+@click.option("--types", default=100, help="Classes they are spread over.")
+@click.option("--depth", default=4, help="Length of their chains of references.")
+@click.option(
+    "--backend",
+    type=click.Choice(["agent"] + list(analysis_utils.BACKENDS)),
+    default="agent",
+    help="How to run the analysis in the target. The agent needs no gdb.",
+)
+@click.option("--pipe-rows", default=100000, help="Rows sent down the FIFO.")
+@click.option("--repeat", default=5, help="Runs of every benchmark.")
+@click.option("-o", "--output-file", help="Write the results as JSON here.")
+def run(objects, types, depth, backend, pipe_rows, repeat, output_file):
+    """
+    Run every benchmark against a synthetic target.
+    """
+    params = {
+        "objects": objects,
+        "types": types,
+        "depth": depth,
+        "backend": backend,
+        "pipe_rows": pipe_rows,
+        "repeat": repeat,
+    }
+    results = run_benchmarks(params).as_dict()
+    for name, metric in sorted(results["metrics"].items()):
+        click.echo(f"{name:45} {metric['value']:>14.3f} {metric['unit']}")
+    for benchmark, reason in results["skipped"].items():
+        frontend_utils.echo_error(f"Skipped {benchmark}: {reason}")
+    if output_file:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=2)
+        frontend_utils.echo_info(f"Wrote the results to {output_file}")
+
+
+@cli.command(name="compare")
+@click.argument("old", type=click.File())
+@click.argument("new", type=click.File())
+@click.option(
+    "--threshold",
+    default=THRESHOLD,
+    help="Relative change past which a metric has regressed.",
+)
+def compare_command(old, new, threshold):
+    """
+    Compare two results files, failing if any metric regressed.
+    """
+    rows = compare(json.load(old), json.load(new), threshold)
+    for name, before, after, change, regressed in rows:
+        mark = "  REGRESSED" if regressed else ""
+        click.echo(f"{name:45} {before:>14.3f} {after:>14.3f} {change:>+8.1%}{mark}")
+    if any(row[-1] for row in rows):
+        sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Synthetic targets for the benchmarks: a process holding a heap of a given
+shape, and a writer that sends rows down the analysis FIFO.
+
+    python -m benchmarks.target heap --objects 100000 --types 500 --depth 4
+    python -m benchmarks.target pipe /tmp/memanz_pipe_123 --rows 100000
+
+The heap target prints "ready" once its heap is built, and exits when its
+stdin closes.
+"""
+
+import os
+import pickle
+import sys
+
+import click
+import pkg_resources
+
+from memory_analyzer import analysis_utils
+
+
+def make_types(count):
+    """
+    `count` distinct classes, so the analysis reports as many rows.
+    """
+    return [type(f"Synthetic{i}", (), {}) for i in range(count)]
+
+
+def build_heap(objects, types, depth):
+    """
+    `objects` instances of `types` classes, in chains `depth` long, each
+    holding a dict, a str and a list of ints. Returns the chain heads.
+    """
+    classes = make_types(types)
+    roots = []
+    for i in range(0, objects, depth):
+        child = None
+        for level in range(min(depth, objects - i)):
+            obj = classes[(i + level) % types]()
+            obj.child = child
+            obj.attrs = {"index": i + level, "level": level}
+            obj.name = f"object {i + level}"
+            obj.values = list(range(level + 1))
+            child = obj
+        roots.append(child)
+    return roots
+
+
+def install_agent():
+    """
+    Start the agent in this process, as `memory_analyzer install-agent` would,
+    without waiting on anyone to read its reply.
+    """
+    templates_path = (
+        pkg_resources.resource_filename("memory_analyzer", "templates") + "/"
+    )
+    template = analysis_utils.render_template(
+        "agent.py.template",
+        templates_path,
+        0,
+        [],
+        None,
+        socket_path=analysis_utils.AGENT_SOCKET_PATH,
+    )
+
+    def devnull_open(path, mode="r"):
+        return open(os.devnull, mode)
+
+    exec(template, {"open": devnull_open})
+
+
+def rows(count):
+    return [[f"module.Synthetic{i}", i, 64 * i] for i in range(count)]
+
+
+def frames(count, batch_size=analysis_utils.BATCH_SIZE):
+    """
+    The frames carrying `count` rows, batched as the analysis batches them,
+    then the end of the stream.
+    """
+    data = rows(count)
+    for start in range(0, count, batch_size):
+        payload = pickle.dumps(("rows", data[start : start + batch_size]))
+        yield analysis_utils.FRAME_HEADER.pack(len(payload)) + payload
+    yield analysis_utils.FRAME_HEADER.pack(0)
+
+
+def send_rows(path, count):
+    with open(path, "wb") as fifo:
+        for frame in frames(count):
+            fifo.write(frame)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--objects", default=100000, help="Instances to create.")
+@click.option("--types", default=100, help="Classes to spread them over.")
+@click.option("--depth", default=4, help="Length of each chain of references.")
+@click.option("--agent", is_flag=True, help="Install the agent once ready.")
+def heap(objects, types, depth, agent):
+    roots = build_heap(objects, types, max(depth, 1))
+    if agent:
+        install_agent()
+    print("ready", flush=True)
+    sys.stdin.read()
+    del roots
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--rows", "count", default=100000, help="Rows to send.")
+def pipe(path, count):
+    send_rows(path, count)
+
+
+if __name__ == "__main__":
+    cli()
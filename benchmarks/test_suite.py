@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pickle
+from unittest import TestCase
+
+from memory_analyzer import analysis_utils
+
+from . import suite, target
+
+
+def result(**values):
+    return {
+        "metrics": {
+            name: {"value": value, "unit": unit, "higher_is_better": unit == "MB/s"}
+            for name, (value, unit) in values.items()
+        }
+    }
+
+
+class BenchmarkTests(TestCase):
+    def test_build_heap(self):
+        roots = target.build_heap(10, 3, 4)
+        chains = []
+        for obj in roots:
+            chain = []
+            while obj is not None:
+                chain.append(obj)
+                obj = obj.child
+            chains.append(chain)
+        self.assertEqual([4, 4, 2], [len(chain) for chain in chains])
+        self.assertEqual([3, 2, 1, 0], [obj.attrs["level"] for obj in chains[0]])
+        self.assertEqual(
+            {"Synthetic0", "Synthetic1", "Synthetic2"},
+            {type(obj).__name__ for chain in chains for obj in chain},
+        )
+
+    def test_frames(self):
+        frames = list(target.frames(2500))
+        self.assertEqual(4, len(frames))
+        buf = bytearray(b"".join(frames))
+        payloads = list(analysis_utils.split_frames(buf))
+        self.assertEqual(b"", payloads[-1])
+        rows = [row for p in payloads[:-1] for row in pickle.loads(p)[1]]
+        self.assertEqual(target.rows(2500), rows)
+
+    def test_compare(self):
+        old = result(
+            walk=(100.0, "ms"), pipe=(20.0, "MB/s"), rows=(10, "rows"), new=(1, "ms")
+        )
+        new = result(
+            walk=(130.0, "ms"), pipe=(21.0, "MB/s"), rows=(20, "rows"), gone=(1, "ms")
+        )
+        self.assertEqual(
+            [
+                ["pipe", 20.0, 21.0, 0.05, False],
+                ["rows", 10, 20, 1.0, False],
+                ["walk", 100.0, 130.0, 0.3, True],
+            ],
+            suite.compare(old, new),
+        )
+        self.assertFalse(any(row[-1] for row in suite.compare(old, new, 0.5)))
+
+    def test_results(self):
+        results = suite.Results({"repeat": 3})
+        for value in (3.0, 1.0, 2.0):
+            results.add("walk", value)
+        results.skip("pipe", "no FIFO")
+        data = results.as_dict()
+        self.assertEqual(2.0, data["metrics"]["walk"]["value"])
+        self.assertEqual([3.0, 1.0, 2.0], data["metrics"]["walk"]["samples"])
+        self.assertEqual({"pipe": "no FIFO"}, data["skipped"])
+
+    def test_attach_ms(self):
+        self.assertEqual(
+            2101.5,
+            suite.attach_ms(
+                {
+                    "analyzer": {"start": 1.0, "wait": 2600.0},
+                    "gdb": {"attach": 2100.0, "gil_ensure": 1.5, "payload": 450.0},
+                    "target": {"walk": 400.0},
+                }
+            ),
+        )
+        self.assertEqual(
+            12.0,
+            suite.attach_ms(
+                {
+                    "analyzer": {"start": 2.0, "wait": 460.0},
+                    "target": {"census": 50.0, "walk": 400.0},
+                }
+            ),
+        )
+
+    def test_gil_hold_ms(self):
+        metadata = {
+            "timings": {"target": {"census": 60.0, "walk": 500.0, "pickle": 10.0}},
+            "pause": {"total_pause_ms": 370.0, "elapsed_ms": 590.0},
+        }
+        self.assertEqual(350.0, suite.gil_hold_ms(metadata))
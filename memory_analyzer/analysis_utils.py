@@ -5,32 +5,271 @@
 # LICENSE file in the root directory of this source tree.
 
 import errno
-import io
+import hashlib
+import inspect
+import json
 import os
 import pickle
 import select
+import socket
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import time
 from contextlib import contextmanager
 from shutil import copyfile
-from typing import List
+from typing import Any, Dict, List
 
-from attr import dataclass
+from attr import Factory, dataclass
 from jinja2 import Environment, FileSystemLoader
-from pympler import summary
 
+from . import buffers, diff_utils, heapgraph
+from . import snapshot_file as snapshot_format
 from .frontend import frontend_utils
 
+# Every message on the FIFO is a big-endian length followed by a pickled
+# `(kind, value)` tuple. A zero length marks the end of the stream.
+FRAME_HEADER = struct.Struct(">I")
+READ_SIZE = 1 << 16
+BATCH_SIZE = 1000
+WALK_CHUNK_SIZE = 10000
+# Enough for the reference graph of most services in well under a GB.
+MAX_GRAPH_NODES = 5_000_000
+# Allocation sites shown when the target is tracing with tracemalloc.
+TRACEMALLOC_TOP = 50
+TRACEMALLOC_GROUPS = ("lineno", "filename", "traceback")
+
+# Payloads no run has used for this long are removed, see clean_payloads.
+PAYLOAD_MAX_AGE_S = 7 * 24 * 3600
+AGENT_SOCKET_PATH = "/tmp/memanz_agent_{pid}.sock"
+# sys.remote_exec runs scripts in the target's __main__, this one runs the
+# payload in globals of its own instead, as gdb_commands.payload_source does.
+REMOTE_EXEC_STUB = (
+    "exec(__import__('pathlib').Path({path!r}).read_text(), "
+    "{{'__name__': '__memory_analyzer__'}})\n"
+)
+# How long a payload scheduled with sys.remote_exec has to run and report.
+REMOTE_EXEC_TIMEOUT_S = 300
+
+TEMPLATE_DEFAULTS = {
+    "batch_size": BATCH_SIZE,
+    "walk_chunk_size": WALK_CHUNK_SIZE,
+    "sample_rate": 1.0,
+    "max_pause_ms": 0,
+    "deadline_ms": 0,
+    "retained_top": 0,
+    "max_graph_nodes": MAX_GRAPH_NODES,
+    "graph_dump_path": "",
+    "tracemalloc_top": TRACEMALLOC_TOP,
+    "tracemalloc_group": "lineno",
+    "native_stats": True,
+    "gc_generations": False,
+    "arrays_top": buffers.ARRAYS_TOP,
+}
+
 
 @dataclass
 class RetrievedObjects:
     pid: int
     title: str
     data: List[List[int]]
+    metadata: Dict[str, Any] = Factory(dict)
+
+
+def split_frames(buf):
+    """
+    Yield the payload of every complete frame at the front of `buf`, then drop
+    the consumed bytes. An incomplete trailing frame is left in `buf` for the
+    next read to finish.
+    """
+    offset = 0
+    while len(buf) - offset >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(buf, offset)
+        end = offset + FRAME_HEADER.size + length
+        if len(buf) < end:
+            break
+        yield bytes(buf[offset + FRAME_HEADER.size : end])
+        offset = end
+    del buf[:offset]
+
+
+def payload_dir():
+    """
+    The directory rendered payloads are kept in between runs, next to the
+    FIFOs they write to. It is only accessible to this user, as whatever is
+    in it gets run in the targets.
+    """
+    path = os.path.join(tempfile.gettempdir(), f"memory_analyzer-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise OSError(errno.EPERM, "Not private to this user", path)
+    return path
+
+
+def payload_path(template_out_dir, template_name, template):
+    # Named after the rendered payload, so the same options give the same file.
+    digest = hashlib.sha256(template.encode()).hexdigest()[:16]
+    return os.path.join(template_out_dir, f"{template_name.split('.')[0]}-{digest}.py")
+
+
+def write_payload(template_out_dir, template_name, template):
+    """
+    Write the rendered `template` to `template_out_dir` unless an earlier run
+    already did, and return its path. Payloads take the pid they report for
+    at run time, so all PIDs share the file.
+    """
+    path = payload_path(template_out_dir, template_name, template)
+    if os.path.exists(path):
+        # Keeps it from being cleaned up.
+        os.utime(path)
+        return path
+    # Renamed into place, so that concurrent runs never read half a payload.
+    fd, partial = tempfile.mkstemp(dir=template_out_dir, suffix=".partial")
+    with os.fdopen(fd, "w") as f:
+        f.write(template)
+    os.replace(partial, path)
+    return path
+
+
+def clean_payloads(template_out_dir, max_age_s=PAYLOAD_MAX_AGE_S):
+    """
+    Remove the payloads no run has used for `max_age_s` seconds, and whatever
+    runs that died left behind.
+    """
+    cutoff = time.time() - max_age_s
+    for entry in os.scandir(template_out_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def gdb_timings_path(template_out_dir, pid):
+    # Written by gdb_commands.py once the payload has run.
+    return os.path.join(template_out_dir, f"gdb_timings-{pid}.json")
+
+
+def elapsed_ms(start):
+    return round((time.monotonic() - start) * 1000, 3)
+
+
+@contextmanager
+def timed(timings, phase):
+    """
+    Add how long the block took, in ms, to `timings[phase]`.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(timings.get(phase, 0) + elapsed_ms(start), 3)
+
+
+def agent_socket_path(pid):
+    return AGENT_SOCKET_PATH.format(pid=pid)
+
+
+def agent_available(pid):
+    """
+    True if an agent installed with `install-agent` is listening for `pid`.
+    """
+    path = agent_socket_path(pid)
+    if not os.path.exists(path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def stop_agent(pid):
+    """
+    Ask the agent in `pid` to shut down; it removes its socket on the way out.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(agent_socket_path(pid))
+        sock.sendall(FRAME_HEADER.pack(0))
+        return sock.recv(READ_SIZE).decode(errors="replace").strip()
+
+
+class AgentRequest:
+    """
+    Stands in for the gdb subprocess while an installed agent runs the
+    payload: it "exits" once the agent replies on the socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.returncode = None
+        self.reply = None
+
+    def poll(self):
+        if self.returncode is None:
+            ready_fds, _, _ = select.select([self.sock], [], [], 0)
+            if ready_fds:
+                self._finish()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            self.sock.settimeout(timeout)
+            try:
+                self._finish()
+            except socket.timeout:
+                raise subprocess.TimeoutExpired("memory_analyzer agent", timeout)
+        return self.returncode
+
+    def kill(self):
+        self.sock.close()
+        self.returncode = -9
+
+    def _finish(self):
+        try:
+            self.reply = self.sock.recv(READ_SIZE).decode(errors="replace").strip()
+        except ConnectionResetError:
+            # Hung up on without a reply, as an agent does when it can't tell
+            # who is asking.
+            self.reply = ""
+        self.returncode = 0 if self.reply == "ok" else 1
+        self.sock.close()
+
+
+def extra_page(pid, value):
+    """
+    A page sent alongside the analysis, such as the retained sizes. The extra
+    columns listed in its `size_columns` hold bytes.
+    """
+    rows = value["rows"]
+    for column in value.get("size_columns", ()):
+        for row in rows:
+            row[column] = frontend_utils.readable_size(row[column])
+    return RetrievedObjects(
+        pid=pid,
+        title=f"{value['title']} for {pid}",
+        data=rows,
+        metadata=value.get("metadata", {}),
+    )
 
 
 class GDBObject:
+    backend = "gdb"
+    # Give up on the results after this long, if set. gdb exiting ends the
+    # wait otherwise.
+    timeout_s = None
+    # Load the debug symbols of `executable`, or make do with the symbols the
+    # interpreter exports, which the C-API calls in gdb_commands.py need only.
+    read_symbols = True
+
     def __init__(self, pid, current_path, executable, template_out_path):
         """
         Args:
@@ -38,32 +277,106 @@ class GDBObject:
             pid: numeric pid of the target
             current_path: the directory containing gdb_commands.py
             executable: the binary passed as the first arg to gdb
-            template_out_path: the location that analysis.py rendered templates
-                end up in.
+            template_out_path: the location that rendered templates end up
+                in, see payload_dir.
         """
         self.pid = pid
         self.fifo = f"/tmp/memanz_pipe_{self.pid}"
         self.current_path = current_path
-        # These should all be the same, so safe for threads.
-        os.putenv("MEMORY_ANALYZER_TEMPLATES_PATH", template_out_path)
+        self.template_out_path = template_out_path
+        # The rendered template to run, see write_payload.
+        self.payload_path = None
         self.executable = executable
+        self.metadata = {}
+        # How long each phase took, in ms: "analyzer" ones timed here, "gdb"
+        # ones by gdb_commands.py and "target" ones by the payload.
+        self.timings = {"analyzer": {}}
+
+    def run_analysis(self, debug=False, on_batch=None):
+        """
+        Args:
 
-    def run_analysis(self, debug=False):
+            debug: show the GDB output
+            on_batch: optional callable, called with `(pid, rows)` for every
+                batch of rows as soon as it is decoded off the pipe.
+        """
+        timings = self.timings["analyzer"]
         self.create_pipe()
         frontend_utils.echo_info(f"Analyzing pid {self.pid}")
+        start = time.monotonic()
+        self.started = time.time()
+        with timed(timings, "start"):
+            proc = self._start(debug)
+        with self.drain_pipe(proc) as frames:
+            retrieved_objs = RetrievedObjects(
+                pid=self.pid,
+                title=f"Analysis for {self.pid}",
+                data=self.unpickle_pipe(frames, on_batch),
+                metadata=self.metadata,
+            )
+        total_ms = elapsed_ms(start)
+        self.metadata["backend"] = {"name": self.backend, "elapsed_ms": total_ms}
+        frontend_utils.echo_info(
+            f"Ran the analysis in pid {self.pid} with {self.backend} "
+            f"in {total_ms:.0f}ms"
+        )
+        pause = self.metadata.get("pause")
+        if pause:
+            frontend_utils.echo_info(
+                f"Paused pid {self.pid} for {pause['total_pause_ms']}ms over "
+                f"{pause['slices']} slices (longest {pause['longest_pause_ms']}ms)"
+            )
+            if pause["partial"]:
+                retrieved_objs.title += " (partial)"
+
+        with timed(timings, "exit"):
+            self._end_subprocess(proc)
+        timings["total"] = total_ms
+        self._read_gdb_timings()
+        # The payload sends the "target" timings as metadata.
+        self.metadata["timings"] = dict(
+            self.timings, **self.metadata.get("timings", {})
+        )
+        return retrieved_objs
+
+    def _read_gdb_timings(self):
+        """
+        Pick up what gdb_commands.py timed. How long gdb took to start, read
+        the symbols and attach is measured from when it was started here.
+        """
+        path = gdb_timings_path(self.template_out_path, self.pid)
+        try:
+            with open(path) as f:
+                gdb_timings = json.load(f)
+            os.remove(path)
+        except (OSError, ValueError):
+            return
+        attached = gdb_timings.pop("attached", self.started)
+        self.timings["gdb"] = dict(
+            attach=round(max(attached - self.started, 0) * 1000, 3), **gdb_timings
+        )
+
+    def _start(self, debug):
         command_file = f"{self.current_path}/gdb_commands.py"
+        if self.read_symbols:
+            # Activates python for GDB.
+            target = [self.executable]
+        else:
+            # gdb finds the binary of the process itself.
+            target = ["--readnever", "-iex", "set debuginfod enabled off"]
+            if self.executable:
+                target.append(self.executable)
         command = [
             "gdb",
             "-q",
-            # Activates python for GDB.
-            self.executable,
+            *target,
             "-p",
             f"{self.pid}",
             "-ex",
             "set trace-commands on",
             f"{'-batch' if debug else '-batch-silent'}",
             # This shouldn't be required since we specify absolute path, but
-            # TODO this gives us a way to inject a path with objgraph on it.
+            # TODO this gives us a way to inject a path with extra modules on it.
             "-ex",
             # Lets gdb find the correct gdb_commands script.
             f"set directories {self.current_path}",
@@ -74,18 +387,15 @@ class GDBObject:
             f"{command_file}",
         ]
         frontend_utils.echo_info(f"Setting up GDB for pid {self.pid}")
-        proc = subprocess.Popen(
-            command, stderr=sys.stderr if debug else subprocess.DEVNULL
+        # Read by gdb_commands.py.
+        env = dict(
+            os.environ,
+            MEMORY_ANALYZER_TEMPLATES_PATH=self.template_out_path,
+            MEMORY_ANALYZER_PAYLOAD=self.payload_path or "",
+        )
+        return subprocess.Popen(
+            command, stderr=sys.stderr if debug else subprocess.DEVNULL, env=env
         )
-        with self.drain_pipe(proc) as data:
-            retrieved_objs = RetrievedObjects(
-                pid=self.pid,
-                title=f"Analysis for {self.pid}",
-                data=self.unpickle_pipe(data),
-            )
-
-        self._end_subprocess(proc)
-        return retrieved_objs
 
     @contextmanager
     def drain_pipe(self, process):
@@ -93,29 +403,13 @@ class GDBObject:
         We need this because by default, `open`s on named pipes block. If GDB or
         the injected GDB extension in Python crash, the process will never write
         to the pipe and we will block opening and `memory_analyzer` won't exit.
+
+        Yields an iterator over the frame payloads, decoded as they arrive so
+        that only a single frame is ever buffered.
         """
         try:
             pipe = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
-            result = io.BytesIO()
-            timeout = 0.1  # seconds
-
-            partial_read = None
-            while bool(partial_read) or process.poll() is None:
-                ready_fds, _, _ = select.select([pipe], [], [], timeout)
-
-                if len(ready_fds) > 0:
-                    ready_fd = ready_fds[0]
-                    try:
-                        partial_read = os.read(ready_fd, select.PIPE_BUF)
-                    except BlockingIOError:
-                        partial_read = None
-
-                    if partial_read:
-                        result.write(partial_read)
-
-            result.seek(0)
-            yield result
-            result.close()
+            yield self._read_frames(pipe, process)
         except Exception as e:
             frontend_utils.echo_error(f"Failed with {e}")
             self._end_subprocess(process)
@@ -123,10 +417,52 @@ class GDBObject:
         finally:
             os.close(pipe)
 
+    def _read_frames(self, pipe, process):
+        timings = self.timings["analyzer"]
+        buf = bytearray()
+        timeout = 0.1  # seconds
+        waiting = time.monotonic()
+        first_read = None
+        deadline = waiting + self.timeout_s if self.timeout_s else None
+
+        partial_read = None
+        finished = False
+        while bool(partial_read) or not finished:
+            # Checked before reading, so anything written just before the
+            # writer exited is still drained.
+            finished = process.poll() is not None
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"pid {self.pid} sent no complete results within "
+                    f"{self.timeout_s}s; is it stuck in native code, or unable to "
+                    f"write to {self.fifo}?"
+                )
+            partial_read = None
+            ready_fds, _, _ = select.select([pipe], [], [], timeout)
+
+            if len(ready_fds) > 0:
+                ready_fd = ready_fds[0]
+                try:
+                    partial_read = os.read(ready_fd, READ_SIZE)
+                except BlockingIOError:
+                    partial_read = None
+
+                if partial_read:
+                    if first_read is None:
+                        # Until then gdb attaches and the payload runs.
+                        first_read = time.monotonic()
+                        timings["wait"] = elapsed_ms(waiting)
+                    buf += partial_read
+                    for frame in split_frames(buf):
+                        if not frame:
+                            timings["drain"] = elapsed_ms(first_read)
+                            return
+                        yield frame
+
     def _end_subprocess(self, proc):
         try:
             proc.wait(5)
-        except TimeoutError:
+        except subprocess.TimeoutExpired:
             proc.kill()
 
     def create_pipe(self):
@@ -137,13 +473,27 @@ class GDBObject:
             if oe.errno != errno.EEXIST:
                 raise
 
-    def unpickle_pipe(self, fifo):
+    def unpickle_pipe(self, frames, on_batch=None):
         frontend_utils.echo_info("Gathering data...")
+        items = []
+        timings = self.timings["analyzer"]
         try:
-            items = pickle.load(fifo)
+            for frame in frames:
+                with timed(timings, "unpickle"):
+                    kind, value = pickle.loads(frame)
+                if kind == "error":
+                    raise value
+                elif kind == "meta":
+                    self.metadata.update(value)
+                elif kind == "rows":
+                    items.extend(value)
+                    if on_batch:
+                        on_batch(self.pid, value)
+                elif kind == "page":
+                    self.metadata.setdefault("pages", []).append(
+                        extra_page(self.pid, value)
+                    )
             if items:
-                if isinstance(items, Exception):
-                    raise items
                 return items
         except EOFError:
             return
@@ -157,32 +507,201 @@ class GDBObject:
             raise
 
 
+class MinimalGDBObject(GDBObject):
+    """
+    Attaches gdb without reading any debug symbols, so neither a debug
+    interpreter nor its symbols are needed, and the attach is much faster.
+    """
+
+    backend = "gdb-minimal"
+    read_symbols = False
+
+
+class RemoteExecRequest:
+    """
+    Stands in for the gdb subprocess while the target runs a payload
+    scheduled with sys.remote_exec: the scheduling process exits straight
+    away, while the payload only ends the FIFO stream once it is done.
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.returncode = None
+        self.scheduled = False
+
+    def poll(self):
+        if self.returncode is not None or self.scheduled:
+            return self.returncode
+        status = self.proc.poll()
+        if status == 0:
+            # Scheduled, not finished: the payload runs once the target next
+            # checks for pending calls, and ends the stream itself. How long
+            # that may take is up to RemoteExecObject.timeout_s.
+            self.scheduled = True
+        elif status is not None:
+            # Scheduling failed, nothing will run.
+            self.returncode = status
+            if self.proc.stderr:
+                error = self.proc.stderr.read().decode(errors="replace").strip()
+                frontend_utils.echo_error(f"sys.remote_exec failed: {error}")
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.returncode = self.proc.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self.proc.kill()
+        self.returncode = -9
+
+
+class RemoteExecObject(GDBObject):
+    """
+    Runs the analysis with sys.remote_exec, Python 3.14's safe way of running
+    a script in another interpreter, without gdb. `executable` is the Python
+    that schedules it, a version the target's interpreter accepts.
+    """
+
+    backend = "remote-exec"
+    # Nothing tells us if the payload never runs, or cannot open the FIFO.
+    timeout_s = REMOTE_EXEC_TIMEOUT_S
+
+    def _start(self, debug):
+        frontend_utils.echo_info(f"Scheduling analysis in pid {self.pid}")
+        # The payload cannot be told its pid here, it reports for the one it
+        # runs in.
+        stub = write_payload(
+            os.path.dirname(self.payload_path),
+            "remote_exec",
+            REMOTE_EXEC_STUB.format(path=self.payload_path),
+        )
+        command = [
+            self.executable,
+            "-c",
+            "import sys; sys.remote_exec(int(sys.argv[1]), sys.argv[2])",
+            str(self.pid),
+            stub,
+        ]
+        proc = subprocess.Popen(command, stderr=None if debug else subprocess.PIPE)
+        return RemoteExecRequest(proc)
+
+
+class AgentObject(GDBObject):
+    """
+    Runs the analysis through an agent previously injected by `install-agent`
+    instead of attaching gdb. Results come back over the same FIFO.
+    """
+
+    backend = "agent"
+
+    def _start(self, debug):
+        frontend_utils.echo_info(f"Sending analysis to the agent in pid {self.pid}")
+        with open(self.payload_path) as f:
+            payload = f.read().encode()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(agent_socket_path(self.pid))
+        sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+        return AgentRequest(sock)
+
+
+BACKENDS = {
+    "gdb": GDBObject,
+    "gdb-minimal": MinimalGDBObject,
+    "remote-exec": RemoteExecObject,
+}
+
+
+def default_executable(backend):
+    """
+    The Python executable a backend uses unless told otherwise: the debug
+    interpreter for gdb, this interpreter to call sys.remote_exec, and none
+    for gdb-minimal, which reads the target's own binary.
+    """
+    if backend == "gdb":
+        return f"{sys.executable}-dbg"
+    if backend == "remote-exec":
+        return sys.executable
+    return None
+
+
+def injector(backend, pid, current_path, executable, template_out_path):
+    """
+    The object that runs rendered templates in `pid` with `backend`, one of
+    BACKENDS.
+    """
+    return BACKENDS[backend](
+        pid,
+        current_path,
+        executable or default_executable(backend),
+        template_out_path,
+    )
+
+
+# One Environment per templates directory, which keeps the compiled templates,
+# and the payloads already rendered, by template and options.
+_environments = {}
+_rendered = {}
+
+
 def load_template(name, templates_path):
-    env = Environment(autoescape=False, loader=FileSystemLoader(templates_path))
+    env = _environments.get(templates_path)
+    if env is None:
+        env = _environments.setdefault(
+            templates_path,
+            Environment(autoescape=False, loader=FileSystemLoader(templates_path)),
+        )
+    # A new Template if the file changed.
     return env.get_template(name)
 
 
 def render_template(
-    template_name,
-    templates_path,
-    num_refs,
-    pid,
-    specific_refs,
-    output_path,
-    template_out_dir,
+    template_name, templates_path, num_refs, specific_refs, output_path, **options
 ):
-    objgraph_template = load_template(template_name, templates_path)
-    template = objgraph_template.render(
-        num_refs=num_refs, pid=pid, specific_refs=specific_refs, output_path=output_path
+    """
+    Render the analysis template. Any extra keyword `options` override the
+    matching entries of TEMPLATE_DEFAULTS. The payload works for any pid, see
+    write_payload, and is only rendered once for the same options.
+    """
+    template = load_template(template_name, templates_path)
+    params = dict(
+        TEMPLATE_DEFAULTS,
+        num_refs=num_refs,
+        specific_refs=specific_refs,
+        output_path=output_path,
+        **options,
     )
-    # This path has to match the end of gdb_commands.py; the env var is set in
-    # GDBObject constructor above.
-    if template_out_dir:
-        with open(
-            os.path.join(template_out_dir, f"rendered_template-{pid}.py.out"), "w"
-        ) as f:
-            f.write(template)
-    return template
+    key = (template, repr(sorted(params.items())))
+    rendered = _rendered.get(key)
+    if rendered is None:
+        rendered = _rendered[key] = template.render(
+            heapgraph_source=inspect.getsource(heapgraph),
+            buffers_source=inspect.getsource(buffers),
+            **params,
+        )
+    return rendered
+
+
+def graph_dump_pages(filename, retained_top=0, num_refs=0, specific_refs=()):
+    """
+    Analyze a heap graph dumped by the target: the per-type summary of its
+    objects, with the references of the types asked for, and if
+    `retained_top` the objects retaining the most memory.
+    """
+    graph = heapgraph.GraphDump(filename)
+    pid = graph.info.get("pid", 0)
+    rows = graph.type_rows()
+    heapgraph.add_references(graph, rows, num_refs, specific_refs)
+    pages = [
+        RetrievedObjects(
+            pid=pid,
+            title=f"Analysis for {pid}",
+            data=rows,
+            metadata={"graph": graph.metadata()},
+        )
+    ]
+    if retained_top:
+        pages.append(extra_page(pid, graph.retained_page(retained_top)))
+    return pages
 
 
 def snapshot_diff(cur_items, snapshot_file):
@@ -191,29 +710,32 @@ def snapshot_diff(cur_items, snapshot_file):
     the first PID listed to the first PID in the file. Any unmatched or non-first
     PIDs will be ignored because we don't know what to compare them to.
     """
+    prev_items = read_snapshot_pages(snapshot_file)
+    if prev_items is None:
+        return None
+    return diff_utils.diff_pages(cur_items, prev_items)
+
+
+def snapshot_trend(cur_items, snapshot_files):
+    """
+    Compares like PIDs across all of `snapshot_files`, oldest first, and the
+    current run.
+    """
+    snapshots = []
+    for snapshot_file in snapshot_files:
+        prev_items = read_snapshot_pages(snapshot_file)
+        if prev_items is None:
+            return None
+        snapshots.append(prev_items)
+    snapshots.append(cur_items)
+    return diff_utils.trend_pages(snapshots)
+
+
+def read_snapshot_pages(snapshot_file):
     try:
-        prev_items = list(frontend_utils.get_pages(snapshot_file))
-    except pickle.UnpicklingError as e:
+        return list(frontend_utils.get_pages(snapshot_file))
+    except (pickle.UnpicklingError, snapshot_format.SnapshotError) as e:
         frontend_utils.echo_error(
             f"Error unpickling the data from {snapshot_file}: {e}"
         )
         return None
-
-    differences = []
-    for cur_item in cur_items:
-        for prev_item in prev_items:
-            if cur_item.pid == prev_item.pid:
-                diff = summary.get_diff(cur_item.data, prev_item.data)
-                differences.append(
-                    RetrievedObjects(
-                        pid=cur_item.pid,
-                        title=f"Snapshot Differences for {cur_item.pid}",
-                        data=diff,
-                    )
-                )
-    if not differences:
-        diff = summary.get_diff(cur_items[0].data, prev_items[0].data)
-        differences.append(
-            RetrievedObjects(pid=0, title=f"Snapshot Differences", data=diff)
-        )
-    return differences
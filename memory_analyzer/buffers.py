@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Sizes of NumPy arrays that count every buffer once.
+
+sys.getsizeof counts the data of an array only if the array allocated it, so
+views of a buffer owned by something else (bytes, an mmap, a C extension)
+count nothing for it, and a base array only reachable through its views isn't
+found at all. Arrays found during the heap walk are kept, and afterwards the
+memory ranges they span are merged: each merged range is attributed once, to
+the type of the object that owns the buffer. Buffers of owners already
+counted in full by the walk (bytes, bytearray, array.array...) are left out.
+
+Reading each array's data pointer is a Python loop, the only part that is;
+sorting, merging and summing the ranges is done by NumPy over all arrays at
+once.
+
+Memoryviews need nothing of the sort: sys.getsizeof already leaves out their
+buffer, and the object exporting it is found through the view. Arrays over a
+memoryview are followed through it to the object that exports the buffer.
+
+This module only uses the standard library and the NumPy the target has
+already imported: its source is inlined into the analysis template and runs
+inside the target.
+"""
+
+import gc
+import sys
+
+# Groups of arrays by dtype and shape reported, largest first.
+ARRAYS_TOP = 20
+
+
+class ArrayBuffers:
+    """
+    The arrays found by a heap walk, and the buffers behind them.
+    """
+
+    def __init__(self, np):
+        self.np = np
+        self.arrays = []
+        self.stats = {"arrays": 0, "views": 0, "buffer_bytes": 0}
+        self.histogram = {}
+
+    @classmethod
+    def for_target(cls):
+        """
+        None unless the target has imported NumPy; it is never imported here.
+        """
+        np = sys.modules.get("numpy")
+        if np is None or not hasattr(np, "ndarray"):
+            return None
+        return cls(np)
+
+    def is_array_type(self, objtype):
+        return issubclass(objtype, self.np.ndarray)
+
+    def _extent(self, array):
+        """
+        The [low, high) range of addresses the elements of `array` span.
+        """
+        interface = array.__array_interface__
+        low = high = interface["data"][0]
+        strides = interface["strides"]
+        if strides is None:
+            return low, high + array.nbytes
+        for dim, stride in zip(array.shape, strides):
+            offset = (dim - 1) * stride
+            if offset < 0:
+                low += offset
+            else:
+                high += offset
+        return low, high + array.itemsize
+
+    def _histogram_add(self, array, owndata):
+        # Keyed by the dtype itself: formatting one takes microseconds.
+        group = self.histogram.setdefault((array.dtype, array.shape), [0, 0, 0])
+        group[0] += 1
+        group[1] += array.nbytes
+        if owndata:
+            group[2] += array.nbytes
+
+    def corrections(self, seen):
+        """
+        Changes to the walk's per-type [count, size] totals: the data
+        sys.getsizeof counted for owning arrays comes off, and the merged
+        buffers go to their owners' types. Owners the walk never reached,
+        such as base arrays only held by views, are counted too. `seen` holds
+        the ids of the untracked objects the walk reached.
+
+        The arrays are dropped afterwards.
+        """
+        np = self.np
+        ndarray = np.ndarray
+        arrays, self.arrays = self.arrays, []
+        walked = {id(array) for array in arrays}
+        changes = {}
+        starts, ends, owners, skip = [], [], [], []
+        owner_types = {}
+        for array in arrays:
+            owndata = array.flags.owndata
+            if owndata:
+                totals = changes.setdefault(type(array), [0, 0])
+                totals[1] -= array.nbytes
+            else:
+                self.stats["views"] += 1
+            self._histogram_add(array, owndata)
+            if not array.size:
+                continue
+            # Views hold their base, arrays over other buffers hold the object
+            # exporting them, at times through a memoryview.
+            owner = array
+            while True:
+                if isinstance(owner, ndarray) and owner.base is not None:
+                    owner = owner.base
+                elif isinstance(owner, memoryview) and owner.obj is not None:
+                    owner = owner.obj
+                else:
+                    break
+            is_array = isinstance(owner, ndarray)
+            if id(owner) in owner_types:
+                if is_array:
+                    continue
+            else:
+                owner_types[id(owner)] = type(owner)
+                if is_array:
+                    reached = id(owner) in walked
+                else:
+                    reached = id(owner) in seen or gc.is_tracked(owner)
+                if not reached:
+                    totals = changes.setdefault(type(owner), [0, 0])
+                    totals[0] += 1
+                    totals[1] += sys.getsizeof(owner)
+                    if is_array:
+                        self._histogram_add(owner, owner.flags.owndata)
+                        if owner.flags.owndata:
+                            totals[1] -= owner.nbytes
+            # A base array owns all of its buffer, however little its views
+            # span, and is looked at once. Other owners only show the part
+            # each view spans.
+            low, high = self._extent(owner if is_array else array)
+            starts.append(low)
+            ends.append(high)
+            owners.append(id(owner))
+            # An owner that isn't an array and whose own size covers the
+            # buffer was counted in full by the walk.
+            skip.append(not is_array and sys.getsizeof(owner) >= high - low)
+        self.stats["arrays"] += len(arrays)
+        del arrays, walked
+        if not starts:
+            return changes
+
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        # By start, then longest first, so every merged range begins with the
+        # widest view of its buffer.
+        order = np.lexsort((-ends, starts))
+        starts, ends = starts[order], ends[order]
+        run_end = np.maximum.accumulate(ends)
+        first = np.empty(len(starts), dtype=bool)
+        first[0] = True
+        first[1:] = starts[1:] >= run_end[:-1]
+        (heads,) = np.nonzero(first)
+        sizes = np.maximum.reduceat(ends, heads) - starts[heads]
+        self.stats["buffer_bytes"] += int(sizes.sum())
+        keep = ~np.array(skip, dtype=bool)[order][heads]
+        head_owners = np.array(owners, dtype=np.int64)[order][heads][keep]
+        sizes = sizes[keep]
+        unique, inverse = np.unique(head_owners, return_inverse=True)
+        by_owner = np.bincount(inverse, weights=sizes, minlength=len(unique))
+        for owner, size in zip(unique.tolist(), by_owner.tolist()):
+            totals = changes.setdefault(owner_types[owner], [0, 0])
+            totals[1] += int(size)
+        return changes
+
+    def apply(self, totals, seen):
+        """
+        Apply the corrections to the walk's `totals`, keyed by type.
+        """
+        for objtype, (count, size) in self.corrections(seen).items():
+            entry = totals.setdefault(objtype, [0, 0])
+            entry[0] += count
+            entry[1] += size
+
+    def page(self, top=ARRAYS_TOP):
+        """
+        The `top` groups of arrays of the same dtype and shape holding the
+        most data, as a page to send back, see analysis_utils.extra_page.
+        """
+        groups = sorted(self.histogram.items(), key=lambda item: -item[1][1])
+        rows = [
+            [f"{dtype} {list(shape)}", count, nbytes, owned]
+            for (dtype, shape), (count, nbytes, owned) in groups[:top]
+        ]
+        return {
+            "title": "Arrays",
+            "rows": rows,
+            "metadata": {
+                "columns": ["Owned"],
+                "buffers": dict(self.stats, groups=len(groups)),
+            },
+            "size_columns": [3],
+        }
@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Per-type heap summaries of core dumps (gcore, or the kernel's), read straight
+from the memory image without gdb or a live process.
+
+Objects are found by their headers. Every 16 bytes of writable memory is a
+candidate object: a reference count, then a pointer to its type. Types are
+the objects whose own type is `type`, or a metaclass, found from the address
+of PyType_Type that the interpreter exports. Candidates whose type is one of
+them are kept, minus freed memory: objects are freed once their reference
+count drops to zero, and allocators overwrite the first words of what they
+free with pointers, neither a plausible reference count. Freed GC objects are
+also told apart by their GC header, which only live ones keep linked.
+
+This is a heuristic: two words that only look like the start of an object,
+say inside a buffer, are taken for one. Most objects are allocated from
+pymalloc's pools, whose headers give the size of their blocks, so candidates
+in a pool are only kept at the start of a block large enough for them. That
+leaves look-alikes in memory pymalloc doesn't manage, such as large buffers,
+which nothing tells from real objects short of walking the interpreter's
+own lists.
+
+Only the exported symbols of the interpreter are needed, no debug build, and
+the layout relied on (object and type headers) has held from Python 3.8 on.
+Sizes follow sys.getsizeof for str, int, list and bytearray and for fixed or
+variable-size objects; the tables of dicts and sets are not followed.
+
+Only 64-bit little-endian cores are read. The scan is vectorized with numpy,
+which is needed here only.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+
+from . import analysis_utils
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+PROGRAM_HEADER = struct.Struct("<IIQQQQQQ")
+SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+SYMBOL = struct.Struct("<IBBHQQ")
+NOTE_HEADER = struct.Struct("<III")
+WORD = struct.Struct("<Q")
+
+ET_CORE = 4
+PT_LOAD = 1
+PT_NOTE = 4
+PF_W = 2
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+NT_PRSTATUS = 1
+NT_AUXV = 6
+NT_FILE = 0x46494C45
+AT_ENTRY = 9
+# Offset of pr_pid in the kernel's elf_prstatus.
+PRSTATUS_PID = 32
+
+# Offsets in PyObject and PyTypeObject, the same on every 64-bit build since
+# Python 3.8.
+OB_TYPE = 8
+OB_SIZE = 16
+TP_NAME = 24
+TP_BASICSIZE = 32
+TP_ITEMSIZE = 40
+TP_FLAGS = 168
+PY_TPFLAGS_HEAPTYPE = 1 << 9
+PY_TPFLAGS_READY = 1 << 12
+PY_TPFLAGS_HAVE_GC = 1 << 14
+# Instances with these (3.11 on) keep their dict and weak references in two
+# words before the GC header.
+PY_TPFLAGS_PREHEADER = (1 << 3) | (1 << 4)
+PREHEADER_SIZE = 16
+GC_HEAD_SIZE = 16
+# Headers of compact ASCII and other compact strs, before and from 3.12, which
+# dropped their wstr fields.
+STR_HEADERS = (48, 72)
+STR_HEADERS_312 = (40, 56)
+# Reference counts above this are taken for pointers. Immortal objects have
+# counts just under it.
+MAX_REFCOUNT = 0xFFFFFFFF
+# Pointers below this are not pointers.
+MIN_ADDRESS = 4096
+# Types with fields beyond these are taken for something else.
+MAX_BASICSIZE = 1 << 20
+MAX_ITEMSIZE = 64
+MAX_NAME = 256
+# Objects longer than this are taken for something else.
+MAX_LENGTH = 1 << 40
+# pymalloc: pools of 16KiB from 3.10 on, 4KiB before, whose header ends with
+# the u32 arena index, size class index, next and last block offsets, and
+# blocks of 16 bytes per size class from 16 to 512.
+POOL_SIZES = (1 << 14, 1 << 12)
+POOL_SZIDX = 32
+POOL_OFFSETS = 40
+POOL_OVERHEAD = 48
+POOL_ALIGNMENT = 16
+SIZE_CLASSES = 32
+
+
+class CoreError(Exception):
+    pass
+
+
+def str_headers(version):
+    """
+    The header sizes of compact ASCII and other compact strs for the
+    interpreter with PY_VERSION_HEX `version`, None if older than 3.11.
+    """
+    if version is not None and version >= 0x030C0000:
+        return STR_HEADERS_312
+    return STR_HEADERS
+
+
+def check_numpy():
+    if np is None:
+        raise ImportError("Analyzing core dumps needs numpy: pip install numpy")
+
+
+class ElfFile:
+    """
+    The program headers, notes and symbols of a 64-bit little-endian ELF file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.data[: ELF_HEADER.size]
+        if len(header) < ELF_HEADER.size or header[:4] != b"\x7fELF":
+            raise CoreError(f"{filename} is not an ELF file")
+        if header[4] != 2 or header[5] != 1:
+            raise CoreError(f"{filename} is not a 64-bit little-endian ELF file")
+        (
+            _,
+            self.type,
+            _,
+            _,
+            self.entry,
+            phoff,
+            shoff,
+            _,
+            _,
+            phentsize,
+            phnum,
+            shentsize,
+            shnum,
+            _,
+        ) = ELF_HEADER.unpack(header)
+        self.segments = [
+            PROGRAM_HEADER.unpack_from(self.data, phoff + i * phentsize)
+            for i in range(phnum)
+        ]
+        self.sections = [
+            SECTION_HEADER.unpack_from(self.data, shoff + i * shentsize)
+            for i in range(shnum if shoff else 0)
+        ]
+
+    def close(self):
+        self.data.close()
+
+    def notes(self):
+        """
+        Yield the (type, name, description) of every note.
+        """
+        for p_type, _, offset, _, _, filesz, _, _ in self.segments:
+            if p_type != PT_NOTE:
+                continue
+            pos, end = offset, offset + filesz
+            while pos + NOTE_HEADER.size <= end:
+                namesz, descsz, n_type = NOTE_HEADER.unpack_from(self.data, pos)
+                pos += NOTE_HEADER.size
+                name = self.data[pos : pos + namesz].rstrip(b"\0")
+                pos += (namesz + 3) & ~3
+                yield n_type, name, self.data[pos : pos + descsz]
+                pos += (descsz + 3) & ~3
+
+    def symbol(self, name):
+        """
+        The value of the symbol `name`, from the dynamic symbol table first,
+        or None.
+        """
+        wanted = name.encode()
+        for kind in (SHT_DYNSYM, SHT_SYMTAB):
+            for _, sh_type, _, _, offset, size, link, _, _, entsize in self.sections:
+                if sh_type != kind or not entsize:
+                    continue
+                strtab = self.sections[link]
+                for pos in range(offset, offset + size, entsize):
+                    st_name, _, _, shndx, value, _ = SYMBOL.unpack_from(self.data, pos)
+                    if not shndx or not value:
+                        continue
+                    start = strtab[4] + st_name
+                    if self.data[start : start + len(wanted) + 1] == wanted + b"\0":
+                        return value
+        return None
+
+    def load_base(self):
+        """
+        The lowest address the file's loadable segments ask for.
+        """
+        return min(
+            vaddr & ~0xFFF
+            for p_type, _, _, vaddr, _, _, _, _ in self.segments
+            if p_type == PT_LOAD
+        )
+
+
+class CoreImage(ElfFile):
+    """
+    The memory of a crashed or gcore'd process. Memory the core left out,
+    such as the read-only parts of the binaries, is read from the mapped files
+    themselves, if they are still where the process found them.
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        if self.type != ET_CORE:
+            raise CoreError(f"{filename} is not a core dump")
+        self.loads = sorted(
+            (vaddr, vaddr + filesz, offset, flags)
+            for p_type, flags, offset, vaddr, _, filesz, _, _ in self.segments
+            if p_type == PT_LOAD and filesz
+        )
+        self.starts = [load[0] for load in self.loads]
+        self.pid = 0
+        self.auxv = {}
+        # (start, end, file offset, path) of every mapped file.
+        self.files = []
+        for n_type, _, desc in self.notes():
+            if n_type == NT_PRSTATUS and not self.pid:
+                self.pid = struct.unpack_from("<i", desc, PRSTATUS_PID)[0]
+            elif n_type == NT_AUXV:
+                words = struct.unpack(f"<{len(desc) // 8}Q", desc)
+                self.auxv.update(zip(words[::2], words[1::2]))
+            elif n_type == NT_FILE:
+                count, page_size = struct.unpack_from("<QQ", desc)
+                names = bytes(desc[16 + count * 24 :]).split(b"\0")
+                for i in range(count):
+                    start, end, page = struct.unpack_from("<QQQ", desc, 16 + i * 24)
+                    path = os.fsdecode(names[i])
+                    self.files.append((start, end, page * page_size, path))
+        self.opened = {}
+
+    def close(self):
+        for elf in self.opened.values():
+            if elf is not None:
+                elf.close()
+        super().close()
+
+    def _mapped_file(self, path):
+        if path not in self.opened:
+            try:
+                self.opened[path] = ElfFile(path)
+            except (OSError, ValueError, CoreError):
+                self.opened[path] = None
+        return self.opened[path]
+
+    def read(self, address, size):
+        pos = bisect.bisect_right(self.starts, address) - 1
+        if pos >= 0:
+            start, end, offset, _ = self.loads[pos]
+            if address + size <= end:
+                return self.data[
+                    offset + address - start : offset + address - start + size
+                ]
+        for start, end, offset, path in self.files:
+            if start <= address and address + size <= end:
+                elf = self._mapped_file(path)
+                if elf is not None:
+                    pos = offset + address - start
+                    data = elf.data[pos : pos + size]
+                    if len(data) == size:
+                        return data
+        raise CoreError(f"Address {address:#x} is not in the core")
+
+    def read_word(self, address):
+        return WORD.unpack(self.read(address, WORD.size))[0]
+
+    def read_string(self, address, limit=256):
+        data = b""
+        while len(data) < limit:
+            try:
+                chunk = self.read(address + len(data), 16)
+            except CoreError:
+                chunk = self.read(address + len(data), 1)
+            end = chunk.find(b"\0")
+            if end >= 0:
+                return (data + chunk[:end]).decode(errors="replace")
+            data += chunk
+        return data.decode(errors="replace")
+
+    def executable(self):
+        """
+        The path the process ran, from the mapping its entry point is in.
+        """
+        entry = self.auxv.get(AT_ENTRY)
+        for start, end, _, path in self.files:
+            if entry is not None and start <= entry < end:
+                return path
+        return None
+
+    def writable_memory(self):
+        """
+        Yield the start address and bytes of every writable part of the core.
+        """
+        for start, end, offset, flags in self.loads:
+            if flags & PF_W:
+                yield start, memoryview(self.data)[offset : offset + end - start]
+
+
+def find_symbol(core, executable, name):
+    """
+    The address of `name` in the process: in its executable, whose load
+    address the entry point gives away, or in the libpython it mapped.
+    """
+    candidates = []
+    if executable:
+        elf = ElfFile(executable)
+        entry = core.auxv.get(AT_ENTRY)
+        candidates.append((elf, entry - elf.entry if entry is not None else 0))
+    for path in dict.fromkeys(path for *_, path in core.files):
+        if "libpython" in os.path.basename(path):
+            elf = core._mapped_file(path)
+            if elf is not None:
+                base = min(start for start, *_, p in core.files if p == path)
+                candidates.append((elf, base - elf.load_base()))
+    for elf, bias in candidates:
+        value = elf.symbol(name)
+        if value is not None:
+            return value + bias
+    return None
+
+
+class CoreHeap:
+    """
+    The objects in a core dump, found by their headers.
+    """
+
+    def __init__(self, core, executable=None):
+        check_numpy()
+        self.core = core
+        self.executable = executable or core.executable()
+        self.type_type = find_symbol(core, self.executable, "PyType_Type")
+        if self.type_type is None:
+            raise CoreError(
+                f"PyType_Type is in neither {self.executable} nor a libpython "
+                "the process mapped"
+            )
+        version = find_symbol(core, self.executable, "Py_Version")
+        # Py_Version is new in 3.11.
+        self.version = self._read(version, 4, "<I") if version else None
+        self.segments = []
+        for start, memory in core.writable_memory():
+            if start % 16 == 0:
+                words = np.frombuffer(memory[: len(memory) // 16 * 16], dtype="<u8")
+                self.segments.append((start, words))
+        self.types = {}
+
+    def _read(self, address, size, fmt):
+        try:
+            return struct.unpack(fmt, self.core.read(address, size))[0]
+        except CoreError:
+            return None
+
+    def _scan(self):
+        for _, words in self.segments:
+            yield self._candidates(words)
+
+    def _gather(self, addresses):
+        """
+        The words at the 8-aligned `addresses`, 0 for those outside the
+        writable memory.
+        """
+        order = np.argsort(addresses, kind="stable")
+        addresses = addresses[order]
+        values = np.zeros(len(addresses), dtype="<u8")
+        for start, words in self.segments:
+            low, high = np.searchsorted(addresses, [start, start + 8 * len(words)])
+            offsets = addresses[low:high] - np.uint64(start)
+            aligned = offsets % 8 == 0
+            chunk = np.zeros(high - low, dtype="<u8")
+            chunk[aligned] = words[(offsets[aligned] // 8).astype(np.intp)]
+            values[low:high] = chunk
+        gathered = np.empty_like(values)
+        gathered[order] = values
+        return gathered
+
+    def python_version(self):
+        if self.version is None:
+            return None
+        return ".".join(str(self.version >> shift & 0xFF) for shift in (24, 16, 8))
+
+    def _candidates(self, words):
+        refcounts = words[0::2]
+        types = words[1::2]
+        plausible = (
+            (refcounts - 1 < MAX_REFCOUNT) & (types % 8 == 0) & (types >= MIN_ADDRESS)
+        )
+        return plausible, types
+
+    def find_types(self):
+        """
+        Every type in the heap: objects whose type is `type`, or a type whose
+        own type is, and so on for metaclasses.
+        """
+        found = [types[plausible] for plausible, types in self._scan()]
+        if not found:
+            return self.types
+        candidates = np.unique(np.concatenate(found))
+        # Anything after a small number in memory looks like an object, so
+        # types are told from other words by their fields first, then their
+        # names.
+        basicsize = self._gather(candidates + TP_BASICSIZE)
+        itemsize = self._gather(candidates + TP_ITEMSIZE)
+        flags = self._gather(candidates + TP_FLAGS)
+        names = self._gather(candidates + TP_NAME)
+        valid = (
+            (basicsize - 1 < MAX_BASICSIZE)
+            & (itemsize <= MAX_ITEMSIZE)
+            & (flags & PY_TPFLAGS_READY != 0)
+            & (flags >> 32 == 0)
+            & (names >= MIN_ADDRESS)
+        )
+        candidates = candidates[valid]
+        metatypes = self._gather(candidates + OB_TYPE)
+        self.types[self.type_type] = self._describe(self.type_type)
+        rejected = set()
+        while True:
+            # Metaclasses are types too, so a few rounds find every type.
+            known = np.array(sorted(self.types), dtype="<u8")
+            added = False
+            for address in candidates[np.isin(metatypes, known)].tolist():
+                if address in self.types or address in rejected:
+                    continue
+                described = self._describe(address)
+                if described is None:
+                    rejected.add(address)
+                else:
+                    self.types[address] = described
+                    added = True
+            if not added:
+                return self.types
+
+    def _describe(self, address):
+        """
+        The name, sizes and flags of the type at `address`, None if its name
+        isn't one.
+        """
+        flags = self._read(address + TP_FLAGS, 8, "<Q") or 0
+        name_address = self._read(address + TP_NAME, 8, "<Q")
+        try:
+            name = self.core.read_string(name_address, MAX_NAME)
+        except CoreError:
+            return None
+        if (
+            not name
+            or len(name) >= MAX_NAME
+            or not name.isprintable()
+            or "\ufffd" in name
+        ):
+            return None
+        if not name.isascii() and not flags & PY_TPFLAGS_HEAPTYPE:
+            return None
+        if "." not in name and not flags & PY_TPFLAGS_HEAPTYPE:
+            name = f"builtins.{name}"
+        return {
+            "name": name,
+            "basicsize": self._read(address + TP_BASICSIZE, 8, "<q") or 0,
+            "itemsize": self._read(address + TP_ITEMSIZE, 8, "<q") or 0,
+            "gc": bool(flags & PY_TPFLAGS_HAVE_GC),
+            "preheader": bool(flags & PY_TPFLAGS_PREHEADER),
+        }
+
+    @staticmethod
+    def _field(words, index, offset):
+        """
+        The word `offset` bytes into each object at `index` (in 16 bytes) of
+        `words`, 0 past either end.
+        """
+        positions = 2 * index + offset // 8
+        values = np.zeros(len(index), dtype=np.int64)
+        inside = (positions >= 0) & (positions < len(words))
+        values[inside] = words[positions[inside]].view(np.int64)
+        return values
+
+    def _in_block(self, addresses, headers, sizes):
+        """
+        Whether each object at `addresses`, allocated `headers` bytes before
+        and `sizes` bytes long, could be where pymalloc put it: at the start
+        of a block that holds it, if in one of its pools at all.
+        """
+        allocated = addresses - headers
+        kept = np.ones(len(addresses), dtype=bool)
+        undecided = np.ones(len(addresses), dtype=bool)
+        for pool_size in POOL_SIZES:
+            pools = allocated & ~(pool_size - 1)
+            size_class = self._gather((pools + POOL_SZIDX).astype("<u8")) >> 32
+            offsets = self._gather((pools + POOL_OFFSETS).astype("<u8"))
+            block = (size_class.astype(np.int64) + 1) * POOL_ALIGNMENT
+            next_offset = (offsets & 0xFFFFFFFF).astype(np.int64)
+            in_pool = (
+                undecided
+                & (size_class < SIZE_CLASSES)
+                & ((offsets >> 32).astype(np.int64) == pool_size - block)
+                & (next_offset <= pool_size)
+                & (next_offset % POOL_ALIGNMENT == 0)
+            )
+            offset = allocated - pools - POOL_OVERHEAD
+            at_block = (offset >= 0) & (offset % block == 0) & (sizes <= block)
+            kept &= ~in_pool | at_block
+            undecided &= ~in_pool
+        return kept
+
+    def rows(self):
+        """
+        [name, count, size] for every type of object in the core.
+        """
+        if not self.types:
+            self.find_types()
+        type_addresses = np.array(sorted(self.types), dtype="<u8")
+        info = [self.types[t] for t in type_addresses.tolist()]
+        basicsize = np.array([t["basicsize"] for t in info], dtype=np.int64)
+        itemsize = np.array([t["itemsize"] for t in info], dtype=np.int64)
+        has_gc = np.array([t["gc"] for t in info], dtype=bool)
+        headers = GC_HEAD_SIZE * has_gc + PREHEADER_SIZE * np.array(
+            [t["preheader"] for t in info], dtype=bool
+        )
+        special = {"builtins.str": 1, "builtins.int": 2, "builtins.list": 3}
+        special["builtins.bytearray"] = 4
+        kind = np.array([special.get(t["name"], 0) for t in info], dtype=np.int8)
+        new_ints = self.version is not None and self.version >= 0x030C0000
+        ascii_header, compact_header = str_headers(self.version)
+        counts = np.zeros(len(info), dtype=np.int64)
+        sizes = np.zeros(len(info), dtype=np.int64)
+        for start, words in self.segments:
+            plausible, objtypes = self._candidates(words)
+            (index,) = np.nonzero(plausible)
+            pos = np.searchsorted(type_addresses, objtypes[index])
+            pos[pos == len(type_addresses)] = 0
+            found = type_addresses[pos] == objtypes[index]
+            index, pos = index[found], pos[found]
+
+            # Live GC objects are either untracked, with no links, or linked
+            # from the previous object in their generation. Freed ones, and
+            # words that only look like objects, are neither.
+            gc_prev = self._field(words, index, -8)
+            gc_next = self._field(words, index, -16)
+            head = (start + 16 * index - GC_HEAD_SIZE).astype(np.int64)
+            linked = self._gather(gc_prev.astype("<u8") & ~np.uint64(7))
+            linked = linked.astype(np.int64) & ~7 == head
+            untracked = (gc_next == 0) & (gc_prev & ~7 == 0)
+            alive = ~has_gc[pos] | linked | untracked
+            index, pos = index[alive], pos[alive]
+
+            kinds = kind[pos]
+            # Only variable-size objects have a length.
+            ob_size = np.where(
+                (itemsize[pos] > 0) | (kinds > 0),
+                np.abs(self._field(words, index, OB_SIZE)),
+                0,
+            )
+            inline = basicsize[pos] + itemsize[pos] * ob_size
+            if new_ints:
+                # 3.12 replaced ob_size with a tag holding the digit count,
+                # and zero, with none, still takes one.
+                digits = np.maximum(ob_size >> 3, 1)
+                inline = np.where(kinds == 2, basicsize[pos] + 4 * digits, inline)
+            # Compact strings: a header for ASCII or not, then the characters
+            # at 1, 2 or 4 bytes each.
+            state = self._field(words, index, 32)
+            char_size = (state >> 2) & 7
+            ascii = (state >> 6) & 1
+            str_size = np.where(ascii == 1, ascii_header, compact_header)
+            str_size += (ob_size + 1) * char_size
+            inline = np.where(kinds == 1, str_size, inline)
+            # Lists and bytearrays hold their items in a separate allocation,
+            # at least as large as they are long.
+            allocated = np.where(
+                kinds == 3,
+                self._field(words, index, 32),
+                np.where(kinds == 4, self._field(words, index, 24), ob_size),
+            )
+            external = np.where(kinds == 3, 8 * allocated, 0)
+            external = np.where(kinds == 4, allocated, external)
+            size = headers[pos] + inline + external
+            # What is in the object itself has to fit in memory.
+            valid = (16 * index + inline <= 8 * len(words)) & (allocated >= ob_size)
+            valid &= (kinds != 1) | np.isin(char_size, (1, 2, 4))
+            valid &= ob_size < MAX_LENGTH
+            addresses = start + 16 * index.astype(np.int64)
+            valid &= self._in_block(addresses, headers[pos], headers[pos] + inline)
+            pos, size = pos[valid], size[valid]
+
+            counts += np.bincount(pos, minlength=len(info))
+            sizes += np.bincount(pos, weights=size, minlength=len(info)).astype(
+                np.int64
+            )
+        by_name = {}
+        for t, count, size in zip(info, counts.tolist(), sizes.tolist()):
+            if count:
+                row = by_name.setdefault(t["name"], [t["name"], 0, 0])
+                row[1] += count
+                row[2] += size
+        return list(by_name.values())
+
+
+def analyze_core(filename, executable=None):
+    """
+    The per-type summary of the core dump `filename`, as the page a live
+    analysis of its process would have given.
+    """
+    core = CoreImage(filename)
+    heap = None
+    try:
+        heap = CoreHeap(core, executable)
+        heap.find_types()
+        rows = heap.rows()
+        return analysis_utils.RetrievedObjects(
+            pid=core.pid,
+            title=f"Analysis for {core.pid}",
+            data=rows,
+            metadata={
+                "core": os.path.abspath(filename),
+                "executable": heap.executable,
+                "python_version": heap.python_version(),
+                "types": len(heap.types),
+            },
+        )
+    finally:
+        if heap is not None:
+            # The scanned words are views of the core, which can't be closed
+            # under them.
+            heap.segments = []
+        core.close()
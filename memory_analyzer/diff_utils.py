@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Differences between snapshots. Every page is indexed by type name once, so
+diffs take time linear in the number of rows however many types there are.
+"""
+
+from . import analysis_utils
+from .frontend import frontend_utils
+
+
+# Kinds of pages that are compared between snapshots, with the title of
+# their differences.
+DIFF_TITLES = {
+    "Analysis": "Snapshot Differences for {pid}",
+    "Allocation Sites": "Snapshot Differences in Allocation Sites for {pid}",
+    "Native Memory": "Snapshot Differences in Native Memory for {pid}",
+}
+
+
+def is_diff_page(page):
+    return "Snapshot Differences" in page.title
+
+
+def page_kind(page):
+    """
+    What a page holds, from its title: "Analysis", "Allocation Sites", ...
+    """
+    return page.title.split(" for ")[0].replace(" (partial)", "")
+
+
+def index_rows(rows):
+    """
+    Map every type name in `rows` to its [count, size].
+    """
+    index = {}
+    for row in rows or []:
+        totals = index.setdefault(row[0], [0, 0])
+        totals[0] += row[1]
+        totals[1] += row[2]
+    return index
+
+
+def diff_rows(cur, prev):
+    """
+    The change in count and size of every type in either `cur` or `prev`, as
+    cur - prev.
+    """
+    prev_index = index_rows(prev)
+    rows = []
+    for name, (count, size) in index_rows(cur).items():
+        prev_count, prev_size = prev_index.pop(name, (0, 0))
+        rows.append([name, count - prev_count, size - prev_size])
+    rows.extend([name, -count, -size] for name, (count, size) in prev_index.items())
+    return rows
+
+
+def trend_rows(snapshots):
+    """
+    An N-way diff of `snapshots`, lists of rows from the oldest to the newest.
+    Each row holds the change in count and size between the first and last
+    snapshot, followed by the type's size in each of them.
+    """
+    indexes = [index_rows(rows) for rows in snapshots]
+    names = dict.fromkeys(name for index in indexes for name in index)
+    rows = []
+    for name in names:
+        totals = [index.get(name, (0, 0)) for index in indexes]
+        row = [name, totals[-1][0] - totals[0][0], totals[-1][1] - totals[0][1]]
+        row.extend(frontend_utils.readable_size(size) for _, size in totals)
+        rows.append(row)
+    return rows
+
+
+def pages_by_pid(pages, kind="Analysis"):
+    """
+    The first page of `kind` of each PID in `pages`, keyed by the PID as a
+    string since older snapshots may hold it as either.
+    """
+    by_pid = {}
+    for page in pages:
+        if not is_diff_page(page) and page_kind(page) == kind:
+            by_pid.setdefault(str(page.pid), page)
+    return by_pid
+
+
+def diff_pages(cur_pages, prev_pages):
+    """
+    A page of differences for every PID of `cur_pages` also in `prev_pages`,
+    for the analysis, the native memory, and the allocation sites if both
+    snapshots traced them. If no PIDs pair up the first page of each is
+    compared instead.
+    """
+    differences = []
+    for kind, title in DIFF_TITLES.items():
+        prev_by_pid = pages_by_pid(prev_pages, kind)
+        for pid, cur_page in pages_by_pid(cur_pages, kind).items():
+            prev_page = prev_by_pid.get(pid)
+            if prev_page is not None:
+                differences.append(
+                    analysis_utils.RetrievedObjects(
+                        pid=cur_page.pid,
+                        title=title.format(pid=cur_page.pid),
+                        data=diff_rows(cur_page.data, prev_page.data),
+                    )
+                )
+    if not differences and cur_pages and prev_pages:
+        diff = diff_rows(cur_pages[0].data, prev_pages[0].data)
+        differences.append(
+            analysis_utils.RetrievedObjects(
+                pid=0, title="Snapshot Differences", data=diff
+            )
+        )
+    return differences
+
+
+def trend_pages(snapshots):
+    """
+    A trend page for every PID of the newest of `snapshots`, lists of pages
+    from the oldest to the newest, with its size in each snapshot. Snapshots
+    missing the PID count as empty.
+    """
+    indexed = [pages_by_pid(pages) for pages in snapshots]
+    trends = []
+    for pid, page in indexed[-1].items():
+        rows = [by_pid[pid].data if pid in by_pid else [] for by_pid in indexed]
+        trends.append(
+            analysis_utils.RetrievedObjects(
+                pid=page.pid,
+                title=f"Snapshot Differences for {page.pid} "
+                f"over {len(snapshots)} snapshots",
+                data=trend_rows(rows),
+                metadata={"columns": [f"Size #{i + 1}" for i in range(len(snapshots))]},
+            )
+        )
+    return trends
@@ -6,14 +6,19 @@
 
 import curses
 import os
-import pickle
 import subprocess
+from array import array
 
 import click
 import prettytable
 
+from .. import snapshot_file
 from . import memanz_curses
 
+# Timed phases that other phases run inside of: the wait for the first
+# results covers gdb's, and gdb's payload the target's.
+ENCLOSING_PHASES = {"total", "wait", "payload"}
+
 
 def readable_size(i, snapshot=False):
     """
@@ -29,78 +34,217 @@ def readable_size(i, snapshot=False):
     return f"{i:.2f}{scales[degree]:>5}"
 
 
-def init_table(references, snapshot):
+def init_table(references, snapshot, sampled=False, columns=()):
     pt = prettytable.PrettyTable()
     field_names = ["Object", "Count", "Size"]
     if references:
         field_names.extend(["References", "Backwards References"])
+    field_names.extend(columns)
     if snapshot:
         field_names[1] += " Diff"
         field_names[2] += " Diff"
+    if sampled:
+        field_names[2:2] = ["Count +/-"]
+        field_names[4:4] = ["Size +/-"]
     pt.field_names = field_names
     pt.align["Object"] = "l"
-    pt.align[pt.field_names[1]] = "r"
-    pt.align[pt.field_names[2]] = "r"
+    for field_name in field_names[1 : 5 if sampled else 3]:
+        pt.align[field_name] = "r"
+    for field_name in columns:
+        pt.align[field_name] = "r"
     return pt
 
 
+def format_row(item, snapshot, errors=None):
+    """
+    The cells of one summary row, with sizes made readable and the confidence
+    half-widths of a sampled page added.
+    """
+    count = f"{item[1]:+}" if snapshot else item[1]
+    size = readable_size(item[2], snapshot)
+    if errors is None:
+        return [item[0], count, size] + list(item[3:])
+    count_err, size_err = errors.get(item[0], (0, 0))
+    return [
+        item[0],
+        count,
+        f"+/-{count_err}",
+        size,
+        f"+/-{readable_size(size_err)}",
+    ] + list(item[3:])
+
+
 def format_summary_output(page):
     """
     Formats in prettytable style the pympler summary.
+
+    Pages produced by a sampled run carry the 95% confidence half-width of
+    every row in their metadata, which is shown next to the estimates.
     """
     references = False
     items = page.data
     if not items:
         items = [[f"No data to display for pid {page.pid}.", 0, 0]]
-    if any(len(item) == 5 for item in items):
+    metadata = getattr(page, "metadata", {})
+    columns = metadata.get("columns", [])
+    if not columns and any(len(item) == 5 for item in items):
         references = True
     snapshot = "Snapshot Differences" in page.title
-    pt = init_table(references, snapshot)
-    items.sort(key=lambda x: x[2], reverse=True)
-    for sublist in items:
-        if snapshot:
-            sublist[1] = f"{sublist[1]:+}"
-        sublist[2] = readable_size(sublist[2], snapshot)
-        if len(sublist) != len(pt.field_names):
+    errors = metadata.get("sampling", {}).get("errors")
+    pt = init_table(references, snapshot, errors is not None, columns)
+    column = metadata.get("sort_column", 2)
+    for item in sorted(items, key=lambda x: x[column], reverse=True):
+        row = format_row(item, snapshot, errors)
+        if len(row) != len(pt.field_names):
             # Fill in missing data with "".
-            sublist.extend(["" for _ in range(len(pt.field_names) - len(sublist))])
-        pt.add_row(sublist)
+            row.extend(["" for _ in range(len(pt.field_names) - len(row))])
+        pt.add_row(row)
     return pt
 
 
+def format_growth_output(growth):
+    """
+    Formats in prettytable style the growth of every type, as returned by
+    TimeSeriesStore.growth.
+    """
+    pt = prettytable.PrettyTable()
+    pt.field_names = ["Object", "Size /h", "Count /h", "Size", "Count"]
+    pt.align["Object"] = "l"
+    for field_name in pt.field_names[1:]:
+        pt.align[field_name] = "r"
+    for item in growth:
+        pt.add_row(
+            [
+                item.name,
+                readable_size(item.size_slope, True),
+                f"{item.count_slope:+.1f}",
+                readable_size(item.size),
+                item.count,
+            ]
+        )
+    return pt
+
+
+def page_table(page):
+    """
+    A memanz_curses.Table showing `page`, either RetrievedObjects or a
+    snapshot_file.SnapshotPage, with rows sorted by size. The rows are left
+    untouched and only formatted as they scroll into view.
+    """
+    if isinstance(page, snapshot_file.SnapshotPage) and not len(page):
+        page = page.load()
+    snapshot = "Snapshot Differences" in page.title
+    metadata = getattr(page, "metadata", {})
+    columns = metadata.get("columns", [])
+    errors = metadata.get("sampling", {}).get("errors")
+    if isinstance(page, snapshot_file.SnapshotPage):
+        # Snapshot pages are stored sorted, and the widest cells can be told
+        # from the page's stats without decoding any rows.
+        rows = page.rows
+        num_rows = len(page)
+        references = not columns and len(page.extra_widths) == 2
+        hints = _stats_hints(page, snapshot, errors)
+    else:
+        items = page.data or [[f"No data to display for pid {page.pid}.", 0, 0]]
+        column = metadata.get("sort_column", 2)
+        order = array(
+            "L",
+            sorted(range(len(items)), key=lambda i: items[i][column], reverse=True),
+        )
+
+        def rows(start, stop):
+            return [items[i] for i in order[start:stop]]
+
+        num_rows = len(items)
+        references = not columns and any(len(item) == 5 for item in items)
+        stride = max(num_rows // memanz_curses.Table.SAMPLE_SIZE, 1)
+        hints = [format_row(item, snapshot, errors) for item in items[::stride]]
+
+    pt = init_table(references, snapshot, errors is not None, columns)
+    field_names = pt.field_names
+
+    def fetch(start, stop):
+        cells = []
+        for item in rows(start, stop):
+            row = format_row(item, snapshot, errors)
+            row.extend([""] * (len(field_names) - len(row)))
+            cells.append(row)
+        return cells
+
+    aligns = [pt.align[name] for name in field_names]
+    return memanz_curses.Table(field_names, aligns, num_rows, fetch, hints)
+
+
+def _stats_hints(page, snapshot, errors):
+    name = "x" * page.stats.get("name_width", 0)
+    count, size = page.stats.get("max_count", 0), page.stats.get("max_size", 0)
+    # Readable sizes are widest with four digits before the point, which any
+    # size from 1000B up may have. Negative sizes are not scaled at all.
+    hints = [format_row([name, count, min(size, 1000)], snapshot, errors)]
+    if snapshot:
+        hints.append(format_row([name, -count, -size], snapshot, errors))
+    if errors is not None:
+        hints.extend(
+            ["", "", f"+/-{count_err}", "", f"+/-{readable_size(size_err)}"]
+            for count_err, size_err in errors.values()
+        )
+    if page.extra_widths:
+        hints.append(
+            [""] * (3 if errors is None else 5)
+            + ["x" * width for width in page.extra_widths]
+        )
+    return hints
+
+
 def table_as_list_of_strings(table):
     string_table = table.get_string()
     return string_table.split("\n")
 
 
+def timings_summary(timings, top=3):
+    """
+    How long an analysis took and its `top` slowest phases, from the
+    "timings" in its metadata. Phases that only enclose others are left out.
+    """
+    phases = sorted(
+        (
+            (ms, f"{source}.{phase}")
+            for source, source_timings in timings.items()
+            for phase, ms in source_timings.items()
+            if phase not in ENCLOSING_PHASES
+        ),
+        reverse=True,
+    )
+    summary = ", ".join(f"{name} {ms:.0f}ms" for ms, name in phases[:top])
+    total = timings.get("analyzer", {}).get("total")
+    if total is None:
+        return summary
+    return f"{total:.0f}ms: {summary}" if summary else f"{total:.0f}ms"
+
+
 def get_pages(filename):
     """
-    Read each pickled object in the given file as a page.
-    The objects will be lists of lists.
+    Read each page of the given snapshot file.
+    The pages' data will be lists of lists.
     """
-    with open(filename, "rb") as fd:
-        while True:
-            try:
-                yield pickle.load(fd)
-            except EOFError:
-                break
-            except pickle.UnpicklingError:
-                raise
+    return snapshot_file.read_pages(filename)
 
 
 def view(stdscr, pages):
     """
-    Format the data in a list of pretty tables that will be the pages of the
-    curses UI, then activate the nCurses UI.
+    Lay out each page as a table for the curses UI, then activate the nCurses
+    UI. Rows are only formatted once they scroll into view.
     """
     pages_as_tables = []
     titles = []
+    statuses = []
     for page in pages:
         titles.append(page.title)
-        table = format_summary_output(page)
-        pages_as_tables.append(table_as_list_of_strings(table))
+        pages_as_tables.append(page_table(page))
+        timings = getattr(page, "metadata", {}).get("timings")
+        statuses.append(timings_summary(timings) if timings else "")
     if pages_as_tables:
-        win = memanz_curses.Window(stdscr, pages_as_tables, titles)
+        win = memanz_curses.Window(stdscr, pages_as_tables, titles, statuses)
         win.run()
 
 
@@ -19,15 +19,80 @@ RIGHT_KEYS = [curses.KEY_RIGHT, ord("d"), ord("l")]
 LEFT_KEYS = [curses.KEY_LEFT, ord("a"), ord("h")]
 
 
+class Table:
+    """
+    The lines of a prettytable-style table, formatted only as they are sliced
+    out, so a page costs nothing until it scrolls into view.
+
+    `fetch(start, stop)` returns the cells of rows `start` to `stop` in display
+    order. Column widths start from the headers, the `hints` rows and the
+    first SAMPLE_SIZE rows, and widen as wider rows are fetched.
+    """
+
+    HEADER_LINES = 3
+    SAMPLE_SIZE = 100
+
+    def __init__(self, field_names, aligns, num_rows, fetch, hints=()):
+        self.field_names = field_names
+        self.aligns = aligns
+        self.num_rows = num_rows
+        self.fetch = fetch
+        self.widths = [len(name) for name in field_names]
+        self.widen(hints)
+        self.widen(fetch(0, self.SAMPLE_SIZE))
+
+    def widen(self, rows):
+        for row in rows:
+            for i, cell in enumerate(row):
+                self.widths[i] = max(self.widths[i], len(str(cell)))
+
+    def __len__(self):
+        return self.num_rows + self.HEADER_LINES + 1
+
+    def border(self):
+        return "+" + "+".join("-" * (width + 2) for width in self.widths) + "+"
+
+    def line(self, cells):
+        justified = []
+        for cell, width, align in zip(cells, self.widths, self.aligns):
+            cell = str(cell)
+            if align == "l":
+                justified.append(cell.ljust(width))
+            elif align == "r":
+                justified.append(cell.rjust(width))
+            else:
+                justified.append(cell.center(width))
+        return "| " + " | ".join(justified) + " |"
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            index = range(len(self))[index]
+            return self[index : index + 1][0]
+        start, stop, _ = index.indices(len(self))
+        first = max(start - self.HEADER_LINES, 0)
+        last = min(stop - self.HEADER_LINES, self.num_rows)
+        rows = self.fetch(first, last) if first < last else []
+        self.widen(rows)
+        header = [self.border(), self.line(self.field_names), self.border()]
+        lines = header[start : min(stop, self.HEADER_LINES)]
+        lines.extend(self.line(row) for row in rows)
+        if start < len(self) <= stop:
+            lines.append(self.border())
+        return lines
+
+
 class Window:
     UP = -1
     DOWN = 1
 
-    def __init__(self, stdscr, pages, titles):
+    def __init__(self, stdscr, pages, titles, statuses=()):
         self.top = 0
         self.position = self.top
         self.pages = pages
         self.page_titles = titles
+        # Shown in the status bar next to the title, such as where the time
+        # of the analysis went.
+        self.page_statuses = list(statuses) or [""] * len(pages)
         self.cur_page = 0
         self.window = stdscr
         self.height = curses.LINES - 1
@@ -41,16 +106,21 @@ class Window:
 
     @cur_page.setter
     def cur_page(self, pos):
-        page = namedtuple("Page", "pos items title")
+        page = namedtuple("Page", "pos items title status")
         self._cur_page = page(
-            pos=pos, items=self.pages[pos], title=self.page_titles[pos]
+            pos=pos,
+            items=self.pages[pos],
+            title=self.page_titles[pos],
+            status=self.page_statuses[pos],
         )
         return self._cur_page
 
     def status_bar_render(self):
+        status = f" | {self.cur_page.status}" if self.cur_page.status else ""
         statusbarstr = (
-            f"{self.cur_page.title} | Navigate with arrows or wasd | Press 'q' to exit"
-        )
+            f"{self.cur_page.title}{status} | Navigate with arrows or wasd | "
+            "Press 'q' to exit"
+        )[: self.width]
         self.window.attron(curses.color_pair(1))
         self.window.addstr(self.height, 0, statusbarstr)
         self.window.addstr(
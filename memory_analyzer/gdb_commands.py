@@ -6,35 +6,61 @@
 """Module containing all of the custom GDB commands to be used for memory analysis.
 This is equivalent to a GDB command file, and can only be called from a GDB process."""
 
+import json
 import os
 import sys
+import time
 
 import gdb
 
 TEMPLATES_PATH = os.getenv("MEMORY_ANALYZER_TEMPLATES_PATH")
+PAYLOAD = os.getenv("MEMORY_ANALYZER_PAYLOAD")
+# By the time this runs gdb has read the symbols and attached. The wall
+# clock, as the analyzer compares it with when it started gdb.
+TIMINGS = {"attached": time.time()}
+
+
+def timed(phase, start):
+    TIMINGS[phase] = round((time.monotonic() - start) * 1000, 3)
 
 
 def lock_GIL(func):
     def wrapper(*args):
+        start = time.monotonic()
         out = gdb.execute("call (void*) PyGILState_Ensure()", to_string=True)
+        timed("gil_ensure", start)
         gil_value = next((x for x in out.split() if x.startswith("$")), "$1")
         print("GIL", gil_value)
+        start = time.monotonic()
         func(*args)
+        timed("payload", start)
+        start = time.monotonic()
         call = "call (void) PyGILState_Release(" + gil_value + ")"
         gdb.execute(call)
+        timed("gil_release", start)
 
     return wrapper
 
 
+def payload_source(filename, pid):
+    """
+    The line that runs the payload in `filename`, in globals of its own so it
+    neither rebinds nor keeps anything alive in the target's __main__. The
+    payload reports for `pid`, see analysis_utils.write_payload.
+    """
+    return (
+        "exec(__import__('pathlib').Path('{filename}').read_text(), "
+        "{{'__name__': '__memory_analyzer__', 'memanz_pid': {pid}}})"
+    ).format(filename=filename, pid=pid)
+
+
 class FileCommand(gdb.Command):
     def __init__(self):
         super(FileCommand, self).__init__("file_command", gdb.COMMAND_NONE)
 
     @lock_GIL
     def invoke(self, filename, from_tty):
-        cmd_string = "with open('{filename}') as f: exec(f.read())".format(
-            filename=filename
-        )
+        cmd_string = payload_source(filename, gdb.selected_inferior().pid)
         gdb.execute(
             'call (void) PyRun_SimpleString("{cmd_str}")'.format(cmd_str=cmd_string)
         )
@@ -42,8 +68,15 @@ class FileCommand(gdb.Command):
 
 FileCommand()
 pid = gdb.selected_inferior().pid
-gdb.execute(
-    "file_command {TEMPLATES_PATH}/rendered_template-{pid}.py.out".format(
-        TEMPLATES_PATH=TEMPLATES_PATH, pid=pid
-    )
-)
+gdb.execute("file_command {PAYLOAD}".format(PAYLOAD=PAYLOAD))
+# Read back by GDBObject, see analysis_utils.gdb_timings_path.
+try:
+    with open(
+        "{TEMPLATES_PATH}/gdb_timings-{pid}.json".format(
+            TEMPLATES_PATH=TEMPLATES_PATH, pid=pid
+        ),
+        "w",
+    ) as f:
+        json.dump(TIMINGS, f)
+except OSError:
+    pass
@@ -0,0 +1,716 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Retained sizes from the dominator tree of the heap.
+
+Every GC-tracked object becomes a node numbered by position, with its edges
+from gc.get_referents held as compressed rows of machine integers, so the
+graph costs about 40 bytes per node and 8 per edge on top of one list of the
+objects and an id -> node dict. An untracked object referenced only once is
+folded into its one referrer, which dominates it anyway; shared ones become
+nodes. Objects referenced from outside the graph (the interpreter, C
+extensions, thread stacks) hang off a virtual root.
+
+Dominators are found with the Lengauer-Tarjan algorithm, with path
+compression, in near-linear time and without recursion.
+
+The graph can instead be dumped to a file, its arrays written as they are,
+and analyzed outside the target from a memory map:
+
+    header   MAGIC, version (u16), byte order (u8), node count, edge count,
+             length of the JSON that follows (u64 each)
+    JSON     type names, labels of modules, classes and functions, the
+             totals of folded objects by type, and extra information
+    arrays   each padded to 8 bytes, in native byte order:
+               ids, sizes, folded sizes (i64 per node), folded counts, type
+               ids (i32 per node), edge starts (i64 per node + 2), edge
+               targets (i32 per edge)
+
+For --show-references, instances of a type are sampled and a breadth-first
+search over the reversed graph, built once, finds the shortest chain of
+referrers from a root (an object held from outside the graph, or a module)
+to one of them.
+
+This module only uses the standard library: its source is inlined into the
+analysis template and runs inside the target.
+"""
+
+import gc
+import heapq
+import json
+import mmap
+import random
+import struct
+import sys
+from array import array
+from types import FrameType, FunctionType, ModuleType
+
+# Objects processed between two checks of the pause budget.
+CHECK_EVERY = 1024
+
+# How deeply nested untracked objects (tuples of tuples...) are folded.
+MAX_FOLD_DEPTH = 32
+
+# Instances of each type whose paths to a root are searched, and how far.
+REFERENCE_SAMPLES = 3
+MAX_CHAIN_DEPTH = 32
+MAX_CHAIN_NODES = 100_000
+
+# How many referenced types are listed for an instance.
+MAX_LISTED_TYPES = 5
+
+MAGIC = b"MEMANZHG"
+VERSION = 1
+HEADER = struct.Struct("<8sHB5xQQQ")
+BYTE_ORDERS = ("little", "big")
+
+
+class HeapGraphError(Exception):
+    pass
+
+
+def type_name(objtype):
+    name = objtype.__name__
+    module = getattr(objtype, "__module__", None)
+    if module:
+        return f"{module}.{name}"
+    return name
+
+
+def describe(obj):
+    name = type_name(type(obj))
+    if isinstance(obj, ModuleType):
+        return f"{name} {obj.__name__}"
+    if isinstance(obj, (type, FunctionType)):
+        return f"{name} {obj.__qualname__}"
+    return f"{name} at {id(obj):#x}"
+
+
+def refcount_base():
+    """
+    The refcount of an object held by exactly one container, less that one
+    reference, as seen from inside a `for ref in gc.get_referents(obj)` loop
+    like those of HeapGraph._visit and the sampled walk of the analysis
+    template.
+    """
+    holder = [float(gc.get_count()[0]) + 0.5]
+    for ref in gc.get_referents(holder):
+        return sys.getrefcount(ref) - 1
+
+
+class Graph:
+    """
+    The queries shared by a live HeapGraph and a GraphDump read back.
+
+    Node `root` is the virtual root and the edges of node v are
+    targets[starts[v]:starts[v + 1]]. sizes holds the size of each object,
+    folded_sizes and folded_counts that of the objects folded into it.
+    """
+
+    def label(self, node):
+        raise NotImplementedError
+
+    def type_rows(self):
+        """
+        [name, count, size] rows of every type in the graph, folded objects
+        included.
+        """
+        totals = {}
+        for type_id, size in zip(self.type_ids, self.sizes):
+            entry = totals.get(type_id)
+            if entry is None:
+                totals[type_id] = [1, size]
+            else:
+                entry[0] += 1
+                entry[1] += size
+        by_name = {}
+        for type_id, (count, size) in totals.items():
+            name = self.type_names[type_id]
+            row = by_name.setdefault(name, [name, 0, 0])
+            row[1] += count
+            row[2] += size
+        for type_id, (count, size) in self.folded.items():
+            name = self.type_names[type_id]
+            row = by_name.setdefault(name, [name, 0, 0])
+            row[1] += count
+            row[2] += size
+        return list(by_name.values())
+
+    def top_retainers(self, top, budget=None):
+        """
+        Rows for the `top` objects with the largest retained size: a
+        description, the number of objects and bytes they retain, and their
+        own size.
+        """
+        vertex, idom = dominators(
+            self.starts, self.targets, self.root, budget, self.referrers()
+        )
+        retained, retained_counts = retained_sizes(
+            vertex, idom, self.sizes, self.folded_sizes, self.folded_counts
+        )
+        # Preorder number 0 is the virtual root.
+        largest = heapq.nlargest(top, range(1, len(vertex)), key=retained.__getitem__)
+        return [
+            [
+                self.label(vertex[w]),
+                retained_counts[w],
+                retained[w],
+                self.sizes[vertex[w]] + self.folded_sizes[vertex[w]],
+            ]
+            for w in largest
+        ]
+
+    def referrers(self):
+        """
+        The reversed graph, see predecessors, built once and shared by every
+        query.
+        """
+        if getattr(self, "_referrers", None) is None:
+            self._referrers = predecessors(
+                self.starts, self.targets, getattr(self, "indegree", None)
+            )
+        return self._referrers
+
+    def sample_instances(self, names, samples=REFERENCE_SAMPLES):
+        """
+        A uniform sample of up to `samples` nodes of each of the types called
+        `names`, all taken in one pass over the nodes.
+        """
+        wanted = {}
+        for type_id, type_name in enumerate(self.type_names):
+            if type_name in names:
+                wanted[type_id] = type_name
+        rng = random.Random()
+        sampled = {name: [] for name in names}
+        seen = dict.fromkeys(names, 0)
+        for node, type_id in enumerate(self.type_ids):
+            name = wanted.get(type_id)
+            if name is None:
+                continue
+            seen[name] += 1
+            sample = sampled[name]
+            if len(sample) < samples:
+                sample.append(node)
+            else:
+                slot = rng.randrange(seen[name])
+                if slot < samples:
+                    sample[slot] = node
+        return sampled
+
+    def _stops(self):
+        # Where searches for a path to a root stop: a byte per node set for
+        # the roots, and the type ids of modules.
+        if getattr(self, "_is_root", None) is None:
+            self._is_root = bytearray(self.root)
+            for edge in range(self.starts[self.root], self.starts[self.root + 1]):
+                self._is_root[self.targets[edge]] = 1
+            self._modules = {
+                type_id
+                for type_id, type_name in enumerate(self.type_names)
+                if type_name == "builtins.module"
+            }
+        return self._is_root, self._modules
+
+    def referenced_types(self, node):
+        """
+        The types `node` references, the most common first.
+        """
+        counts = {}
+        for edge in range(self.starts[node], self.starts[node + 1]):
+            type_id = self.type_ids[self.targets[edge]]
+            counts[type_id] = counts.get(type_id, 0) + 1
+        listed = sorted(counts.items(), key=lambda item: -item[1])
+        names = [
+            f"{self.type_names[type_id]} x{count}"
+            if count > 1
+            else self.type_names[type_id]
+            for type_id, count in listed[:MAX_LISTED_TYPES]
+        ]
+        if len(listed) > MAX_LISTED_TYPES:
+            names.append("...")
+        return ", ".join(names)
+
+    def path_to_root(self, nodes, max_depth=MAX_CHAIN_DEPTH, max_nodes=MAX_CHAIN_NODES):
+        """
+        The shortest chain of nodes from a root to any of `nodes`, searching
+        at most `max_depth` referrers back and `max_nodes` nodes in all. None
+        if there is no such chain.
+        """
+        pred_starts, pred = self.referrers()
+        is_root, modules = self._stops()
+        # referrer -> the node it references, one step closer to `nodes`.
+        towards = {node: None for node in nodes}
+        frontier = list(nodes)
+        for _ in range(max_depth + 1):
+            next_frontier = []
+            for node in frontier:
+                if is_root[node] or self.type_ids[node] in modules:
+                    chain = [node]
+                    while towards[chain[-1]] is not None:
+                        chain.append(towards[chain[-1]])
+                    return chain
+                for edge in range(pred_starts[node], pred_starts[node + 1]):
+                    referrer = pred[edge]
+                    if referrer == self.root or referrer in towards:
+                        continue
+                    towards[referrer] = node
+                    next_frontier.append(referrer)
+                if len(towards) > max_nodes:
+                    return None
+            frontier = next_frontier
+        return None
+
+    def references(self, nodes):
+        """
+        What one of the instances `nodes` references, and the shortest chain
+        of references to one of them from a root, as text.
+        """
+        if not nodes:
+            return ["", "No instance in the heap graph"]
+        chain = self.path_to_root(nodes)
+        if chain is None:
+            path = f"No root within {MAX_CHAIN_DEPTH} referrers"
+        else:
+            path = " -> ".join(self.label(node) for node in chain)
+        return [self.referenced_types(chain[-1] if chain else nodes[0]), path]
+
+    def retained_page(self, top, budget=None):
+        """
+        The `top` retainers as a page to send back, see
+        analysis_utils.extra_page.
+        """
+        page = {
+            "title": "Retained Sizes",
+            "rows": self.top_retainers(top, budget),
+            "metadata": {"columns": ["Own Size"], "graph": self.metadata()},
+            "size_columns": [3],
+        }
+        if self.metadata()["truncated"] or (budget and budget.expired):
+            page["title"] += " (partial)"
+        return page
+
+
+class HeapGraph(Graph):
+    """
+    The reference graph of the GC-tracked objects, up to `max_nodes` of them
+    (0 for no limit). Past the limit, or once the pause budget's deadline
+    passes, the graph is cut short and marked truncated.
+    """
+
+    def __init__(self, max_nodes=0):
+        self.max_nodes = max_nodes
+        self.objects = []
+        self.index = {}
+        self.sizes = array("q")
+        self.folded_sizes = array("q")
+        self.folded_counts = array("i")
+        self.type_ids = array("i")
+        self.type_names = []
+        self.type_index = {}
+        # type id -> [count, size] of the folded objects.
+        self.folded = {}
+        self.starts = array("q", [0])
+        self.targets = array("i")
+        self.indegree = array("i")
+        self.root = None
+        self.num_roots = 0
+        self.truncated = False
+        self.refcount_base = refcount_base()
+        self.ignore = {id(self), id(self.objects), id(self.index), id(self.type_index)}
+
+    def walk(self, budget=None, ignore=()):
+        """
+        Build the graph of the current heap, skipping `ignore`d objects.
+        """
+        self.ignore.update(id(obj) for obj in ignore)
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            objects = gc.get_objects()
+            self.ignore.add(id(objects))
+            for i, obj in enumerate(objects):
+                if i % CHECK_EVERY == 0 and budget and not budget.checkpoint():
+                    self.truncated = True
+                    break
+                if type(obj) is FrameType or id(obj) in self.ignore:
+                    continue
+                if self._add(obj) is None:
+                    break
+            del objects
+            obj = None
+            self._link(budget)
+            self._add_root()
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _type_id(self, objtype):
+        type_id = self.type_index.get(id(objtype))
+        if type_id is None:
+            # Keyed by id so the graph holds no extra references to types.
+            type_id = self.type_index[id(objtype)] = len(self.type_names)
+            self.type_names.append(type_name(objtype))
+        return type_id
+
+    def _add(self, obj):
+        if self.max_nodes and len(self.objects) >= self.max_nodes:
+            self.truncated = True
+            return None
+        node = len(self.objects)
+        self.objects.append(obj)
+        self.index[id(obj)] = node
+        self.sizes.append(sys.getsizeof(obj))
+        self.folded_sizes.append(0)
+        self.folded_counts.append(0)
+        self.indegree.append(0)
+        self.type_ids.append(self._type_id(type(obj)))
+        return node
+
+    def _link(self, budget):
+        node = 0
+        while node < len(self.objects):
+            if node % CHECK_EVERY == 0 and budget and not budget.checkpoint():
+                self.truncated = True
+                break
+            self._visit(node, self.objects[node], 0)
+            self.starts.append(len(self.targets))
+            node += 1
+        # Nodes never visited have no edges.
+        while len(self.starts) <= len(self.objects):
+            self.starts.append(len(self.targets))
+
+    def _visit(self, node, obj, depth):
+        index = self.index
+        is_tracked = gc.is_tracked
+        for ref in gc.get_referents(obj):
+            target = index.get(id(ref))
+            if target is None:
+                if is_tracked(ref):
+                    # Created after the heap was listed, or ignored.
+                    continue
+                if (
+                    sys.getrefcount(ref) - self.refcount_base <= 1
+                    and depth < MAX_FOLD_DEPTH
+                ):
+                    self._fold(node, ref)
+                    self._visit(node, ref, depth + 1)
+                    continue
+                target = self._add(ref)
+                if target is None:
+                    continue
+            self.targets.append(target)
+            self.indegree[target] += 1
+
+    def _fold(self, node, obj):
+        size = sys.getsizeof(obj)
+        self.folded_sizes[node] += size
+        self.folded_counts[node] += 1
+        entry = self.folded.setdefault(self._type_id(type(obj)), [0, 0])
+        entry[0] += 1
+        entry[1] += size
+
+    def _add_root(self):
+        # An object with more references than edges into it is also held
+        # from outside the graph.
+        objects = self.objects
+        objects.append(object())
+        held = sys.getrefcount(objects[-1])
+        objects.pop()
+        self.root = len(objects)
+        for node in range(self.root):
+            if sys.getrefcount(objects[node]) - held > self.indegree[node]:
+                self.targets.append(node)
+                self.indegree[node] += 1
+                self.num_roots += 1
+        self.starts.append(len(self.targets))
+        self.sizes.append(0)
+        self.folded_sizes.append(0)
+        self.folded_counts.append(0)
+        self.indegree.append(0)
+
+    def label(self, node):
+        return describe(self.objects[node])
+
+    def metadata(self):
+        return {
+            "nodes": len(self.objects),
+            "edges": len(self.targets) - self.num_roots,
+            "roots": self.num_roots,
+            "truncated": self.truncated,
+        }
+
+    def dump(self, filename, info=None):
+        """
+        Write the graph to `filename`, with the `info` dict stored alongside.
+        """
+        labels = [
+            [node, describe(obj)]
+            for node, obj in enumerate(self.objects)
+            if isinstance(obj, (ModuleType, type, FunctionType))
+        ]
+        meta = json.dumps(
+            {
+                "type_names": self.type_names,
+                "labels": labels,
+                "folded": [[k, *totals] for k, totals in self.folded.items()],
+                "graph": self.metadata(),
+                "info": info or {},
+            }
+        ).encode()
+        arrays = [
+            array("q", map(id, self.objects)),
+            self.sizes,
+            self.folded_sizes,
+            self.folded_counts,
+            self.type_ids,
+            self.starts,
+            self.targets,
+        ]
+        with open(filename, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    BYTE_ORDERS.index(sys.byteorder),
+                    self.root,
+                    len(self.targets),
+                    len(meta),
+                )
+            )
+            f.write(meta)
+            _pad(f)
+            for values in arrays:
+                f.write(values)
+                _pad(f)
+
+
+def _pad(f):
+    f.write(bytes(-f.tell() % 8))
+
+
+class GraphDump(Graph):
+    """
+    A graph written by HeapGraph.dump, read from a memory map without copying
+    its arrays.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            try:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise HeapGraphError(f"{filename} is empty")
+        if len(self.mmap) < HEADER.size:
+            raise HeapGraphError(f"{filename} is not a heap graph")
+        (
+            magic,
+            version,
+            byte_order,
+            num_objects,
+            num_edges,
+            meta_length,
+        ) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise HeapGraphError(f"{filename} is not a heap graph")
+        if version > VERSION:
+            raise HeapGraphError(f"{filename} is from a newer version")
+        if BYTE_ORDERS[byte_order] != sys.byteorder:
+            raise HeapGraphError(f"{filename} was written on another architecture")
+        offset = HEADER.size
+        meta = json.loads(bytes(self.mmap[offset : offset + meta_length]))
+        offset += meta_length
+        self.type_names = meta["type_names"]
+        self.labels = {node: label for node, label in meta["labels"]}
+        self.folded = {type_id: totals for type_id, *totals in meta["folded"]}
+        self.graph = meta["graph"]
+        self.info = meta["info"]
+        self.root = num_objects
+        view = memoryview(self.mmap)
+        arrays = []
+        for typecode, length in [
+            ("q", num_objects),
+            ("q", num_objects + 1),
+            ("q", num_objects + 1),
+            ("i", num_objects + 1),
+            ("i", num_objects),
+            ("q", num_objects + 2),
+            ("i", num_edges),
+        ]:
+            offset += -offset % 8
+            end = offset + length * array(typecode).itemsize
+            if end > len(self.mmap):
+                raise HeapGraphError(f"{filename} is truncated")
+            arrays.append(view[offset:end].cast(typecode))
+            offset = end
+        (
+            self.ids,
+            self.sizes,
+            self.folded_sizes,
+            self.folded_counts,
+            self.type_ids,
+            self.starts,
+            self.targets,
+        ) = arrays
+
+    def label(self, node):
+        label = self.labels.get(node)
+        if label is None:
+            label = f"{self.type_names[self.type_ids[node]]} at {self.ids[node]:#x}"
+        return label
+
+    def metadata(self):
+        return self.graph
+
+
+def add_references(graph, rows, num_refs, specific_refs):
+    """
+    Add the references of the `num_refs` largest types in `rows`, and of the
+    first type matching each of `specific_refs`, to their rows. Instances of
+    all of them are sampled at once, and every search shares one index of
+    referrers.
+    """
+    chosen = []
+    if num_refs > 0:
+        rows.sort(key=lambda row: row[2], reverse=True)
+        chosen.extend(rows[:num_refs])
+    for name in specific_refs:
+        for row in rows:
+            if name in row[0]:
+                if not any(row is other for other in chosen):
+                    chosen.append(row)
+                break
+    if not chosen:
+        return
+    sampled = graph.sample_instances({row[0] for row in chosen})
+    for row in chosen:
+        row.extend(graph.references(sampled[row[0]]))
+
+
+def predecessors(starts, targets, indegree=None):
+    """
+    The reverse of a graph in compressed rows: pred[pred_starts[v]:
+    pred_starts[v + 1]] are the nodes with an edge to v. Given the `indegree`
+    of every node, the edges are only read once.
+    """
+    num_nodes = len(starts) - 1
+    pred_starts = array("q", [0]) * (num_nodes + 1)
+    if indegree is None:
+        for target in targets:
+            pred_starts[target + 1] += 1
+    else:
+        pred_starts[1:] = array("q", indegree)
+    for node in range(num_nodes):
+        pred_starts[node + 1] += pred_starts[node]
+    fill = pred_starts[:num_nodes]
+    pred = array("i", [0]) * len(targets)
+    for node in range(num_nodes):
+        for edge in range(starts[node], starts[node + 1]):
+            target = targets[edge]
+            pred[fill[target]] = node
+            fill[target] += 1
+    return pred_starts, pred
+
+
+def dominators(starts, targets, root, budget=None, referrers=None):
+    """
+    The dominator tree of the nodes reachable from `root`, by Lengauer-Tarjan.
+
+    Returns (vertex, idom): vertex[w] is the node with depth-first preorder
+    number w, and idom[w] the preorder number of its immediate dominator.
+    Number 0 is `root`, its own dominator. Once `budget`'s deadline passes,
+    the nodes not yet processed are left dominated by the root. `referrers`
+    is the reversed graph, if already built.
+    """
+    num_nodes = len(starts) - 1
+    dfnum = array("i", [-1]) * num_nodes
+    vertex = array("i", [root])
+    parent = array("i", [0])
+    cursor = array("q", starts)
+    dfnum[root] = 0
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        edge = cursor[node]
+        if edge == starts[node + 1]:
+            stack.pop()
+            continue
+        cursor[node] = edge + 1
+        target = targets[edge]
+        if dfnum[target] < 0:
+            dfnum[target] = len(vertex)
+            vertex.append(target)
+            parent.append(dfnum[node])
+            stack.append(target)
+    del cursor, stack
+
+    pred_starts, pred = referrers or predecessors(starts, targets)
+    num_reached = len(vertex)
+    semi = array("i", range(num_reached))
+    label = array("i", range(num_reached))
+    ancestor = array("i", [-1]) * num_reached
+    idom = array("i", [0]) * num_reached
+    bucket = array("i", [-1]) * num_reached
+    next_in_bucket = array("i", [-1]) * num_reached
+
+    def evaluate(v):
+        # The vertex of least semidominator on the path up to the root of
+        # v's tree in the forest, compressing the path on the way.
+        if ancestor[v] < 0:
+            return v
+        path = []
+        u = v
+        while ancestor[ancestor[u]] >= 0:
+            path.append(u)
+            u = ancestor[u]
+        for u in reversed(path):
+            a = ancestor[u]
+            if semi[label[a]] < semi[label[u]]:
+                label[u] = label[a]
+            ancestor[u] = ancestor[a]
+        return label[v]
+
+    for w in range(num_reached - 1, 0, -1):
+        if w % CHECK_EVERY == 0 and budget and not budget.checkpoint():
+            break
+        node = vertex[w]
+        s = semi[w]
+        for edge in range(pred_starts[node], pred_starts[node + 1]):
+            v = dfnum[pred[edge]]
+            if v < 0:
+                continue
+            u = evaluate(v)
+            if semi[u] < s:
+                s = semi[u]
+        semi[w] = s
+        next_in_bucket[w] = bucket[s]
+        bucket[s] = w
+        p = parent[w]
+        ancestor[w] = p
+        v = bucket[p]
+        while v >= 0:
+            u = evaluate(v)
+            idom[v] = u if semi[u] < semi[v] else p
+            v = next_in_bucket[v]
+        bucket[p] = -1
+    for w in range(1, num_reached):
+        if idom[w] != semi[w]:
+            idom[w] = idom[idom[w]]
+    return vertex, idom
+
+
+def retained_sizes(vertex, idom, sizes, folded_sizes, folded_counts):
+    """
+    The bytes and objects retained by each preorder number, its own and those
+    folded into it included.
+    """
+    retained = array("q", (sizes[node] + folded_sizes[node] for node in vertex))
+    retained_counts = array("q", (1 + folded_counts[node] for node in vertex))
+    # Dominators come before the nodes they dominate in preorder.
+    for w in range(len(vertex) - 1, 0, -1):
+        retained[idom[w]] += retained[w]
+        retained_counts[idom[w]] += retained_counts[w]
+    return retained, retained_counts
@@ -28,8 +28,7 @@ class IntegrationTest(unittest.TestCase):
 
         self.assertEqual("0", value, "/proc/sys/kernel/yama/ptrace_scope should be 0")
 
-        # Presumably this is a virtualenv python executable that has objgraph
-        # and pympler
+        # Presumably this is a virtualenv python executable
         try:
             child = subprocess.Popen(
                 [sys.executable, "-c", "import sys; sys.stdin.readline()"],
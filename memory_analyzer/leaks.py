@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Leak suspects from a series of snapshots of the same process.
+
+The size of every type is fitted against time by least squares. A type's
+score is the t statistic of its slope, so caches that come and go score low
+however large their swings, while steady growth scores high. How often the
+type grew from one snapshot to the next is reported alongside.
+
+Only running sums are kept per type, one numpy vector each, so a series is
+read one snapshot at a time in memory linear in the number of types. numpy is
+optional for the rest of the analyzer, and only needed here.
+"""
+
+from . import analysis_utils, diff_utils, snapshot_file
+from .frontend import frontend_utils
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Slopes this many standard errors above zero are reported. High enough that
+# tens of thousands of fluctuating types don't throw up chance suspects.
+MIN_SCORE = 5.0
+
+
+def check_numpy():
+    if np is None:
+        raise ImportError("Finding leak suspects needs numpy: pip install numpy")
+
+
+class LeakFit:
+    """
+    Least-squares fits of the size of every type against time, added to one
+    snapshot at a time.
+    """
+
+    def __init__(self):
+        check_numpy()
+        self.index = {}
+        self.names = []
+        self.num_samples = 0
+        self.sum_x = 0.0
+        self.sum_xx = 0.0
+        self.vectors = {
+            name: np.zeros(0)
+            for name in ("base", "sum_y", "sum_xy", "sum_yy", "rising", "size", "count")
+        }
+
+    def _column(self, name):
+        column = self.index.get(name)
+        if column is None:
+            column = self.index[name] = len(self.names)
+            self.names.append(name)
+        return column
+
+    def add(self, x, names, counts, sizes):
+        """
+        Add the snapshot taken at time `x`, with the given rows.
+        """
+        columns = np.fromiter(map(self._column, names), np.int64, len(names))
+        num_types = len(self.names)
+        for name, vector in self.vectors.items():
+            if len(vector) < num_types:
+                self.vectors[name] = np.concatenate(
+                    [vector, np.zeros(num_types - len(vector))]
+                )
+        v = self.vectors
+        size = np.bincount(columns, weights=np.asarray(sizes), minlength=num_types)
+        count = np.bincount(columns, weights=np.asarray(counts), minlength=num_types)
+        if not self.num_samples:
+            # Sums are taken relative to the first snapshot, which keeps them
+            # small enough for the variances to stay accurate.
+            v["base"] = size.copy()
+        else:
+            v["rising"] += size > v["size"]
+        y = size - v["base"]
+        v["sum_y"] += y
+        v["sum_xy"] += x * y
+        v["sum_yy"] += y * y
+        v["size"] = size
+        v["count"] = count
+        self.num_samples += 1
+        self.sum_x += x
+        self.sum_xx += x * x
+
+    def suspects(self, min_score=MIN_SCORE, top=None):
+        """
+        Rows for the types whose size grew with a score of at least
+        `min_score`, highest score first: name, latest count and size, growth
+        per unit of time, score and the share of snapshots it grew in.
+        """
+        n = self.num_samples
+        if n < 3:
+            return []
+        v = self.vectors
+        spread = self.sum_xx - self.sum_x * self.sum_x / n
+        if spread <= 0:
+            return []
+        slope = (v["sum_xy"] - self.sum_x * v["sum_y"] / n) / spread
+        total = v["sum_yy"] - v["sum_y"] * v["sum_y"] / n
+        residual = total - slope * slope * spread
+        # What is left of an exact fit is rounding error.
+        residual[residual <= 1e-9 * total] = 0
+        stderr = np.sqrt(np.maximum(residual, 0) / (n - 2) / spread)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = np.where(stderr > 0, slope / stderr, np.inf)
+        (candidates,) = np.nonzero((slope > 0) & (score >= min_score))
+        order = candidates[np.argsort(-score[candidates], kind="stable")][:top]
+        rising = v["rising"] / (n - 1)
+        return [
+            [
+                self.names[i],
+                int(v["count"][i]),
+                int(v["size"][i]),
+                frontend_utils.readable_size(float(slope[i]), True),
+                round(float(score[i]), 1),
+                f"{rising[i]:.0%}",
+            ]
+            for i in order
+        ]
+
+
+def leak_page(pid, fit, unit, min_score=MIN_SCORE, top=None):
+    return analysis_utils.RetrievedObjects(
+        pid=pid,
+        title=f"Leak Suspects for {pid} over {fit.num_samples} snapshots",
+        data=fit.suspects(min_score, top),
+        metadata={
+            "columns": [f"Growth /{unit}", "Score", "Rising"],
+            "sort_column": 4,
+        },
+    )
+
+
+def page_arrays(page):
+    if isinstance(page, snapshot_file.SnapshotPage):
+        return page.arrays()
+    rows = page.data or []
+    return (
+        [row[0] for row in rows],
+        [row[1] for row in rows],
+        [row[2] for row in rows],
+    )
+
+
+def snapshot_leak_pages(filenames, pids=(), min_score=MIN_SCORE, top=None):
+    """
+    A leak suspect page for every PID in the snapshot `filenames`, oldest
+    first, or only for `pids`. Snapshots are placed at the time they were
+    taken if all of them recorded it, and growth is then per hour; otherwise
+    they are evenly spaced and growth is per snapshot.
+    """
+    series = []
+    for filename in filenames:
+        if snapshot_file.is_snapshot_file(filename):
+            reader = snapshot_file.SnapshotReader(filename)
+            pages = [reader.page(pos) for pos in range(len(reader))]
+        else:
+            pages = list(snapshot_file.read_pages(filename))
+        series.append(diff_utils.pages_by_pid(pages))
+    wanted = [str(pid) for pid in pids] or list(
+        dict.fromkeys(pid for by_pid in series for pid in by_pid)
+    )
+    leak_pages = []
+    for pid in wanted:
+        pages = [by_pid[pid] for by_pid in series if pid in by_pid]
+        if not pages:
+            continue
+        times = [getattr(page, "metadata", {}).get("timestamp") for page in pages]
+        if None in times:
+            times, unit = range(len(pages)), "snapshot"
+        else:
+            times, unit = [(t - times[0]) / 3600 for t in times], "h"
+        fit = LeakFit()
+        for x, page in zip(times, pages):
+            fit.add(x, *page_arrays(page))
+        leak_pages.append(leak_page(pages[0].pid, fit, unit, min_score, top))
+    return leak_pages
+
+
+def store_leak_pages(store, pids=(), min_score=MIN_SCORE, top=None):
+    """
+    A leak suspect page for every PID in a `watch` store, or only for `pids`.
+    """
+    leak_pages = []
+    for pid in pids or store.pids():
+        fit = LeakFit()
+        start = None
+        for sample in store.samples(pid):
+            start = sample.time if start is None else start
+            totals = sample.rows.values()
+            fit.add(
+                (sample.time - start) / 3600,
+                list(sample.rows),
+                [count for count, _ in totals],
+                [size for _, size in totals],
+            )
+        leak_pages.append(leak_page(pid, fit, "h", min_score, top))
+    return leak_pages
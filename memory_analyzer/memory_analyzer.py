@@ -5,10 +5,12 @@
 # LICENSE file in the root directory of this source tree.
 
 import errno
+import json
 import os
 import pickle
 import sys
-import tempfile
+import threading
+import time
 from datetime import datetime
 from functools import partial
 from multiprocessing.pool import ThreadPool
@@ -16,36 +18,272 @@ from multiprocessing.pool import ThreadPool
 import click
 import pkg_resources
 
-from . import analysis_utils
+from . import (
+    analysis_utils,
+    buffers,
+    core,
+    diff_utils,
+    heapgraph,
+    leaks,
+    native,
+    snapshot_file,
+    timeseries,
+)
 from .frontend import frontend_utils
 
 
+def report_batch(pid, rows):
+    frontend_utils.echo_info(f"Received {len(rows)} rows from pid {pid}")
+
+
 def analyze_memory_launcher(
-    pid, num_refs, specific_refs, debug, output_file, executable, template_out_path
+    pid,
+    num_refs,
+    specific_refs,
+    debug,
+    output_file,
+    executable,
+    template_out_path,
+    on_batch=None,
+    template_options=None,
+    use_agent=True,
+    dump_graph=False,
+    backend="gdb",
 ):
     templates_path = (
         pkg_resources.resource_filename("memory_analyzer", "templates") + "/"
     )
     cur_path = os.path.dirname(__file__) + "/"  # not zip safe, for now
-    gdb_obj = analysis_utils.GDBObject(pid, cur_path, executable, template_out_path)
+    if use_agent and analysis_utils.agent_available(pid):
+        gdb_obj = analysis_utils.AgentObject(
+            pid, cur_path, executable, template_out_path
+        )
+    else:
+        gdb_obj = analysis_utils.injector(
+            backend, pid, cur_path, executable, template_out_path
+        )
     output_path = os.path.abspath(output_file)
-    analysis_utils.render_template(
-        f"analysis.py.template",
+    template_options = dict(template_options or {})
+    if dump_graph:
+        # The payload dumps to f"{output_path}.{pid}.graph".
+        template_options["graph_dump_path"] = output_path
+    timings = gdb_obj.timings["analyzer"]
+    with analysis_utils.timed(timings, "render"):
+        template = analysis_utils.render_template(
+            "analysis.py.template",
+            templates_path,
+            num_refs,
+            specific_refs,
+            output_path,
+            **template_options,
+        )
+        gdb_obj.payload_path = analysis_utils.write_payload(
+            template_out_path, "analysis.py.template", template
+        )
+    result = gdb_obj.run_analysis(debug, on_batch)
+    dump = result.metadata.get("graph_dump")
+    if dump:
+        analyze_graph_dump(
+            result,
+            dump,
+            template_options.get("retained_top", 0),
+            num_refs,
+            specific_refs,
+        )
+    for page in result.metadata.get("pages", []):
+        if page.title.startswith("GC Generations"):
+            report_gc_timings(pid, page.metadata["gc"])
+    native_stats = template_options.get("native_stats", True)
+    # Hosts without /proc have no mappings to read, which is no error.
+    if native_stats and result.data is not None and native.available():
+        try:
+            with analysis_utils.timed(timings, "native"):
+                pages = native.native_pages(result)
+        except OSError as e:
+            frontend_utils.echo_error(f"Could not read the mappings of pid {pid}: {e}")
+        else:
+            result.metadata.setdefault("pages", []).extend(pages)
+    return result
+
+
+def report_gc_timings(pid, state):
+    """
+    Echo how long the collections of each generation took, as timed by the
+    agent since it was installed.
+    """
+    for generation, timing in sorted((state.get("timings") or {}).items()):
+        frontend_utils.echo_info(
+            f"pid {pid} generation {generation}: {timing['collections']} "
+            f"collections, {timing['total_ms']:.1f}ms in total, "
+            f"{timing['max_ms']:.1f}ms the longest"
+        )
+    if state.get("frozen"):
+        frontend_utils.echo_info(
+            f"pid {pid} has {state['frozen']} objects frozen with gc.freeze(), "
+            "in no generation"
+        )
+
+
+def analyze_graph_dump(result, dump, retained_top, num_refs=0, specific_refs=()):
+    """
+    Fill in `result` from the heap graph its target dumped to `dump`.
+    """
+    frontend_utils.echo_info(f"Analyzing the heap graph in {dump}")
+    try:
+        main, *pages = analysis_utils.graph_dump_pages(
+            dump, retained_top, num_refs, specific_refs
+        )
+    except (OSError, heapgraph.HeapGraphError) as e:
+        frontend_utils.echo_error(f"Could not read the heap graph {dump}: {e}")
+        return
+    result.data = main.data
+    if main.metadata["graph"]["truncated"] and "(partial)" not in result.title:
+        result.title += " (partial)"
+    result.metadata.setdefault("pages", []).extend(pages)
+
+
+def analyze_core_launcher(core_file, executable=None):
+    """
+    The per-type summary of the core dump `core_file`. Errors are reported and
+    give a result with no data, as a failed attach would.
+    """
+    frontend_utils.echo_info(f"Reading the heap of {core_file}")
+    try:
+        return core.analyze_core(core_file, executable)
+    except (OSError, ImportError, core.CoreError) as e:
+        frontend_utils.echo_error(f"Could not analyze {core_file}: {e}")
+        return analysis_utils.RetrievedObjects(
+            pid=0, title=f"Analysis of {core_file}", data=None
+        )
+
+
+def install_agent_launcher(pid, debug, executable, template_out_path, backend="gdb"):
+    templates_path = (
+        pkg_resources.resource_filename("memory_analyzer", "templates") + "/"
+    )
+    cur_path = os.path.dirname(__file__) + "/"  # not zip safe, for now
+    gdb_obj = analysis_utils.injector(
+        backend, pid, cur_path, executable, template_out_path
+    )
+    template = analysis_utils.render_template(
+        "agent.py.template",
         templates_path,
-        num_refs,
-        pid,
-        specific_refs,
-        output_path,
-        template_out_path,
+        0,
+        [],
+        None,
+        socket_path=analysis_utils.AGENT_SOCKET_PATH,
+    )
+    gdb_obj.payload_path = analysis_utils.write_payload(
+        template_out_path, "agent.py.template", template
     )
-    return gdb_obj.run_analysis(debug)
+    gdb_obj.run_analysis(debug)
+    return gdb_obj.metadata
 
 
-def write_to_output_file(filename, items):
-    with open(filename, "wb+") as outputf:
-        for item in items:
-            bytes_item = pickle.dumps(item)
-            outputf.write(bytes_item)
+def trace_launcher(
+    pid, start, frames, debug, executable, template_out_path, backend="gdb"
+):
+    """
+    Start (or stop) tracemalloc in the process, through its agent if it has
+    one. Returns what the process reported about tracing.
+    """
+    templates_path = (
+        pkg_resources.resource_filename("memory_analyzer", "templates") + "/"
+    )
+    cur_path = os.path.dirname(__file__) + "/"  # not zip safe, for now
+    if analysis_utils.agent_available(pid):
+        gdb_obj = analysis_utils.AgentObject(
+            pid, cur_path, executable, template_out_path
+        )
+    else:
+        gdb_obj = analysis_utils.injector(
+            backend, pid, cur_path, executable, template_out_path
+        )
+    template = analysis_utils.render_template(
+        "tracemalloc.py.template",
+        templates_path,
+        0,
+        [],
+        None,
+        start=start,
+        frames=frames,
+    )
+    gdb_obj.payload_path = analysis_utils.write_payload(
+        template_out_path, "tracemalloc.py.template", template
+    )
+    gdb_obj.run_analysis(debug)
+    return gdb_obj.metadata.get("tracemalloc")
+
+
+def run_scheduled(target, pids, jobs, stagger_ms=0):
+    """
+    Run `target` for every pid on a pool of `jobs` threads, so at most `jobs`
+    gdb sessions (and paused targets) exist at once. Consecutive attaches are
+    started at least `stagger_ms` apart. Results are yielded as they finish,
+    with their start time and wall time stored in the metadata.
+    """
+    lock = threading.Lock()
+    next_start = [time.monotonic()]
+
+    def staggered(pid):
+        with lock:
+            now = time.monotonic()
+            delay = next_start[0] - now
+            next_start[0] = max(next_start[0], now) + stagger_ms / 1000
+        if delay > 0:
+            time.sleep(delay)
+        start = time.monotonic()
+        timestamp = time.time()
+        result = target(pid)
+        result.metadata["timestamp"] = timestamp
+        result.metadata["wall_time_s"] = round(time.monotonic() - start, 3)
+        return result
+
+    worker_pool = ThreadPool(jobs)
+    try:
+        for done, result in enumerate(worker_pool.imap_unordered(staggered, pids), 1):
+            frontend_utils.echo_info(
+                f"[{done}/{len(pids)}] pid {result.pid} finished in "
+                f"{result.metadata['wall_time_s']}s"
+            )
+            yield result
+    finally:
+        worker_pool.close()
+
+
+def payload_dir():
+    """
+    The directory to render payloads to, cleared of those no run has used in
+    a while.
+    """
+    try:
+        path = analysis_utils.payload_dir()
+        analysis_utils.clean_payloads(path)
+    except OSError as e:
+        frontend_utils.echo_error(f"Cannot keep payloads in {e.filename}: {e}")
+        sys.exit(1)
+    return path
+
+
+def write_to_output_file(filename, items, compress=True):
+    snapshot_file.write_snapshot(filename, items, compress)
+
+
+def write_timings(filename, results):
+    """
+    Dump where the time of every analysis went, in ms, as JSON.
+    """
+    timings = [
+        {
+            "pid": result.pid,
+            "title": result.title,
+            "timings": result.metadata["timings"],
+        }
+        for result in results
+        if "timings" in result.metadata
+    ]
+    with open(filename, "w") as f:
+        json.dump(timings, f, indent=2)
 
 
 def is_root():
@@ -78,14 +316,112 @@ def check_positive_int(ctx, param, i):
     raise click.BadParameter(msg)
 
 
+def check_sample_rate(ctx, param, rate):
+    if 0 < rate <= 1:
+        return rate
+    msg = "The sample rate must be greater than 0 and at most 1."
+    raise click.BadParameter(msg)
+
+
+def check_jobs(ctx, param, jobs):
+    """
+    Accepts a number of concurrent jobs, or a percentage of the PIDs given.
+    Defaults to one job per CPU.
+    """
+    pids = ctx.params.get("pids") or ()
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    elif jobs.endswith("%"):
+        try:
+            percent = float(jobs[:-1])
+        except ValueError:
+            percent = 0
+        if not 0 < percent <= 100:
+            raise click.BadParameter("Percentages must be between 0 and 100.")
+        jobs = int(len(pids) * percent / 100)
+    else:
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            raise click.BadParameter(f"{jobs} is not a number or percentage.")
+        if jobs < 1:
+            raise click.BadParameter("At least one job is required.")
+    return max(1, min(jobs, len(pids))) if pids else max(1, jobs)
+
+
+def check_at_least_one(ctx, param, n):
+    if n >= 1:
+        return n
+    msg = "Must be at least 1."
+    raise click.BadParameter(msg)
+
+
+def check_duration(ctx, param, ms):
+    if ms >= 0:
+        return ms
+    msg = "Durations cannot be negative."
+    raise click.BadParameter(msg)
+
+
+def backend_options(command):
+    """
+    The -d, -e and --backend options of every command that runs code in a
+    process.
+    """
+    options = [
+        click.option(
+            "-d",
+            "--debug",
+            "debug",
+            is_flag=True,
+            default=False,
+            help="Show GDB output, for debugging the analyzer.",
+        ),
+        click.option(
+            "-e",
+            "--exec",
+            "executable",
+            help=f"Python executable to use. Defaults to {sys.executable}-dbg with\n\
+    gdb, and to this Python with remote-exec.",
+        ),
+        click.option(
+            "--backend",
+            type=click.Choice(list(analysis_utils.BACKENDS)),
+            default="gdb",
+            help="How to run the analysis in the process: gdb with the debug\n\
+    interpreter, gdb-minimal with only the symbols the interpreter exports,\n\
+    or remote-exec with sys.remote_exec on Python 3.14+.",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
 @click.group()
 def cli():
     pass
 
 
+def read_snapshot(filename, pid=None, top=None):
+    """
+    Open the pages of `filename`, only those of `pid` and their `top` rows if
+    given. Pages of a snapshot file are decoded lazily as the viewer scrolls;
+    old pickle snapshots are always read whole.
+    """
+    if not snapshot_file.is_snapshot_file(filename):
+        pages = list(frontend_utils.get_pages(filename))
+        return [page for page in pages if pid is None or str(page.pid) == str(pid)]
+    reader = snapshot_file.SnapshotReader(filename)
+    positions = range(len(reader)) if pid is None else reader.find(pid)
+    return [reader.page(pos, top) for pos in positions]
+
+
 @cli.command()
 @click.argument("filename", type=click.Path(exists=True))
-def view(filename):
+@click.option("--pid", help="Only show the pages for this PID.")
+@click.option("--top", type=int, help="Only read the N largest rows of each page.")
+def view(filename, pid, top):
     """
     Tool for viewing the output of the memory analyzer. Launches a UI.
 
@@ -94,23 +430,294 @@ def view(filename):
         FILENAME: The filename of the snapshot to view.
     """
     try:
-        pages = frontend_utils.get_pages(filename)
-    except pickle.UnpicklingError as e:
+        pages = read_snapshot(filename, pid, top)
+    except (pickle.UnpicklingError, snapshot_file.SnapshotError) as e:
         frontend_utils.echo_error(f"Error unpickling the data from {filename}: {e}")
         sys.exit(1)
+    if not pages:
+        frontend_utils.echo_error(f"No pages for pid {pid} in {filename}")
+        sys.exit(1)
     frontend_utils.initiate_curses(pages)
 
 
 @cli.command()
+@click.argument("filenames", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("-f", "--output-file", type=str, help="File to output results to.")
+def diff(filenames, output_file):
+    """
+    Compare snapshots already taken, without running the analysis. Launches a
+    UI.
+
+    Argument:
+
+        FILENAMES: The snapshot files to compare, oldest first. With two the
+        newest is compared to the oldest; with more a trend table shows the
+        size of every type in each of them.
+    """
+    if len(filenames) < 2:
+        frontend_utils.echo_error("Need at least two snapshots to compare")
+        sys.exit(1)
+    *snapshots, newest = filenames
+    pages = analysis_utils.read_snapshot_pages(newest)
+    if pages is None:
+        sys.exit(1)
+    pages = [page for page in pages if not diff_utils.is_diff_page(page)]
+    if len(snapshots) == 1:
+        differences = analysis_utils.snapshot_diff(pages, snapshots[0])
+    else:
+        differences = analysis_utils.snapshot_trend(pages, snapshots)
+    if not differences:
+        frontend_utils.echo_error("No pages to compare")
+        sys.exit(1)
+    if output_file:
+        frontend_utils.echo_info(f"Writing output to file {output_file}")
+        write_to_output_file(output_file, differences)
+    frontend_utils.initiate_curses(differences)
+
+
+@cli.command()
+@click.argument("filenames", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "--retained",
+    "retained_top",
+    default=0,
+    callback=check_positive_int,
+    help="Also show the X objects retaining the most memory.",
+)
+@click.option(
+    "-s",
+    "--show-references",
+    "num_refs",
+    default=0,
+    callback=check_positive_int,
+    help="Shows the references of the X largest types.",
+)
+@click.option(
+    "-ss",
+    "--show-specific-references",
+    "specific_refs",
+    multiple=True,
+    default=[],
+    help="Shows the references of all objects given.",
+)
+@click.option("-f", "--output-file", type=str, help="File to output results to.")
+def graph(filenames, retained_top, num_refs, specific_refs, output_file):
+    """
+    Analyze heap graphs dumped by run --dump-graph. Launches a UI.
+
+    Argument:
+
+        FILENAMES: The heap graph files.
+    """
+    pages = []
+    for filename in filenames:
+        try:
+            pages.extend(
+                analysis_utils.graph_dump_pages(
+                    filename, retained_top, num_refs, specific_refs
+                )
+            )
+        except heapgraph.HeapGraphError as e:
+            frontend_utils.echo_error(f"Could not read the heap graph: {e}")
+            sys.exit(1)
+    if output_file:
+        frontend_utils.echo_info(f"Writing output to file {output_file}")
+        write_to_output_file(output_file, pages)
+    frontend_utils.initiate_curses(pages)
+
+
+@cli.command("leaks")
+@click.argument("filenames", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--store",
+    "store_file",
+    type=click.Path(exists=True),
+    help="Read the samples from a store written by watch instead.",
+)
+@click.option("--pid", "pids", multiple=True, help="Only look at these PIDs.")
+@click.option(
+    "--min-score",
+    type=float,
+    default=leaks.MIN_SCORE,
+    help="Only report types whose growth is at least this many standard\n\
+    errors above zero.",
+)
+@click.option(
+    "--top",
+    type=int,
+    default=100,
+    callback=check_at_least_one,
+    help="How many suspects to report per PID.",
+)
+@click.option("-f", "--output-file", type=str, help="File to output results to.")
+def leak_suspects(filenames, store_file, pids, min_score, top, output_file):
+    """
+    Rank the types most likely to be leaking from a series of snapshots of the
+    same processes. Needs numpy. Launches a UI.
+
+    Argument:
+
+        FILENAMES: The snapshot files, oldest first.
+    """
+    if leaks.np is None:
+        frontend_utils.echo_error("Finding leak suspects needs numpy")
+        sys.exit(1)
+    if store_file:
+        try:
+            pages = leaks.store_leak_pages(
+                timeseries.TimeSeriesStore(store_file), pids, min_score, top
+            )
+        except timeseries.TimeSeriesError as e:
+            frontend_utils.echo_error(str(e))
+            sys.exit(1)
+    elif len(filenames) >= 3:
+        try:
+            pages = leaks.snapshot_leak_pages(filenames, pids, min_score, top)
+        except (pickle.UnpicklingError, snapshot_file.SnapshotError) as e:
+            frontend_utils.echo_error(f"Error unpickling the snapshots: {e}")
+            sys.exit(1)
+    else:
+        frontend_utils.echo_error("Need at least three snapshots or a --store")
+        sys.exit(1)
+    if output_file:
+        frontend_utils.echo_info(f"Writing output to file {output_file}")
+        write_to_output_file(output_file, pages)
+    frontend_utils.initiate_curses(pages)
+
+
+@cli.command("install-agent")
+@click.argument("pids", callback=validate_pids, nargs=-1)
+@backend_options
+def install_agent(pids, debug, executable, backend):
+    """
+    Inject a long-lived agent thread into running Python 3 process(es).
+
+    Later `run` calls against these PIDs send their analysis to the agent over
+    a Unix socket instead of attaching gdb each time.
+
+    Argument:
+
+        PIDS: The pid or list of pids of the running Python 3 process(es).
+    """
+    template_out_path = payload_dir()
+    failed = False
+    for pid in pids:
+        metadata = install_agent_launcher(
+            pid, debug, executable, template_out_path, backend
+        )
+        if "agent" not in metadata:
+            frontend_utils.echo_error(f"Could not install the agent in pid {pid}")
+            failed = True
+        elif metadata["agent_started"]:
+            frontend_utils.echo_info(
+                f"Agent for pid {pid} listening on {metadata['agent']}"
+            )
+        else:
+            frontend_utils.echo_info(f"Agent for pid {pid} was already running")
+    if failed:
+        sys.exit(1)
+
+
+@cli.command("uninstall-agent")
+@click.argument("pids", callback=validate_pids, nargs=-1)
+def uninstall_agent(pids):
+    """
+    Stop the agent thread started by `install-agent`.
+
+    Argument:
+
+        PIDS: The pid or list of pids of the running Python 3 process(es).
+    """
+    for pid in pids:
+        if not analysis_utils.agent_available(pid):
+            frontend_utils.echo_error(f"No agent is listening in pid {pid}")
+            continue
+        analysis_utils.stop_agent(pid)
+        frontend_utils.echo_info(f"Stopped the agent in pid {pid}")
+
+
+@cli.command("trace-start")
+@click.argument("pids", callback=validate_pids, nargs=-1)
+@click.option(
+    "--frames",
+    default=1,
+    callback=check_at_least_one,
+    help="How many frames of each allocation's traceback to keep.",
+)
+@backend_options
+def trace_start(pids, frames, debug, executable, backend):
+    """
+    Start tracing allocations with tracemalloc in running Python 3
+    process(es), so that `run` can show where the memory in use was allocated.
+
+    Tracing slows allocations down and takes memory of its own, stop it with
+    `trace-stop` once done.
+
+    Argument:
+
+        PIDS: The pid or list of pids of the running Python 3 process(es).
+    """
+    template_out_path = payload_dir()
+    failed = False
+    for pid in pids:
+        status = trace_launcher(
+            pid, True, frames, debug, executable, template_out_path, backend
+        )
+        if status is None:
+            frontend_utils.echo_error(f"Could not start tracing in pid {pid}")
+            failed = True
+        elif status["was_tracing"]:
+            frontend_utils.echo_info(
+                f"pid {pid} was already tracing {status['frames']} frame(s)"
+            )
+        else:
+            frontend_utils.echo_info(
+                f"Tracing allocations in pid {pid} with {status['frames']} frame(s)"
+            )
+    if failed:
+        sys.exit(1)
+
+
+@cli.command("trace-stop")
 @click.argument("pids", callback=validate_pids, nargs=-1)
+@backend_options
+def trace_stop(pids, debug, executable, backend):
+    """
+    Stop tracing allocations in process(es) `trace-start` was run on, freeing
+    the traces.
+
+    Argument:
+
+        PIDS: The pid or list of pids of the running Python 3 process(es).
+    """
+    template_out_path = payload_dir()
+    failed = False
+    for pid in pids:
+        status = trace_launcher(
+            pid, False, 1, debug, executable, template_out_path, backend
+        )
+        if status is None:
+            frontend_utils.echo_error(f"Could not stop tracing in pid {pid}")
+            failed = True
+        elif status["was_tracing"]:
+            frontend_utils.echo_info(f"Stopped tracing allocations in pid {pid}")
+        else:
+            frontend_utils.echo_info(f"pid {pid} was not tracing allocations")
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+# Eager, so that --jobs can be given as a percentage of the PIDs.
+@click.argument("pids", callback=validate_pids, nargs=-1, is_eager=True)
 @click.option(
     "-s",
     "--show-references",
     "num_refs",
     default=0,
     callback=check_positive_int,
-    help="Shows the references of the X most common objects.\n\
-    This is a costly operation, do not use a large number.",
+    help="Shows the references of the X largest types: what an instance\n\
+    references, and the shortest path to one from a root.",
 )
 @click.option(
     "-ss",
@@ -118,13 +725,70 @@ def view(filename):
     "specific_refs",
     multiple=True,
     default=[],
-    help="Shows the references of all objects given.\n\
-    This is a costly operation, be careful.",
+    help="Shows the references of all objects given.",
+)
+@click.option(
+    "--retained",
+    "retained_top",
+    default=0,
+    callback=check_positive_int,
+    help="Also show the X objects retaining the most memory, from the\n\
+    dominator tree of the heap. Needs about 100 bytes per object.",
+)
+@click.option(
+    "--max-graph-nodes",
+    default=analysis_utils.MAX_GRAPH_NODES,
+    callback=check_positive_int,
+    help="Cut the heap graph for --retained short at this many objects.\n\
+    0 means no limit.",
+)
+@click.option(
+    "--dump-graph",
+    is_flag=True,
+    default=False,
+    help="Only dump the heap graph in the process, next to the output file,\n\
+    and analyze it afterwards. Pauses the process for much less time.",
+)
+@click.option(
+    "--arrays-top",
+    default=buffers.ARRAYS_TOP,
+    callback=check_positive_int,
+    help="Show the X groups of NumPy arrays of the same dtype and shape\n\
+    holding the most data. 0 to skip them.",
+)
+@click.option(
+    "--no-native",
+    is_flag=True,
+    default=False,
+    help="Don't show the native memory and mapping pages.",
+)
+@click.option(
+    "--gc-generations",
+    is_flag=True,
+    default=False,
+    help="Also split the tracked objects by GC generation, in a pass over\n\
+    the heap of its own before the walk.",
+)
+@click.option(
+    "--tracemalloc-top",
+    default=analysis_utils.TRACEMALLOC_TOP,
+    callback=check_positive_int,
+    help="Show the X allocation sites holding the most memory, if the\n\
+    process is tracing (see trace-start). 0 to skip them.",
+)
+@click.option(
+    "--tracemalloc-group",
+    type=click.Choice(analysis_utils.TRACEMALLOC_GROUPS),
+    default="lineno",
+    help="Group allocations by line, by file or by traceback.",
 )
 @click.option(
     "--snapshot",
+    "snapshots",
     type=click.Path(exists=True),
-    help="The file containing snapshot information of previous run.",
+    multiple=True,
+    help="The file containing snapshot information of previous run. Give it "
+    "more than once, oldest first, for a trend across all of them.",
 )
 @click.option(
     "-q",
@@ -134,41 +798,113 @@ def view(filename):
     default=False,
     help="Don't enter UI after evaluation.",
 )
+@backend_options
+@click.option("-f", "--output-file", type=str, help="File to output results to.")
 @click.option(
-    "-d",
-    "--debug",
-    "debug",
+    "--no-compress",
     is_flag=True,
     default=False,
-    help="Show GDB output, for debugging the analyzer.",
+    help="Do not compress the columns of the output file.",
 )
-@click.option("-f", "--output-file", type=str, help="File to output results to.")
 @click.option(
     "--no-upload",
     is_flag=True,
     default=False,
-    help="Do not upload reference graphs to phabricator.",
+    hidden=True,
+    help="Deprecated: references are no longer rendered as images.",
+)
+@click.option(
+    "--sample-rate",
+    type=float,
+    default=1.0,
+    callback=check_sample_rate,
+    help="Fraction of the heap to sample. Counts and sizes are scaled back up\n\
+    and shown with 95% confidence intervals.",
+)
+@click.option(
+    "--max-pause-ms",
+    type=int,
+    default=0,
+    callback=check_duration,
+    help="Hold the target's GIL for at most this long at a time, releasing it\n\
+    between slices of the analysis. 0 means no limit.",
+)
+@click.option(
+    "--deadline-ms",
+    type=int,
+    default=0,
+    callback=check_duration,
+    help="Stop the analysis after this long and report partial results.\n\
+    0 means no deadline.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    callback=check_jobs,
+    help="How many PIDs to analyze at once, either a number or a percentage\n\
+    of the PIDs given (e.g. 25%). Defaults to the number of CPUs.",
+)
+@click.option(
+    "--stagger-ms",
+    type=int,
+    default=0,
+    callback=check_duration,
+    help="Wait at least this long between starting two attaches.",
+)
+@click.option(
+    "--no-agent",
+    is_flag=True,
+    default=False,
+    help="Attach with gdb even if an agent is installed in the process.",
+)
+@click.option(
+    "--core",
+    "cores",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    help="Analyze this core dump instead of a running process, with the\n\
+    interpreter given by -e, or the one that dumped it. Can be given more\n\
+    than once; needs numpy.",
 )
 @click.option(
-    "-e",
-    "--exec",
-    "executable",
-    help="Python executable to use",
-    default=f"{sys.executable}-dbg",
+    "--timings",
+    "timings_file",
+    type=click.Path(dir_okay=False),
+    help="Write how long each phase of every analysis took to this file,\n\
+    as JSON.",
 )
 def run(
     pids,
     num_refs,
     specific_refs,
-    snapshot,
+    retained_top,
+    max_graph_nodes,
+    dump_graph,
+    arrays_top,
+    no_native,
+    gc_generations,
+    tracemalloc_top,
+    tracemalloc_group,
+    snapshots,
     quiet,
     debug,
     output_file,
+    no_compress,
     no_upload,
     executable,
+    sample_rate,
+    max_pause_ms,
+    deadline_ms,
+    jobs,
+    stagger_ms,
+    no_agent,
+    backend,
+    cores,
+    timings_file,
 ):
     """
-    Tool for providing memory analysis on a running Python3 process.
+    Tool for providing memory analysis on a running Python3 process, or on
+    core dumps of one with --core.
 
     Argument:
 
@@ -178,57 +914,282 @@ def run(
     Output:
 
         A binary file of the results. By default, after run completes the user
-        will enter a UI for navigating the data. If references are set, png
-        files will also be created and uploaded to phabricator.
+        will enter a UI for navigating the data. If references are set, they
+        are shown as extra columns.
 
 
         Unless otherwise set, the output files will reside in memory_analyzer_out/,
         which is created where the service is ran.
     """
+    if cores and pids:
+        raise click.UsageError("Give either PIDs or --core, not both.")
     runtime = "{:%Y%m%d%H%M%S}".format(datetime.now())
     default_filename = f"memory_analyzer_out/memory_analyzer_snapshot-{runtime}"
     if not output_file:
         output_file = default_filename
 
-    references = num_refs > 0 or specific_refs
     retrieved_objs = []
     # Create a folder for output
-    if references or output_file == default_filename:
+    if output_file == default_filename:
         os.makedirs(os.path.dirname(default_filename), exist_ok=True)
-    template_out_path = tempfile.mkdtemp()
+    template_out_path = payload_dir()
 
-    # Make a new thread per PID
-    worker_pool = ThreadPool(len(pids))
-    target = partial(
-        analyze_memory_launcher,
-        num_refs=num_refs,
-        specific_refs=specific_refs,
-        debug=debug,
-        output_file=output_file,
-        executable=executable,
-        template_out_path=template_out_path,
-    )
+    if cores:
+        # Cores only give the per-type summary: there is no process to run
+        # the rest of the analysis in.
+        target = partial(analyze_core_launcher, executable=executable)
+        pids = cores
+    else:
+        target = partial(
+            analyze_memory_launcher,
+            num_refs=num_refs,
+            specific_refs=specific_refs,
+            debug=debug,
+            output_file=output_file,
+            executable=executable,
+            template_out_path=template_out_path,
+            on_batch=report_batch,
+            template_options={
+                "sample_rate": sample_rate,
+                "max_pause_ms": max_pause_ms,
+                "deadline_ms": deadline_ms,
+                "retained_top": retained_top,
+                "max_graph_nodes": max_graph_nodes,
+                "tracemalloc_top": tracemalloc_top,
+                "tracemalloc_group": tracemalloc_group,
+                "native_stats": not no_native,
+                "gc_generations": gc_generations,
+                "arrays_top": arrays_top,
+            },
+            use_agent=not no_agent,
+            dump_graph=dump_graph,
+            backend=backend,
+        )
 
-    for result in worker_pool.imap_unordered(target, pids):
+    results = []
+    for result in run_scheduled(target, pids, jobs, stagger_ms):
+        results.append(result)
         if result.data is None:
             frontend_utils.echo_error(
                 f"{result.title} returned no data!  Try rerunning with --debug"
             )
         else:
             retrieved_objs.append(result)
+        # Pages sent alongside the analysis, such as the retained sizes.
+        retrieved_objs.extend(result.metadata.pop("pages", []))
+    if timings_file:
+        frontend_utils.echo_info(f"Writing timings to file {timings_file}")
+        write_timings(timings_file, results)
     if not retrieved_objs:
         frontend_utils.echo_error("No results to report")
         sys.exit(1)
-    if snapshot:
-        diffs = analysis_utils.snapshot_diff(retrieved_objs, snapshot)
-        retrieved_objs.extend(diffs)
+    if snapshots:
+        diffs = analysis_utils.snapshot_diff(retrieved_objs, snapshots[-1])
+        retrieved_objs.extend(diffs or [])
+    if len(snapshots) > 1:
+        trends = analysis_utils.snapshot_trend(retrieved_objs, snapshots)
+        retrieved_objs.extend(trends or [])
 
     frontend_utils.echo_info(f"Writing output to file {output_file}")
-    write_to_output_file(output_file, retrieved_objs)
+    write_to_output_file(output_file, retrieved_objs, not no_compress)
     if not quiet:
         frontend_utils.echo_info("Initializing frontend...")
         frontend_utils.initiate_curses(retrieved_objs)
 
 
+def watch_samples(store, target, pids, jobs, interval_s, count=0, stagger_ms=0):
+    """
+    Append a sample of every pid to `store` each `interval_s` seconds, `count`
+    times or until interrupted. Returns how many rounds were taken.
+    """
+    rounds = 0
+    next_round = time.monotonic()
+    try:
+        while not count or rounds < count:
+            timestamp = time.time()
+            for result in run_scheduled(target, pids, jobs, stagger_ms):
+                if result.data is None:
+                    frontend_utils.echo_error(f"{result.title} returned no data!")
+                    continue
+                store.append(result.pid, result.data, timestamp)
+            rounds += 1
+            next_round += interval_s
+            if not count or rounds < count:
+                time.sleep(max(next_round - time.monotonic(), 0))
+    except KeyboardInterrupt:
+        pass
+    return rounds
+
+
+def report_growth(store, pids, top):
+    for pid in pids:
+        growth = store.growth(pid, top)
+        if not growth:
+            frontend_utils.echo_info(f"Not enough samples of pid {pid} yet")
+            continue
+        frontend_utils.echo_info(f"Steepest growth for pid {pid}:")
+        click.echo(frontend_utils.format_growth_output(growth))
+
+
+@cli.command()
+@click.argument("pids", callback=validate_pids, nargs=-1, is_eager=True)
+@click.option(
+    "--interval-s",
+    type=int,
+    default=60,
+    callback=check_at_least_one,
+    help="Seconds between two samples of each PID.",
+)
+@click.option(
+    "-n",
+    "--count",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Stop after this many samples. 0 samples until interrupted.",
+)
+@click.option(
+    "--store",
+    "store_file",
+    type=str,
+    help="Time series file to append the samples to.",
+)
+@click.option(
+    "--retention-s",
+    type=int,
+    default=7 * 24 * 3600,
+    callback=check_at_least_one,
+    help="Drop samples older than this many seconds.",
+)
+@click.option(
+    "--downsample-after-s",
+    type=int,
+    default=3600,
+    callback=check_duration,
+    help="Keep fewer samples once they are older than this many seconds.",
+)
+@click.option(
+    "--downsample-s",
+    type=int,
+    default=600,
+    callback=check_duration,
+    help="Keep one sample per this many seconds of the older samples.\n\
+    0 keeps them all.",
+)
+@click.option(
+    "--top",
+    type=int,
+    default=20,
+    callback=check_at_least_one,
+    help="How many of the fastest growing types to report.",
+)
+@click.option(
+    "--sample-rate",
+    type=float,
+    default=1.0,
+    callback=check_sample_rate,
+    help="Fraction of the heap to sample.",
+)
+@click.option(
+    "--max-pause-ms",
+    type=int,
+    default=0,
+    callback=check_duration,
+    help="Hold the target's GIL for at most this long at a time.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    callback=check_jobs,
+    help="How many PIDs to sample at once.",
+)
+@backend_options
+def watch(
+    pids,
+    interval_s,
+    count,
+    store_file,
+    retention_s,
+    downsample_after_s,
+    downsample_s,
+    top,
+    sample_rate,
+    max_pause_ms,
+    jobs,
+    debug,
+    executable,
+    backend,
+):
+    """
+    Sample the type counts and sizes of running Python 3 processes at a fixed
+    interval, then report the types growing the fastest.
+
+    Argument:
+
+        PIDS: The pid or list of pids of the running Python 3 process(es) to watch.
+
+    Samples are appended to a time series store, by default in
+    memory_analyzer_out/, and older ones are downsampled and eventually
+    dropped so it can be left running. Install an agent in the processes first
+    to avoid attaching gdb for every sample.
+    """
+    if not store_file:
+        runtime = "{:%Y%m%d%H%M%S}".format(datetime.now())
+        store_file = f"memory_analyzer_out/memory_analyzer_watch-{runtime}"
+        os.makedirs(os.path.dirname(store_file), exist_ok=True)
+    store = timeseries.TimeSeriesStore(
+        store_file, retention_s, downsample_after_s, downsample_s
+    )
+    for pid in pids:
+        if not analysis_utils.agent_available(pid):
+            frontend_utils.echo_info(
+                f"No agent in pid {pid}, every sample will attach gdb"
+            )
+    target = partial(
+        analyze_memory_launcher,
+        num_refs=0,
+        specific_refs=[],
+        debug=debug,
+        output_file=store_file,
+        executable=executable,
+        template_out_path=payload_dir(),
+        template_options={
+            "sample_rate": sample_rate,
+            "max_pause_ms": max_pause_ms,
+            # Only the per-type totals are kept.
+            "native_stats": False,
+        },
+        backend=backend,
+    )
+    frontend_utils.echo_info(f"Appending samples to {store_file}")
+    watch_samples(store, target, pids, jobs, interval_s, count)
+    report_growth(store, pids, top)
+
+
+@cli.command()
+@click.argument("store_file", type=click.Path(exists=True))
+@click.option("--pid", "pids", multiple=True, help="Only report these PIDs.")
+@click.option(
+    "--top",
+    type=int,
+    default=20,
+    callback=check_at_least_one,
+    help="How many of the fastest growing types to report.",
+)
+def growth(store_file, pids, top):
+    """
+    Report the fastest growing types in a time series store written by watch.
+
+    Argument:
+
+        STORE_FILE: The time series file to read.
+    """
+    try:
+        store = timeseries.TimeSeriesStore(store_file)
+    except timeseries.TimeSeriesError as e:
+        frontend_utils.echo_error(str(e))
+        sys.exit(1)
+    report_growth(store, pids or store.pids(), top)
+
+
 if __name__ == "__main__":
     cli()
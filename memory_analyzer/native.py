@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Memory the Python heap summary can't see: what numpy, protobuf and other C
+extensions allocate, and what malloc holds on to.
+
+The target reports its malloc statistics (mallinfo2) before the heap is
+walked. Afterwards the analyzer reads the resident memory of every mapping
+from /proc/<pid>/smaps, which costs nothing in the target, and splits it into
+Python objects, malloc's free chunks, other native memory and file-backed
+mappings.
+"""
+
+import os
+
+from . import analysis_utils
+
+# Fields of /proc/<pid>/smaps summed per mapping, in kB there.
+SMAPS_FIELDS = ("Rss", "Pss", "Anonymous", "Private_Dirty", "Swap")
+
+
+def available():
+    """
+    Whether the mappings of processes can be read here, from /proc (Linux).
+    """
+    return os.path.exists("/proc/self/smaps")
+
+
+def parse_smaps(lines):
+    """
+    Totals of SMAPS_FIELDS in bytes, for every mapping in `lines` of
+    /proc/<pid>/smaps (or its smaps_rollup). Yields (name, totals) per
+    mapping, named after the file mapped, or "[anonymous]".
+    """
+    name = None
+    totals = None
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if not fields[0].endswith(":"):
+            if name is not None:
+                yield name, totals
+            # address perms offset dev inode [pathname]
+            name = " ".join(fields[5:]) or "[anonymous]"
+            totals = dict.fromkeys(SMAPS_FIELDS, 0)
+        elif totals is not None and fields[0][:-1] in totals:
+            totals[fields[0][:-1]] += int(fields[1]) * 1024
+    if name is not None:
+        yield name, totals
+
+
+def read_rollup(pid):
+    """
+    The resident totals of the whole process. Kernels before 4.14 lack
+    smaps_rollup, every mapping is summed there instead.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            mappings = list(parse_smaps(f))
+    except FileNotFoundError:
+        with open(f"/proc/{pid}/smaps") as f:
+            mappings = list(parse_smaps(f))
+    rollup = dict.fromkeys(SMAPS_FIELDS, 0)
+    for _, totals in mappings:
+        for field, value in totals.items():
+            rollup[field] += value
+    return rollup
+
+
+def mapping_rows(pid):
+    """
+    A row per file mapped (and one for all anonymous mappings, one for the
+    heap, ...): name, mappings, resident bytes, then the SMAPS_FIELDS after Rss.
+    """
+    by_name = {}
+    with open(f"/proc/{pid}/smaps") as f:
+        for name, totals in parse_smaps(f):
+            row = by_name.setdefault(name, [name, 0] + [0] * len(SMAPS_FIELDS))
+            row[1] += 1
+            for column, field in enumerate(SMAPS_FIELDS, 2):
+                row[column] += totals[field]
+    return [row for row in by_name.values() if row[2] or row[-1]]
+
+
+def reconcile(rollup, malloc, python_size, python_count=0):
+    """
+    Rows splitting the resident memory in `rollup` between the Python objects
+    the analysis found, malloc's free chunks, other native memory, and
+    file-backed mappings. `malloc` is what the target reported from mallinfo2,
+    None if it couldn't.
+
+    Free chunks count as resident, though malloc never touched some of them,
+    so native memory is if anything underestimated.
+    """
+    anonymous = rollup["Anonymous"]
+    free = min(malloc["fordblks"], anonymous) if malloc else 0
+    python_size = min(python_size, anonymous - free)
+    return [
+        ["Python objects", python_count, python_size],
+        ["Free in malloc arenas", malloc["ordblks"] if malloc else 0, free],
+        [
+            "Native allocations and other anonymous memory",
+            0,
+            anonymous - free - python_size,
+        ],
+        ["File-backed mappings", 0, max(rollup["Rss"] - anonymous, 0)],
+    ]
+
+
+def native_pages(result):
+    """
+    The native memory and mapping pages for the analysis `result`, from the
+    malloc statistics it carries and the process's smaps.
+    """
+    rows = result.data or []
+    malloc = result.metadata.get("malloc")
+    rollup = read_rollup(result.pid)
+    reconciled = reconcile(
+        rollup,
+        malloc,
+        sum(row[2] for row in rows),
+        sum(row[1] for row in rows),
+    )
+    metadata = {"rollup": rollup, "malloc": malloc}
+    if malloc is None:
+        metadata["warning"] = "The process did not report malloc statistics"
+    return [
+        analysis_utils.extra_page(
+            result.pid,
+            {"title": "Native Memory", "rows": reconciled, "metadata": metadata},
+        ),
+        analysis_utils.extra_page(
+            result.pid,
+            {
+                "title": "Memory Mappings",
+                "rows": mapping_rows(result.pid),
+                "metadata": {"columns": list(SMAPS_FIELDS[1:])},
+                "size_columns": range(3, 2 + len(SMAPS_FIELDS)),
+            },
+        ),
+    ]
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Columnar snapshot file format.
+
+    header   MAGIC, version (u16), flags (u16), index offset (u64), index size (u64)
+    pages    one block per column per page, optionally zlib compressed:
+               names    utf-8 type names, back to back
+               offsets  u64 end offset of every name in `names`
+               counts   i64 per row
+               sizes    i64 per row
+               extras   JSON list of the columns past the third of every row,
+                        back to back, empty for rows with only three
+               extra_offsets  u64 end offset of every row's JSON in `extras`
+    index    JSON list with the pid, title, metadata, row count, widest name,
+             largest count and size, width of the widest cell of every extra
+             column and the (offset, length) of each column block of every page
+
+Rows are stored sorted by size, largest first (or by the column named by the
+page's "sort_column" metadata), so the top N rows of a page can be read by
+decoding only the first N entries of each column. The file is
+memory-mapped when read, so a page's rows are decoded only when asked for. Files that
+don't start with MAGIC are read as the old back-to-back pickles.
+"""
+
+import json
+import mmap
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+
+from . import analysis_utils
+
+MAGIC = b"MEMANZSN"
+VERSION = 1
+HEADER = struct.Struct("<8sHHQQ")
+FLAG_ZLIB = 1
+READ_SIZE = 1 << 16
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def to_disk(arr):
+    """
+    The bytes of `arr`, little-endian whatever the platform.
+    """
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def from_disk(typecode, data):
+    """
+    An array of `typecode` from little-endian `data`.
+    """
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+def is_snapshot_file(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_snapshot(filename, pages, compress=True):
+    """
+    Write `pages` (RetrievedObjects) to `filename` in the columnar format.
+    """
+    index = []
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))
+        for page in pages:
+            index.append(_write_page(f, page, compress))
+        index_offset = f.tell()
+        index_bytes = json.dumps(index).encode()
+        f.write(index_bytes)
+        f.seek(0)
+        flags = FLAG_ZLIB if compress else 0
+        f.write(HEADER.pack(MAGIC, VERSION, flags, index_offset, len(index_bytes)))
+
+
+def _write_page(f, page, compress):
+    column = getattr(page, "metadata", {}).get("sort_column", 2)
+    rows = sorted(page.data or [], key=lambda row: row[column], reverse=True)
+    names = [str(row[0]).encode() for row in rows]
+    extras = [json.dumps(row[3:]).encode() if len(row) > 3 else b"" for row in rows]
+    extra_widths = []
+    for row in rows:
+        for i, cell in enumerate(row[3:]):
+            if i == len(extra_widths):
+                extra_widths.append(0)
+            extra_widths[i] = max(extra_widths[i], len(str(cell)))
+    columns = {
+        "names": b"".join(names),
+        "offsets": to_disk(_end_offsets(names)),
+        "counts": to_disk(array("q", (int(row[1]) for row in rows))),
+        "sizes": to_disk(array("q", (int(row[2]) for row in rows))),
+        "extras": b"".join(extras),
+        "extra_offsets": to_disk(_end_offsets(extras)),
+    }
+    entry = {
+        "pid": page.pid,
+        "title": page.title,
+        "metadata": getattr(page, "metadata", {}),
+        "rows": len(rows),
+        "stats": {
+            "name_width": max((len(str(row[0])) for row in rows), default=0),
+            "max_count": max((abs(int(row[1])) for row in rows), default=0),
+            "max_size": max((abs(int(row[2])) for row in rows), default=0),
+            "extra_widths": extra_widths,
+        },
+        "compressed": compress,
+        "columns": {},
+    }
+    for name, data in columns.items():
+        if compress:
+            data = zlib.compress(data)
+        entry["columns"][name] = [f.tell(), len(data)]
+        f.write(data)
+    return entry
+
+
+def _end_offsets(blobs):
+    offsets = array("Q")
+    end = 0
+    for blob in blobs:
+        end += len(blob)
+        offsets.append(end)
+    return offsets
+
+
+class _Column:
+    """
+    One column block of a page, viewed straight from the mapped file.
+    Compressed blocks are only inflated as far as the rows read so far need.
+    """
+
+    def __init__(self, buf, compressed):
+        self.buf = buf
+        self.compressed = compressed
+        self.inflated = bytearray()
+        self.decompressor = zlib.decompressobj() if compressed else None
+        self.consumed = 0
+
+    def read(self, start, stop):
+        if not self.compressed:
+            return bytes(self.buf[start:stop])
+        while len(self.inflated) < stop and self.consumed < len(self.buf):
+            chunk = self.buf[self.consumed : self.consumed + READ_SIZE]
+            self.consumed += len(chunk)
+            self.inflated += self.decompressor.decompress(chunk)
+        return bytes(self.inflated[start:stop])
+
+    def read_all(self):
+        return self.read(0, sys.maxsize)
+
+
+class SnapshotPage:
+    """
+    A page of a snapshot file that decodes its rows on demand. Has the pid,
+    title and metadata of RetrievedObjects, and `rows(start, stop)` in place
+    of `data`.
+    """
+
+    def __init__(self, reader, entry, limit=None):
+        self.pid = entry["pid"]
+        self.title = entry["title"]
+        self.metadata = entry["metadata"]
+        self.stats = entry.get("stats", {})
+        # The width of the widest cell of every column past the third.
+        self.extra_widths = self.stats.get("extra_widths", [])
+        self.length = entry["rows"] if limit is None else min(limit, entry["rows"])
+        self.columns = {
+            name: _Column(reader.view(offset, length), entry["compressed"])
+            for name, (offset, length) in entry["columns"].items()
+        }
+
+    def __len__(self):
+        return self.length
+
+    def _numbers(self, name, typecode, start, stop):
+        return from_disk(typecode, self.columns[name].read(start * 8, stop * 8))
+
+    def _blobs(self, name, offsets_name, start, stop):
+        # The variable length entries `start` to `stop` of column `name`, whose
+        # end offsets are in `offsets_name`.
+        offsets = self._numbers(offsets_name, "Q", max(start - 1, 0), stop)
+        if start == 0:
+            offsets.insert(0, 0)
+        blob = self.columns[name].read(offsets[0], offsets[-1])
+        return [
+            blob[begin - offsets[0] : end - offsets[0]]
+            for begin, end in zip(offsets, offsets[1:])
+        ]
+
+    def _extras(self, start, stop):
+        return [
+            json.loads(extra) if extra else []
+            for extra in self._blobs("extras", "extra_offsets", start, stop)
+        ]
+
+    def rows(self, start=0, stop=None):
+        """
+        Decode rows `start` to `stop`, largest first.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        if start >= stop:
+            return []
+        names = self._blobs("names", "offsets", start, stop)
+        counts = self._numbers("counts", "q", start, stop)
+        sizes = self._numbers("sizes", "q", start, stop)
+        extras = self._extras(start, stop)
+        return [
+            [name.decode(), count, size] + extra
+            for name, count, size, extra in zip(names, counts, sizes, extras)
+        ]
+
+    def arrays(self):
+        """
+        The names, counts and sizes of all the rows, without building the rows.
+        """
+        names = [
+            name.decode() for name in self._blobs("names", "offsets", 0, self.length)
+        ]
+        counts = self._numbers("counts", "q", 0, self.length)
+        sizes = self._numbers("sizes", "q", 0, self.length)
+        return names, counts, sizes
+
+    def load(self):
+        return analysis_utils.RetrievedObjects(
+            pid=self.pid, title=self.title, data=self.rows(), metadata=self.metadata
+        )
+
+
+class SnapshotReader:
+    """
+    Random access to the pages of a snapshot file. The file is memory-mapped
+    and nothing but the header and index is decoded until a page is asked for.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError(f"{filename} is empty")
+        if len(self.map) < HEADER.size:
+            raise SnapshotError(f"{filename} is truncated")
+        magic, version, self.flags, offset, length = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise SnapshotError(f"{filename} is not a memory_analyzer snapshot")
+        if version > VERSION:
+            raise SnapshotError(
+                f"{filename} has version {version}, newer than {VERSION}"
+            )
+        try:
+            self.index = json.loads(self.map[offset : offset + length])
+        except ValueError as e:
+            raise SnapshotError(f"{filename} has a corrupt index: {e}")
+
+    def __len__(self):
+        return len(self.index)
+
+    def view(self, offset, length):
+        return memoryview(self.map)[offset : offset + length]
+
+    def pids(self):
+        return [entry["pid"] for entry in self.index]
+
+    def find(self, pid):
+        """
+        Positions of the pages belonging to `pid`.
+        """
+        return [
+            i for i, entry in enumerate(self.index) if str(entry["pid"]) == str(pid)
+        ]
+
+    def page(self, pos, limit=None):
+        """
+        Page `pos` as a SnapshotPage, only its `limit` largest rows if given.
+        """
+        return SnapshotPage(self, self.index[pos], limit)
+
+    def read_page(self, pos, limit=None):
+        """
+        Decode page `pos` as RetrievedObjects, only its `limit` largest rows if
+        given.
+        """
+        return self.page(pos, limit).load()
+
+    def pages(self, limit=None):
+        for pos in range(len(self)):
+            yield self.read_page(pos, limit)
+
+
+def read_pages(filename):
+    """
+    Yield every page of `filename`, in either the columnar or the old pickle
+    format.
+    """
+    if is_snapshot_file(filename):
+        yield from SnapshotReader(filename).pages()
+        return
+    with open(filename, "rb") as fd:
+        while True:
+            try:
+                yield pickle.load(fd)
+            except EOFError:
+                break
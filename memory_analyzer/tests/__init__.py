@@ -4,9 +4,18 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+from .test_agent_template import AgentTemplateTests
 from .test_analysis_template import ObjGraphTemplateTests
 from .test_analysis_utils import AnalysisUtilsTest
-from .test_curses import MemanzCursesTest
+from .test_buffers import ArrayBuffersTests
+from .test_core import CoreTests
+from .test_curses import MemanzCursesTest, TableTest
+from .test_diff_utils import DiffUtilsTest
 from .test_frontend import FrontendUtilsTest
 from .test_gdb_commands import GdbCommandsTests
+from .test_heapgraph import HeapGraphTests
+from .test_leaks import LeaksTests
 from .test_main_lib import FakeOSError, MainLibTests
+from .test_native import NativeTests
+from .test_snapshot_file import SnapshotFileTests
+from .test_timeseries import TimeSeriesStoreTests
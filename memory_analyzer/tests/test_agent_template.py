@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import gc
+import os
+import pickle
+import socket
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+from .. import analysis_utils
+
+
+class AgentTemplateTests(TestCase):
+    template_name = "agent.py.template"
+    templates_path = f"{os.path.abspath(os.path.dirname(__file__))}/../templates/"
+    pid = 1234
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.socket_path = os.path.join(self.tmpdir, "agent.sock")
+        patch_path = mock.patch.object(
+            analysis_utils, "agent_socket_path", return_value=self.socket_path
+        )
+        patch_path.start()
+        self.addCleanup(patch_path.stop)
+
+    def install(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            None,
+            socket_path=self.socket_path,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        written = bytearray(
+            b"".join(call[0][0] for call in mock_fifo().write.call_args_list)
+        )
+        return [pickle.loads(f) for f in analysis_utils.split_frames(written) if f]
+
+    def stop(self):
+        agent = sys._memory_analyzer_agent
+        self.assertEqual("stopped", analysis_utils.stop_agent(self.pid))
+        agent.join(5)
+
+    def send(self, source):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        payload = source.encode()
+        sock.sendall(analysis_utils.FRAME_HEADER.pack(len(payload)) + payload)
+        request = analysis_utils.AgentRequest(sock)
+        request.wait(5)
+        return request
+
+    def test_install_runs_payloads_and_stops(self):
+        frames = self.install()
+        self.addCleanup(lambda: os.path.exists(self.socket_path) and self.stop())
+        self.assertEqual(
+            [("meta", {"agent": self.socket_path, "agent_started": True})], frames
+        )
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+        self.assertTrue(analysis_utils.agent_available(self.pid))
+
+        out = os.path.join(self.tmpdir, "out")
+        request = self.send(f"with open({out!r}, 'w') as f: f.write(__name__)")
+        self.assertEqual(0, request.returncode)
+        with open(out) as f:
+            self.assertEqual("__memory_analyzer__", f.read())
+
+        request = self.send("raise ValueError('boom')")
+        self.assertEqual(1, request.returncode)
+        self.assertEqual("error ValueError('boom')", request.reply)
+
+        self.stop()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertFalse(analysis_utils.agent_available(self.pid))
+
+    def test_client_gone_before_the_reply(self):
+        self.install()
+        self.addCleanup(self.stop)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        payload = b"import time; time.sleep(0.2)"
+        sock.sendall(analysis_utils.FRAME_HEADER.pack(len(payload)) + payload)
+        sock.close()
+        request = self.send("pass")
+        self.assertEqual(0, request.returncode)
+        self.assertTrue(sys._memory_analyzer_agent.is_alive())
+
+    def test_refuses_clients_it_cannot_identify(self):
+        self.install()
+        self.addCleanup(self.stop)
+        out = os.path.join(self.tmpdir, "out")
+        with mock.patch.dict(socket.__dict__):
+            del socket.SO_PEERCRED
+            request = self.send(f"open({out!r}, 'w').close()")
+        self.assertEqual(1, request.returncode)
+        self.assertFalse(os.path.exists(out))
+
+    def test_socket_removed_at_exit(self):
+        with mock.patch("atexit.register") as mock_register:
+            self.install()
+        self.stop()
+        ((remove, path, owner), _) = mock_register.call_args
+        self.assertEqual((self.socket_path, os.getpid()), (path, owner))
+        open(path, "w").close()
+        # Not by children forked since.
+        remove(path, owner + 1)
+        self.assertTrue(os.path.exists(path))
+        remove(path, owner)
+        self.assertFalse(os.path.exists(path))
+
+    def test_payloads_told_the_agents_pid(self):
+        self.install()
+        self.addCleanup(self.stop)
+        out = os.path.join(self.tmpdir, "out")
+        self.send(f"with open({out!r}, 'w') as f: f.write(str(memanz_pid))")
+        with open(out) as f:
+            self.assertEqual(str(os.getpid()), f.read())
+
+    def test_install_twice_keeps_one_agent(self):
+        self.install()
+        self.addCleanup(self.stop)
+        agent = sys._memory_analyzer_agent
+        frames = self.install()
+        self.assertFalse(frames[0][1]["agent_started"])
+        self.assertIs(agent, sys._memory_analyzer_agent)
+
+    def test_collections_timed_while_installed(self):
+        self.install()
+        callbacks = list(gc.callbacks)
+        gc.collect()
+        timings = sys._memory_analyzer_gc_timings
+        self.assertEqual(1, timings[2]["collections"])
+        self.assertGreaterEqual(timings[2]["max_ms"], 0)
+        self.stop()
+        self.assertIsNone(sys._memory_analyzer_gc_timings)
+        self.assertEqual(len(callbacks) - 1, len(gc.callbacks))
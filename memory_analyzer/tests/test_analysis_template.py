@@ -4,17 +4,33 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import gc
 import os
 import pickle
 import sys
 import tempfile
+import tracemalloc
 from unittest import TestCase, mock
 
-import objgraph
-from jinja2 import Environment, FileSystemLoader
-from pympler import muppy, summary  # noqa
+from .. import analysis_utils, heapgraph
 
-from .. import analysis_utils
+
+def decode_frames(mock_fifo):
+    written = bytearray(
+        b"".join(call[0][0] for call in mock_fifo().write.call_args_list)
+    )
+    return [
+        pickle.loads(frame) if frame else None
+        for frame in analysis_utils.split_frames(written)
+    ]
+
+
+def decode_rows(mock_fifo):
+    rows = []
+    for frame in decode_frames(mock_fifo):
+        if frame and frame[0] == "rows":
+            rows.extend(frame[1])
+    return rows
 
 
 class ObjGraphTemplateTests(TestCase):
@@ -25,15 +41,24 @@ class ObjGraphTemplateTests(TestCase):
     specific_refs = ["str", "int"]
 
     def setUp(self):
-        self.items = [
-            ["builtins.test1", 1, 10000],
-            ["__main__.test2", 3, 5],
-            ["ast._things.test3", 10, 1024],
-        ]
-        # TODO: Add tests for summary obj and the _repr
-        mock_summ = mock.patch.object(summary, "summarize", return_value=self.items)
-        mock_summ.start()
-        self.addCleanup(mock_summ.stop)
+        # A tiny fake heap: two tracked lists sharing one large untracked str.
+        big = "x" * 10000
+        self.heap = [[big, 1], [big, 2]]
+        self.list_row = ["builtins.list", 2, 2 * sys.getsizeof(self.heap[0])]
+        self.str_row = ["builtins.str", 1, sys.getsizeof(big)]
+        self.int_row = ["builtins.int", 2, sys.getsizeof(1) + sys.getsizeof(2)]
+        # list_traverse visits items last to first, hence int before str.
+        self.items = [self.list_row, self.int_row, self.str_row]
+
+        def get_objects(generation=None):
+            return list(self.heap) if generation in (None, 2) else []
+
+        mock_get_objects = mock.patch.object(gc, "get_objects", side_effect=get_objects)
+        mock_get_objects.start()
+        self.addCleanup(mock_get_objects.stop)
+        mock_collect = mock.patch.object(gc, "collect")
+        mock_collect.start()
+        self.addCleanup(mock_collect.stop)
 
     def tearDown(self):
         if os.path.isfile(f"{self.templates_path}rendered_template.py.out"):
@@ -44,82 +69,444 @@ class ObjGraphTemplateTests(TestCase):
             self.template_name,
             self.templates_path,
             0,
-            self.pid,
             [],
             self.filename,
-            None,
         )
         with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
-            exec(template)
+            exec(template, {"memanz_pid": self.pid})
         mock_fifo.assert_called_with(f"/tmp/memanz_pipe_{self.pid}", "wb")
-        output_bytes = pickle.dumps(self.items)
-        mock_fifo().write.assert_called_with(output_bytes)
+        self.assertEqual(self.items, decode_rows(mock_fifo))
+        self.assertIsNone(decode_frames(mock_fifo)[-1])
 
-    @mock.patch.object(objgraph, "show_backrefs")
-    @mock.patch.object(objgraph, "show_refs")
-    def test_with_num_references(self, mock_refs, mock_back_refs):
-        dirname = "/tmp/tests/"
+    def test_malloc_stats(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        metas = [frame[1] for frame in decode_frames(mock_fifo)[:-1]]
+        malloc = [meta["malloc"] for meta in metas if "malloc" in meta]
+        if sys.platform.startswith("linux"):
+            self.assertGreater(malloc[0]["uordblks"], 0)
+            self.assertGreater(malloc[0]["arena"], 0)
+
+    def test_target_timings(self):
         template = analysis_utils.render_template(
             self.template_name,
             self.templates_path,
             1,
-            self.pid,
             [],
-            f"{dirname}{self.filename}",
-            None,
+            self.filename,
+            tracemalloc_top=0,
+            gc_generations=True,
         )
         with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
             exec(template, {})
-        handler = mock_fifo()
-        output_bytes = pickle.dumps(self.items)
-        handler.write.assert_called_with(output_bytes)
+        (timings,) = [
+            frame[1]["timings"]
+            for frame in decode_frames(mock_fifo)[:-1]
+            if frame[0] == "meta" and "timings" in frame[1]
+        ]
+        self.assertEqual(
+            [
+                "census",
+                "collect",
+                "malloc",
+                "walk",
+                "summarize",
+                "references",
+                "pickle",
+            ],
+            list(timings["target"]),
+        )
+        for ms in timings["target"].values():
+            self.assertGreaterEqual(ms, 0)
+
+    def test_gc_generations_page(self):
+        self.heap.append(self.heap[0])
+
+        def get_objects(generation=None):
+            # One list is young, the other and its twin are in the oldest
+            # generation.
+            return {0: self.heap[:1], 2: self.heap[1:]}.get(generation, [])
+
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            gc_generations=True,
+        )
+        with mock.patch.object(gc, "get_objects", side_effect=get_objects):
+            with mock.patch(
+                "builtins.open", mock.mock_open(), create=True
+            ) as mock_fifo:
+                exec(template, {})
+        (page,) = [
+            frame[1]
+            for frame in decode_frames(mock_fifo)[:-1]
+            if frame[0] == "page" and frame[1]["title"] == "GC Generations"
+        ]
+        size = sys.getsizeof(self.heap[0])
+        # Three tracked lists, two of them in generation 2 holding two
+        # references each.
+        self.assertEqual([["builtins.list", 3, 3 * size, 1, 0, 2, 4]], page["rows"])
+        metadata = page["metadata"]
+        self.assertEqual(
+            ["Gen 0", "Gen 1", "Gen 2", "Gen 2 references"], metadata["columns"]
+        )
+        self.assertEqual(5, metadata["sort_column"])
+        self.assertEqual(gc.get_threshold(), metadata["gc"]["thresholds"])
+        self.assertEqual(3, len(metadata["gc"]["stats"]))
+
+    def test_gc_generations_census_honours_the_deadline(self):
+        def get_objects(generation=None):
+            return {0: self.heap[:1], 2: self.heap[1:]}.get(generation, [])
+
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            gc_generations=True,
+            deadline_ms=15,
+        )
+        clock = iter(range(0, 1000, 10))
+        with mock.patch.object(gc, "get_objects", side_effect=get_objects), mock.patch(
+            "time.perf_counter", lambda: next(clock) / 1000
+        ), mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        (page,) = [
+            frame[1] for frame in decode_frames(mock_fifo)[:-1] if frame[0] == "page"
+        ]
+        # The deadline passed before the oldest generation was listed.
+        self.assertEqual("GC Generations (partial)", page["title"])
+        size = sys.getsizeof(self.heap[0])
+        self.assertEqual([["builtins.list", 1, size, 1, 0, 0, 0]], page["rows"])
+        self.assertTrue(decode_frames(mock_fifo)[1][1]["pause"]["partial"])
+
+    def test_no_gc_generations_page_by_default(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        self.assertNotIn("page", [frame[0] for frame in decode_frames(mock_fifo)[:-1]])
+
+    def test_array_buffers_counted_once(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        base = np.zeros(1000)
+        views = [base[:10], base[500:]]
+        self.heap = [views]
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+        )
+        header = sys.getsizeof(base) - base.nbytes
+        del base
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        rows = {row[0]: row[1:] for row in decode_rows(mock_fifo)}
+        # Both views, and their base that only they hold.
+        self.assertEqual(
+            [3, 2 * sys.getsizeof(views[0]) + header + 8000], rows["numpy.ndarray"]
+        )
+        kind, page = decode_frames(mock_fifo)[-2]
+        self.assertEqual("Arrays", page["title"])
+        self.assertEqual(
+            [["float64 [1000]", 1, 8000, 8000], ["float64 [500]", 1, 4000, 0]],
+            page["rows"][:2],
+        )
+
+    def test_heap_walk_in_small_chunks(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            walk_chunk_size=1,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        self.assertEqual(sorted(self.items), sorted(decode_rows(mock_fifo)))
+        self.assertTrue(gc.isenabled())
+        kind, meta = decode_frames(mock_fifo)[0]
+        self.assertEqual("meta", kind)
+        self.assertEqual(5, meta["objects_walked"])
+        self.assertGreater(meta["peak_overhead_bytes"], 0)
+
+    def test_sampled_heap_walk(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            sample_rate=0.999999,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        rows = {row[0]: row for row in decode_rows(mock_fifo)}
+        self.assertEqual(self.list_row, rows["builtins.list"])
+        # The shared str is reached through both lists, but counted once.
+        self.assertEqual(self.str_row, rows["builtins.str"])
+        kind, meta = decode_frames(mock_fifo)[0]
+        self.assertEqual(0.999999, meta["sampling"]["rate"])
+        self.assertEqual(set(rows), set(meta["sampling"]["errors"]))
+
+    def test_pause_budget_yields_between_slices(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            walk_chunk_size=1,
+            max_pause_ms=5,
+        )
+        clock = iter(range(0, 1000, 10))
+        with mock.patch("time.perf_counter", lambda: next(clock) / 1000), mock.patch(
+            "time.sleep"
+        ) as mock_sleep, mock.patch(
+            "builtins.open", mock.mock_open(), create=True
+        ) as mock_fifo:
+            exec(template, {})
+        gc.collect.assert_not_called()
+        mock_sleep.assert_called_with(0.005)
+        self.assertEqual(self.items, decode_rows(mock_fifo))
+        pause = decode_frames(mock_fifo)[1][1]["pause"]
+        self.assertEqual(mock_sleep.call_count + 1, pause["slices"])
+        self.assertFalse(pause["partial"])
+
+    def test_deadline_returns_partial_results(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            walk_chunk_size=1,
+            deadline_ms=15,
+        )
+        clock = iter(range(0, 1000, 10))
+        with mock.patch("time.perf_counter", lambda: next(clock) / 1000), mock.patch(
+            "builtins.open", mock.mock_open(), create=True
+        ) as mock_fifo:
+            exec(template, {})
+        # Only the last list was walked before the deadline.
         self.assertEqual(
-            self.items,
             [
-                [
-                    "builtins.test1",
-                    1,
-                    10000,
-                    f"{dirname}ref_1234_test1.png",
-                    f"{dirname}backref_1234_test1.png",
-                ],
-                ["ast._things.test3", 10, 1024],
-                ["__main__.test2", 3, 5],
+                ["builtins.list", 1, sys.getsizeof(self.heap[1])],
+                ["builtins.int", 1, sys.getsizeof(2)],
+                self.str_row,
             ],
+            decode_rows(mock_fifo),
+        )
+        self.assertTrue(decode_frames(mock_fifo)[1][1]["pause"]["partial"])
+
+    def test_rows_sent_in_batches(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            batch_size=2,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        frames = decode_frames(mock_fifo)
+        self.assertEqual(
+            [("rows", self.items[:2]), ("rows", self.items[2:]), None], frames[-3:]
         )
 
-    @mock.patch.object(objgraph, "show_backrefs")
-    @mock.patch.object(objgraph, "show_refs")
-    def test_with_specific_references(self, mock_refs, mock_back_refs):
-        dirname = "/tmp/tests/"
+    def test_retained_sizes_page(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            retained_top=2,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        self.assertEqual(self.items, decode_rows(mock_fifo))
+        kind, page = decode_frames(mock_fifo)[-2]
+        self.assertEqual("page", kind)
+        self.assertEqual("Retained Sizes", page["title"])
+        self.assertEqual(["Own Size"], page["metadata"]["columns"])
+        self.assertFalse(page["metadata"]["graph"]["truncated"])
+        # Both lists share the str, so each only retains itself and its int.
+        self.assertEqual(
+            [f"builtins.str at {id(self.heap[0][0]):#x}", 1, self.str_row[2]],
+            page["rows"][0][:3],
+        )
+        self.assertEqual(2, len(page["rows"]))
+
+    def test_graph_dump_mode(self):
         with tempfile.TemporaryDirectory() as d:
+            output_path = os.path.join(d, "snapshot")
+            dump = f"{output_path}.{self.pid}.graph"
             template = analysis_utils.render_template(
                 self.template_name,
                 self.templates_path,
                 0,
-                self.pid,
-                ["test3"],
-                f"{dirname}{self.filename}",
-                d,
+                [],
+                self.filename,
+                graph_dump_path=output_path,
             )
+            real_open = open
+            mock_fifo = mock.mock_open()
+
+            def fake_open(filename, mode="r"):
+                if filename == dump:
+                    return real_open(filename, mode)
+                return mock_fifo(filename, mode)
+
+            with mock.patch("builtins.open", fake_open, create=True):
+                exec(template, {"memanz_pid": self.pid})
+            frames = decode_frames(mock_fifo)
+            self.assertEqual([], decode_rows(mock_fifo))
+            self.assertEqual(("meta", {"graph_dump": dump}), frames[-2])
+            graph = heapgraph.GraphDump(dump)
+            self.assertEqual({"pid": self.pid}, graph.info)
+            self.assertEqual(sorted(self.items), sorted(graph.type_rows()))
+            del graph
+
+    def test_with_num_references(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            1,
+            [],
+            self.filename,
+        )
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        # The str is only held by the lists, which the test holds.
+        path = (
+            f"builtins.list at {id(self.heap[0]):#x} -> "
+            f"builtins.str at {id(self.heap[0][0]):#x}"
+        )
+        self.assertEqual(
+            decode_rows(mock_fifo),
+            [self.str_row + ["", path], self.list_row, self.int_row],
+        )
+
+    def test_with_specific_references(self):
+        with tempfile.TemporaryDirectory() as d:
+            template = analysis_utils.render_template(
+                self.template_name,
+                self.templates_path,
+                0,
+                ["int", "list"],
+                self.filename,
+            )
+            for _ in range(2):
+                analysis_utils.write_payload(d, self.template_name, template)
             self.assertEqual(1, len(os.listdir(d)), os.listdir(d))
 
         with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
             exec(template, {})
-        handler = mock_fifo()
-        output_bytes = pickle.dumps(self.items)
-        handler.write.assert_called_with(output_bytes)
+        list_row, int_row, str_row = decode_rows(mock_fifo)
+        self.assertEqual(self.str_row, str_row)
+        # Small ints are shared with the whole interpreter, so are roots.
+        self.assertEqual(self.int_row + [""], int_row[:4])
+        self.assertIn(int_row[4], [f"builtins.int at {id(i):#x}" for i in (1, 2)])
+        self.assertEqual(self.list_row + ["builtins.int, builtins.str"], list_row[:4])
+        self.assertIn(
+            list_row[4], [f"builtins.list at {id(item):#x}" for item in self.heap]
+        )
+
+    def test_allocation_sites_page(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+            tracemalloc_top=3,
+            tracemalloc_group="traceback",
+        )
+        # Compiled as gdb would, so that the payload's own code isn't traced.
+        code = compile(template, "<string>", "exec")
+        tracemalloc.start(2)
+        self.addCleanup(tracemalloc.stop)
+        block = bytearray(1 << 20)
+        line = sys._getframe().f_lineno - 1
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(code, {})
+        kind, page = decode_frames(mock_fifo)[-2]
+        self.assertEqual("page", kind)
+        self.assertEqual("Allocation Sites", page["title"])
+        self.assertEqual(3, len(page["rows"]))
+        site, _, size = page["rows"][0]
+        # The most recent frame comes first.
+        self.assertTrue(site.startswith(f"{__file__}:{line} <- "), site)
+        self.assertGreaterEqual(size, len(block))
+        metadata = page["metadata"]["tracemalloc"]
+        self.assertEqual(2, metadata["frames"])
+        self.assertEqual("traceback", metadata["group"])
+        self.assertGreaterEqual(metadata["traced"], len(block))
+
+    def test_no_allocation_sites_without_tracing(self):
+        template = analysis_utils.render_template(
+            self.template_name,
+            self.templates_path,
+            0,
+            [],
+            self.filename,
+        )
+        self.assertFalse(tracemalloc.is_tracing())
+        with mock.patch("builtins.open", mock.mock_open(), create=True) as mock_fifo:
+            exec(template, {})
+        titles = [
+            frame[1]["title"]
+            for frame in decode_frames(mock_fifo)[:-1]
+            if frame[0] == "page"
+        ]
+        self.assertNotIn("Allocation Sites", titles)
+
+    def test_trace_start_and_stop(self):
+        self.addCleanup(tracemalloc.stop)
+        statuses = []
+        for start in (True, True, False):
+            template = analysis_utils.render_template(
+                "tracemalloc.py.template",
+                self.templates_path,
+                0,
+                [],
+                None,
+                start=start,
+                frames=3,
+            )
+            with mock.patch(
+                "builtins.open", mock.mock_open(), create=True
+            ) as mock_fifo:
+                exec(template, {})
+            (kind, meta), end = decode_frames(mock_fifo)
+            self.assertEqual(("meta", None), (kind, end))
+            statuses.append(meta["tracemalloc"])
         self.assertEqual(
-            self.items,
-            [
-                ["builtins.test1", 1, 10000],
-                ["__main__.test2", 3, 5],
-                [
-                    "ast._things.test3",
-                    10,
-                    1024,
-                    f"{dirname}ref_1234_test3.png",
-                    f"{dirname}backref_1234_test3.png",
-                ],
-            ],
+            [(False, True), (True, True), (True, False)],
+            [(status["was_tracing"], status["tracing"]) for status in statuses],
         )
+        self.assertEqual(3, statuses[1]["frames"])
@@ -4,10 +4,14 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import json
 import os
 import pickle
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 from unittest import TestCase, mock
 
 from .. import analysis_utils
@@ -21,6 +25,8 @@ class AnalysisUtilsTest(TestCase):
         self.gdb = analysis_utils.GDBObject(
             self.PID, self.CURRENT_PATH, sys.executable, "/tmp"
         )
+        self.payload = "/tmp/analysis-0123456789abcdef.py"
+        self.gdb.payload_path = self.payload
         self.filepath = os.path.abspath(
             f"{os.path.dirname(__file__)}/../gdb_commands.py"
         )
@@ -52,7 +58,10 @@ class AnalysisUtilsTest(TestCase):
             "-x",
             f"{self.filepath}",
         ]
-        mock_sub.assert_called_with(cmd_list, stderr=subprocess.DEVNULL)
+        mock_sub.assert_called_with(cmd_list, stderr=subprocess.DEVNULL, env=mock.ANY)
+        env = mock_sub.call_args[1]["env"]
+        self.assertEqual("/tmp", env["MEMORY_ANALYZER_TEMPLATES_PATH"])
+        self.assertEqual(self.payload, env["MEMORY_ANALYZER_PAYLOAD"])
         calls = [
             mock.call(f"Analyzing pid {self.PID}"),
             mock.call(f"Setting up GDB for pid {self.PID}"),
@@ -81,41 +90,321 @@ class AnalysisUtilsTest(TestCase):
             "-x",
             f"{self.filepath}",
         ]
-        mock_sub.assert_called_with(cmd_list, stderr=sys.stderr)
+        mock_sub.assert_called_with(cmd_list, stderr=sys.stderr, env=mock.ANY)
         calls = [
             mock.call(f"Analyzing pid {self.PID}"),
             mock.call(f"Setting up GDB for pid {self.PID}"),
         ]
         self.mock_info.assert_has_calls(calls)
 
-    @mock.patch("memory_analyzer.analysis_utils.pickle.load")
+    @mock.patch("memory_analyzer.analysis_utils.pickle.loads")
     @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
     def test_unpickle_pipe_errors(self, mock_echo, mock_pickle):
         mock_pickle.side_effect = NameError("Random Exception")
         with self.assertRaises(NameError):
-            self.gdb.unpickle_pipe("Fifo Data")
+            self.gdb.unpickle_pipe([b"Fifo Data"])
         mock_echo.assert_called_with(
             "NameError occurred during analysis: Random Exception"
         )
 
-    @mock.patch("memory_analyzer.analysis_utils.pickle.load")
+    @mock.patch("memory_analyzer.analysis_utils.pickle.loads")
     @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
     def test_unpickle_pipe_unpickle_errors(self, mock_echo, mock_pickle):
         mock_pickle.side_effect = pickle.UnpicklingError("Error")
         with self.assertRaises(pickle.UnpicklingError):
-            self.gdb.unpickle_pipe("Fifo Data")
+            self.gdb.unpickle_pipe([b"Fifo Data"])
         mock_echo.assert_called_with("Error retrieving data from process: Error")
 
-    @mock.patch("memory_analyzer.analysis_utils.pickle.load")
+    @mock.patch("memory_analyzer.analysis_utils.pickle.loads")
     @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
     def test_read_items_exception(self, mock_echo, mock_pickle):
-        mock_pickle.return_value = AttributeError("Whats up")
+        mock_pickle.return_value = ("error", AttributeError("Whats up"))
         with self.assertRaises(AttributeError):
-            self.gdb.unpickle_pipe("Fifo Data")
+            self.gdb.unpickle_pipe([b"Fifo Data"])
         mock_echo.assert_called_with(
             "AttributeError occurred during analysis: Whats up"
         )
 
+    def test_unpickle_pipe_batches_and_metadata(self):
+        on_batch = mock.Mock()
+        frames = [
+            pickle.dumps(("rows", [["a", 1, 2]])),
+            pickle.dumps(("meta", {"key": "value"})),
+            pickle.dumps(("rows", [["b", 3, 4]])),
+        ]
+        items = self.gdb.unpickle_pipe(frames, on_batch)
+        self.assertEqual([["a", 1, 2], ["b", 3, 4]], items)
+        self.assertEqual({"key": "value"}, self.gdb.metadata)
+        on_batch.assert_has_calls(
+            [mock.call(self.PID, [["a", 1, 2]]), mock.call(self.PID, [["b", 3, 4]])]
+        )
+
+    def test_unpickle_pipe_collects_pages(self):
+        frames = [
+            pickle.dumps(("rows", [["a", 1, 2]])),
+            pickle.dumps(
+                (
+                    "page",
+                    {
+                        "title": "Retained Sizes",
+                        "rows": [["a at 0x1", 3, 4096, 2048]],
+                        "metadata": {"columns": ["Own Size"]},
+                        "size_columns": [3],
+                    },
+                )
+            ),
+        ]
+        self.assertEqual([["a", 1, 2]], self.gdb.unpickle_pipe(frames))
+        (page,) = self.gdb.metadata["pages"]
+        self.assertEqual(f"Retained Sizes for {self.PID}", page.title)
+        self.assertEqual([["a at 0x1", 3, 4096, "2.00   KB"]], page.data)
+        self.assertEqual({"columns": ["Own Size"]}, page.metadata)
+
+    def test_split_frames_keeps_partial_frame(self):
+        first = pickle.dumps(("rows", []))
+        header = analysis_utils.FRAME_HEADER
+        buf = bytearray(header.pack(len(first)) + first + header.pack(10) + b"abc")
+        self.assertEqual([first], list(analysis_utils.split_frames(buf)))
+        self.assertEqual(header.pack(10) + b"abc", bytes(buf))
+        buf += b"defghij" + header.pack(0)
+        self.assertEqual([b"abcdefghij", b""], list(analysis_utils.split_frames(buf)))
+        self.assertEqual(b"", bytes(buf))
+
+    def test_read_frames_stops_at_end_of_stream(self):
+        read_fd, write_fd = os.pipe()
+        header = analysis_utils.FRAME_HEADER
+        os.write(write_fd, header.pack(3) + b"abc" + header.pack(0) + b"junk")
+        process = mock.Mock()
+        process.poll.return_value = None
+        try:
+            frames = list(self.gdb._read_frames(read_fd, process))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEqual([b"abc"], frames)
+
+    def test_run_analysis_records_timings(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            gdb = analysis_utils.GDBObject(
+                os.getpid(), self.CURRENT_PATH, sys.executable, out_dir
+            )
+            gdb_timings = analysis_utils.gdb_timings_path(out_dir, os.getpid())
+            with open(gdb_timings, "w") as f:
+                # As gdb_commands.py writes them.
+                json.dump(
+                    {"attached": time.time() + 1, "gil_ensure": 1.5, "payload": 20}, f
+                )
+            payload = b"".join(
+                analysis_utils.FRAME_HEADER.pack(len(frame)) + frame
+                for frame in [
+                    pickle.dumps(("meta", {"timings": {"target": {"walk": 12.5}}})),
+                    pickle.dumps(("rows", [["a", 1, 2]])),
+                    b"",
+                ]
+            )
+
+            def start(debug):
+                writer = subprocess.Popen(
+                    [
+                        sys.executable,
+                        "-c",
+                        "import sys; open(sys.argv[1], 'wb').write(sys.stdin.buffer.read())",
+                        gdb.fifo,
+                    ],
+                    stdin=subprocess.PIPE,
+                )
+                writer.stdin.write(payload)
+                writer.stdin.close()
+                return writer
+
+            with mock.patch.object(gdb, "_start", side_effect=start):
+                result = gdb.run_analysis()
+            self.assertFalse(os.path.exists(gdb_timings))
+        timings = result.metadata["timings"]
+        self.assertEqual(["analyzer", "gdb", "target"], list(timings))
+        self.assertEqual(
+            ["start", "wait", "unpickle", "drain", "exit", "total"],
+            list(timings["analyzer"]),
+        )
+        self.assertEqual(
+            result.metadata["backend"]["elapsed_ms"], timings["analyzer"]["total"]
+        )
+        self.assertAlmostEqual(1000, timings["gdb"]["attach"], delta=500)
+        self.assertEqual(1.5, timings["gdb"]["gil_ensure"])
+        self.assertEqual({"walk": 12.5}, timings["target"])
+
+    @mock.patch("memory_analyzer.analysis_utils.socket.socket")
+    def test_agent_object_sends_rendered_payload(self, mock_socket):
+        with mock.patch("builtins.open", mock.mock_open(read_data="payload")) as m:
+            agent = analysis_utils.AgentObject(
+                self.PID, self.CURRENT_PATH, sys.executable, "/tmp"
+            )
+            agent.payload_path = self.payload
+            request = agent._start(debug=False)
+        m.assert_called_with(self.payload)
+        sock = mock_socket.return_value
+        sock.connect.assert_called_with(analysis_utils.agent_socket_path(self.PID))
+        sock.sendall.assert_called_with(
+            analysis_utils.FRAME_HEADER.pack(len(b"payload")) + b"payload"
+        )
+        self.assertIsInstance(request, analysis_utils.AgentRequest)
+
+    def test_agent_request_finishes_on_reply(self):
+        ours, theirs = socket.socketpair()
+        request = analysis_utils.AgentRequest(ours)
+        self.assertIsNone(request.poll())
+        theirs.sendall(b"ok\n")
+        self.assertEqual(0, request.poll())
+        theirs.close()
+
+    def test_agent_request_wait_times_out(self):
+        ours, theirs = socket.socketpair()
+        request = analysis_utils.AgentRequest(ours)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            request.wait(0.01)
+        request.kill()
+        self.assertEqual(-9, request.poll())
+        theirs.close()
+
+    @mock.patch("memory_analyzer.analysis_utils.subprocess.Popen", autospec=True)
+    def test_minimal_gdb_reads_no_symbols(self, mock_sub):
+        gdb = analysis_utils.injector(
+            "gdb-minimal", self.PID, self.CURRENT_PATH, None, "/tmp"
+        )
+        self.assertIsInstance(gdb, analysis_utils.MinimalGDBObject)
+        gdb._start(debug=False)
+        command = mock_sub.call_args[0][0]
+        self.assertEqual(
+            [
+                "gdb",
+                "-q",
+                "--readnever",
+                "-iex",
+                "set debuginfod enabled off",
+                "-p",
+                f"{self.PID}",
+            ],
+            command[:7],
+        )
+        self.assertEqual(f"{self.filepath}", command[-1])
+
+    def test_injector_defaults(self):
+        gdb = analysis_utils.injector("gdb", self.PID, self.CURRENT_PATH, None, "/tmp")
+        self.assertIs(type(gdb), analysis_utils.GDBObject)
+        self.assertEqual(f"{sys.executable}-dbg", gdb.executable)
+        remote = analysis_utils.injector(
+            "remote-exec", self.PID, self.CURRENT_PATH, None, "/tmp"
+        )
+        self.assertIsInstance(remote, analysis_utils.RemoteExecObject)
+        self.assertEqual(sys.executable, remote.executable)
+        gdb = analysis_utils.injector(
+            "gdb", self.PID, self.CURRENT_PATH, "/usr/bin/python3-dbg", "/tmp"
+        )
+        self.assertEqual("/usr/bin/python3-dbg", gdb.executable)
+
+    @mock.patch("memory_analyzer.analysis_utils.subprocess.Popen", autospec=True)
+    def test_remote_exec_schedules_rendered_payload(self, mock_sub):
+        remote = analysis_utils.RemoteExecObject(
+            self.PID, self.CURRENT_PATH, sys.executable, "/tmp"
+        )
+        with tempfile.TemporaryDirectory() as out_dir:
+            payload = os.path.join(out_dir, "analysis-0123456789abcdef.py")
+            with open(payload, "w") as f:
+                f.write("import sys; sys.ran = __name__")
+            remote.payload_path = payload
+            request = remote._start(debug=False)
+            command = mock_sub.call_args[0][0]
+            self.assertEqual(sys.executable, command[0])
+            self.assertIn("sys.remote_exec", command[2])
+            self.assertEqual(str(self.PID), command[3])
+            # What the target runs is a stub that runs the payload in globals
+            # of its own.
+            main = {"__name__": "__main__"}
+            with open(command[4]) as f:
+                exec(f.read(), main)
+            self.assertEqual(["__builtins__", "__name__"], sorted(main))
+            self.assertEqual("__memory_analyzer__", sys.ran)
+            del sys.ran
+        self.assertIsInstance(request, analysis_utils.RemoteExecRequest)
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
+    def test_remote_exec_request(self, mock_error):
+        # Scheduled: the payload still has to run and end the stream.
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+        request = analysis_utils.RemoteExecRequest(proc)
+        self.assertIsNone(request.poll())
+        self.assertTrue(request.scheduled)
+        proc = subprocess.Popen(
+            [sys.executable, "-c", "raise SystemExit('no remote_exec')"],
+            stderr=subprocess.PIPE,
+        )
+        proc.wait()
+        request = analysis_utils.RemoteExecRequest(proc)
+        self.assertEqual(1, request.poll())
+        mock_error.assert_called_with("sys.remote_exec failed: no remote_exec")
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
+    def test_remote_exec_payload_that_never_runs_times_out(self, mock_error):
+        remote = analysis_utils.RemoteExecObject(
+            os.getpid(), self.CURRENT_PATH, sys.executable, "/tmp"
+        )
+        remote.timeout_s = 0.2
+
+        def start(debug):
+            # Scheduled fine, but nothing will ever write to the FIFO.
+            return analysis_utils.RemoteExecRequest(
+                subprocess.Popen([sys.executable, "-c", "pass"])
+            )
+
+        with mock.patch.object(remote, "_start", side_effect=start):
+            with self.assertRaises(SystemExit):
+                remote.run_analysis()
+        self.assertIn("sent no complete results within 0.2s", str(mock_error.call_args))
+
+    def test_render_template_once_per_options(self):
+        templates_path = f"{self.CURRENT_PATH}/templates/"
+        first = analysis_utils.render_template(
+            "tracemalloc.py.template", templates_path, 0, [], None, start=True
+        )
+        again = analysis_utils.render_template(
+            "tracemalloc.py.template", templates_path, 0, [], None, start=True
+        )
+        other = analysis_utils.render_template(
+            "tracemalloc.py.template", templates_path, 0, [], None, start=False
+        )
+        self.assertIs(first, again)
+        self.assertNotEqual(first, other)
+        self.assertIs(
+            analysis_utils.load_template("tracemalloc.py.template", templates_path),
+            analysis_utils.load_template("tracemalloc.py.template", templates_path),
+        )
+
+    def test_payloads_written_once_and_cleaned(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            path = analysis_utils.write_payload(out_dir, "agent.py.template", "a")
+            self.assertEqual(
+                path, analysis_utils.write_payload(out_dir, "agent.py.template", "a")
+            )
+            self.assertTrue(os.path.basename(path).startswith("agent-"))
+            stale = analysis_utils.write_payload(out_dir, "agent.py.template", "b")
+            week_ago = time.time() - analysis_utils.PAYLOAD_MAX_AGE_S - 1
+            os.utime(stale, (week_ago, week_ago))
+            analysis_utils.clean_payloads(out_dir)
+            self.assertEqual([os.path.basename(path)], os.listdir(out_dir))
+            with open(path) as f:
+                self.assertEqual("a", f.read())
+
+    def test_payload_dir_is_private(self):
+        path = analysis_utils.payload_dir()
+        self.assertEqual(path, analysis_utils.payload_dir())
+        info = os.stat(path)
+        self.assertEqual(os.getuid(), info.st_uid)
+        self.assertEqual(0, info.st_mode & 0o077)
+
+    def test_agent_not_available_without_socket(self):
+        self.assertFalse(analysis_utils.agent_available(-1))
+
     @mock.patch("memory_analyzer.analysis_utils.pickle.load")
     @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
     def test_snapshot_diff_error(self, mock_echo, mock_pickle):
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sys
+from unittest import TestCase, skipUnless
+
+from .. import buffers
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@skipUnless(np is not None, "numpy is not installed")
+class ArrayBuffersTests(TestCase):
+    def corrections(self, arrays, seen=()):
+        array_buffers = buffers.ArrayBuffers.for_target()
+        array_buffers.arrays.extend(arrays)
+        return array_buffers, array_buffers.corrections(set(seen))
+
+    def test_owning_array_is_unchanged(self):
+        a = np.zeros(1000)
+        _, changes = self.corrections([a])
+        self.assertEqual({np.ndarray: [0, 0]}, changes)
+
+    def test_views_count_the_buffer_once(self):
+        a = np.zeros(1000)
+        array_buffers, changes = self.corrections([a, a[10:], a[::2], a[:500]])
+        self.assertEqual({np.ndarray: [0, 0]}, changes)
+        self.assertEqual(a.nbytes, array_buffers.stats["buffer_bytes"])
+        self.assertEqual(4, array_buffers.stats["arrays"])
+
+    def test_base_only_held_by_views_is_counted(self):
+        view = np.zeros(1000)[100:200]
+        _, changes = self.corrections([view])
+        header = sys.getsizeof(view.base) - view.base.nbytes
+        self.assertEqual({np.ndarray: [1, header + view.base.nbytes]}, changes)
+
+    def test_views_of_bytes(self):
+        data = b"x" * 8000
+        views = [np.frombuffer(data, dtype=np.int64), np.frombuffer(data)[:10]]
+        # The walk already counted the bytes object, with its data.
+        _, changes = self.corrections(views, seen=[id(data)])
+        self.assertEqual({}, changes)
+        # Otherwise it is counted once here.
+        _, changes = self.corrections(views)
+        self.assertEqual({bytes: [1, sys.getsizeof(data)]}, changes)
+
+    def test_views_of_mmap(self):
+        import gc
+        import mmap
+
+        region = mmap.mmap(-1, 1 << 16)
+        view = np.frombuffer(region, dtype=np.uint8)
+        _, changes = self.corrections([view, view[::-1]])
+        # Its size leaves out the mapping, which goes to it here. The walk
+        # counted it already if it is tracked.
+        expected = [0, 0] if gc.is_tracked(region) else [1, sys.getsizeof(region)]
+        expected[1] += 1 << 16
+        self.assertEqual({mmap.mmap: expected}, changes)
+
+    def test_strided_extent(self):
+        a = np.zeros((10, 10))
+        array_buffers = buffers.ArrayBuffers(np)
+        low, high = array_buffers._extent(a[::-1, 2:5])
+        start = a.__array_interface__["data"][0]
+        self.assertEqual((start + 2 * 8, start + 9 * 80 + 5 * 8), (low, high))
+
+    def test_page(self):
+        arrays = [np.zeros((4, 4), np.float32) for _ in range(3)]
+        arrays.append(arrays[0][1:])
+        arrays.append(np.arange(10))
+        array_buffers, _ = self.corrections(arrays)
+        page = array_buffers.page(2)
+        self.assertEqual("Arrays", page["title"])
+        self.assertEqual(
+            [["float32 [4, 4]", 3, 3 * 64, 3 * 64], ["int64 [10]", 1, 80, 80]],
+            page["rows"],
+        )
+        self.assertEqual(3, page["metadata"]["buffers"]["groups"])
+        self.assertEqual([], array_buffers.arrays)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import gc
+import os
+import struct
+import sys
+import tempfile
+from unittest import TestCase, skipUnless
+
+from .. import core
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def note(n_type, desc, name=b"CORE"):
+    name += b"\0"
+    return (
+        core.NOTE_HEADER.pack(len(name), len(desc), n_type)
+        + name.ljust((len(name) + 3) & ~3, b"\0")
+        + desc.ljust((len(desc) + 3) & ~3, b"\0")
+    )
+
+
+def write_core(path, segments, notes):
+    """
+    An ELF core of the (address, bytes, flags) `segments`, with `notes`.
+    """
+    phnum = 1 + len(segments)
+    offset = core.ELF_HEADER.size + phnum * core.PROGRAM_HEADER.size
+    ident = b"\x7fELF\x02\x01\x01".ljust(16, b"\0")
+    headers = [
+        core.ELF_HEADER.pack(
+            ident,
+            core.ET_CORE,
+            62,
+            1,
+            0,
+            core.ELF_HEADER.size,
+            0,
+            0,
+            core.ELF_HEADER.size,
+            core.PROGRAM_HEADER.size,
+            phnum,
+            0,
+            0,
+            0,
+        ),
+        core.PROGRAM_HEADER.pack(core.PT_NOTE, 0, offset, 0, 0, len(notes), 0, 4),
+    ]
+    offset += len(notes)
+    for address, data, flags in segments:
+        headers.append(
+            core.PROGRAM_HEADER.pack(
+                core.PT_LOAD, flags, offset, address, 0, len(data), len(data), 4096
+            )
+        )
+        offset += len(data)
+    with open(path, "wb") as f:
+        f.writelines(headers)
+        f.write(notes)
+        for _, data, _ in segments:
+            f.write(data)
+
+
+def write_self_core(path):
+    """
+    A core of this process, as gcore would write it: its writable memory,
+    where its files are mapped, its entry point and its pid. The collector is
+    paused, so that the memory is read as of one moment.
+    """
+    segments, files = [], []
+    enabled = gc.isenabled()
+    gc.disable()
+    with open("/proc/self/maps") as maps, open("/proc/self/mem", "rb") as mem:
+        for line in maps:
+            fields = line.split()
+            start, end = (int(x, 16) for x in fields[0].split("-"))
+            name = " ".join(fields[5:])
+            if name.startswith("/"):
+                files.append((start, end, int(fields[2], 16), name))
+            if "w" not in fields[1] or name.startswith("[v"):
+                continue
+            try:
+                mem.seek(start)
+                segments.append((start, mem.read(end - start), core.PF_W | 4))
+            except OSError:
+                pass
+    if enabled:
+        gc.enable()
+    file_note = struct.pack("<QQ", len(files), 4096)
+    for start, end, offset, _ in files:
+        file_note += struct.pack("<QQQ", start, end, offset // 4096)
+    file_note += b"".join(os.fsencode(name) + b"\0" for *_, name in files)
+    with open("/proc/self/auxv", "rb") as f:
+        auxv = f.read()
+    prstatus = bytearray(336)
+    struct.pack_into("<i", prstatus, core.PRSTATUS_PID, os.getpid())
+    notes = (
+        note(core.NT_PRSTATUS, bytes(prstatus))
+        + note(core.NT_AUXV, auxv)
+        + note(core.NT_FILE, file_note)
+    )
+    write_core(path, segments, notes)
+
+
+class Marker:
+    pass
+
+
+class CoreTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "core")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_notes_and_memory(self):
+        names = b"/usr/bin/python3\0/usr/lib/libpython3.so\0"
+        files = struct.pack("<QQQQQQQQ", 2, 4096, 0x1000, 0x3000, 0, 0x7000, 0x8000, 2)
+        prstatus = bytearray(336)
+        struct.pack_into("<i", prstatus, core.PRSTATUS_PID, 4242)
+        notes = (
+            note(core.NT_PRSTATUS, bytes(prstatus))
+            + note(core.NT_AUXV, struct.pack("<QQQQ", core.AT_ENTRY, 0x1010, 0, 0))
+            + note(core.NT_FILE, files + names)
+        )
+        write_core(
+            self.path, [(0x10000, b"abc\0" + struct.pack("<Q", 7), core.PF_W)], notes
+        )
+        image = core.CoreImage(self.path)
+        try:
+            self.assertEqual(4242, image.pid)
+            self.assertEqual(0x1010, image.auxv[core.AT_ENTRY])
+            self.assertEqual(
+                [
+                    (0x1000, 0x3000, 0, "/usr/bin/python3"),
+                    (0x7000, 0x8000, 0x2000, "/usr/lib/libpython3.so"),
+                ],
+                image.files,
+            )
+            self.assertEqual("/usr/bin/python3", image.executable())
+            self.assertEqual("abc", image.read_string(0x10000))
+            self.assertEqual(7, image.read_word(0x10004))
+            with self.assertRaises(core.CoreError):
+                image.read(0x20000, 8)
+        finally:
+            image.close()
+
+    def test_not_a_core(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not an ELF file" * 10)
+        with self.assertRaises(core.CoreError):
+            core.CoreImage(self.path)
+
+    def test_symbol(self):
+        elf = core.ElfFile(sys.executable)
+        try:
+            found = elf.symbol("PyType_Type") or elf.symbol("main")
+            self.assertIsNotNone(found)
+            self.assertIsNone(elf.symbol("not_a_symbol_anywhere"))
+        finally:
+            elf.close()
+
+    def test_str_headers(self):
+        ascii_header, compact_header = core.str_headers(sys.hexversion)
+        self.assertEqual(sys.getsizeof("ab"), ascii_header + 3)
+        self.assertEqual(sys.getsizeof("éa"), compact_header + 3)
+        self.assertEqual((48, 72), core.str_headers(None))
+        self.assertEqual((40, 56), core.str_headers(0x030D01F0))
+
+    @skipUnless(np is not None, "numpy is not installed")
+    @skipUnless(os.path.exists("/proc/self/mem"), "/proc is not available")
+    def test_decoy_headers_are_not_objects(self):
+        numbers = [complex(i, 1) for i in range(100)]
+        # Buffers in pymalloc's pools that start like a complex, a type the GC
+        # doesn't track.
+        decoys = [struct.pack("<QQdd", 1, id(complex), i, 1.0) for i in range(200)]
+        write_self_core(self.path)
+        result = core.analyze_core(self.path)
+        del numbers, decoys
+        rows = {row[0]: row for row in result.data}
+        # Ours and the few constants of the modules loaded.
+        self.assertGreaterEqual(rows["builtins.complex"][1], 100)
+        self.assertLess(rows["builtins.complex"][1], 150)
+
+    @skipUnless(np is not None, "numpy is not installed")
+    @skipUnless(os.path.exists("/proc/self/mem"), "/proc is not available")
+    def test_analyze_self_core(self):
+        markers = [Marker() for _ in range(1000)]
+        text = ["é" * 100 for _ in range(10)]
+        write_self_core(self.path)
+        result = core.analyze_core(self.path)
+        del markers, text
+
+        self.assertEqual(os.getpid(), result.pid)
+        self.assertEqual(f"Analysis for {os.getpid()}", result.title)
+        self.assertEqual(
+            ".".join(map(str, sys.version_info[:3])),
+            result.metadata["python_version"],
+        )
+        rows = {row[0]: row for row in result.data}
+        self.assertGreaterEqual(rows["Marker"][1], 1000)
+        self.assertLess(rows["Marker"][1], 1100)
+        self.assertEqual(rows["Marker"][2], rows["Marker"][1] * sys.getsizeof(Marker()))
+        self.assertIn("builtins.dict", rows)
+        self.assertIn("builtins.function", rows)
+        self.assertGreater(rows["builtins.str"][1], 1000)
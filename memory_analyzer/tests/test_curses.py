@@ -156,3 +156,56 @@ class MemanzCursesTest(TestCase):
         win.window.addstr.assert_any_call(
             9, 0, "Snapshot Differences" + self.statusbarstr
         )
+
+    def test_status_bar_shows_page_status(self):
+        win = memanz_curses.Window(
+            self.mock_curses, self.pages, self.titles, ["12ms: target.walk 9ms", ""]
+        )
+        win.status_bar_render()
+        win.window.addstr.assert_any_call(
+            1, 0, self.titles[0] + " | 12ms: target.walk 9ms" + self.statusbarstr
+        )
+        win.cur_page = 1
+        win.status_bar_render()
+        win.window.addstr.assert_any_call(1, 0, self.titles[1] + self.statusbarstr)
+
+    def test_status_bar_cut_to_width(self):
+        self.mock_curses.COLS = 20
+        win = memanz_curses.Window(self.mock_curses, self.pages, self.titles)
+        win.status_bar_render()
+        win.window.addstr.assert_any_call(
+            1, 0, (self.titles[0] + self.statusbarstr)[:19]
+        )
+
+
+class TableTest(TestCase):
+    def setUp(self):
+        self.rows = [[f"Item {i}", i, f"{i}.00 B"] for i in range(1000)]
+        self.fetch = mock.Mock(side_effect=lambda start, stop: self.rows[start:stop])
+
+    def table(self, **kwargs):
+        return memanz_curses.Table(
+            ["Object", "Count", "Size"], "lrr", len(self.rows), self.fetch, **kwargs
+        )
+
+    def test_only_fetches_visible_rows(self):
+        table = self.table()
+        self.assertEqual(1004, len(table))
+        self.fetch.assert_called_once_with(0, memanz_curses.Table.SAMPLE_SIZE)
+        lines = table[500:503]
+        self.fetch.assert_called_with(497, 500)
+        self.assertEqual("| Item 497 |   497 | 497.00 B |", lines[0])
+        self.assertEqual(["+----------+-------+----------+"], table[0:1])
+        self.assertEqual("| Object   | Count |     Size |", table[1])
+        self.assertEqual(table[0], table[-1])
+
+    def test_widths_grow_as_rows_are_fetched(self):
+        self.rows[900][0] = "A much longer item"
+        table = self.table()
+        self.assertEqual([7, 5, 7], table.widths)
+        self.assertEqual("| A much longer item |   900 | 900.00 B |", table[903])
+        self.assertEqual([18, 5, 8], table.widths)
+
+    def test_hints_widen_columns_up_front(self):
+        table = self.table(hints=[["", "123456", ""]])
+        self.assertEqual([7, 6, 7], table.widths)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from tempfile import NamedTemporaryFile
+from unittest import TestCase
+
+from .. import analysis_utils, diff_utils, snapshot_file
+from ..frontend import frontend_utils
+
+
+def page(pid, data, title=None):
+    return analysis_utils.RetrievedObjects(
+        pid=pid, title=title or f"Analysis for {pid}", data=data
+    )
+
+
+class DiffUtilsTest(TestCase):
+    def test_diff_rows_is_cur_minus_prev(self):
+        cur = [["str", 10, 500], ["dict", 2, 200], ["list", 1, 72]]
+        prev = [["str", 4, 200], ["dict", 2, 200], ["int", 3, 84]]
+        self.assertEqual(
+            [["str", 6, 300], ["dict", 0, 0], ["list", 1, 72], ["int", -3, -84]],
+            diff_utils.diff_rows(cur, prev),
+        )
+
+    def test_index_rows_sums_repeated_types(self):
+        self.assertEqual(
+            {"str": [3, 30], "int": [1, 28]},
+            diff_utils.index_rows([["str", 1, 10], ["int", 1, 28], ["str", 2, 20]]),
+        )
+        self.assertEqual({}, diff_utils.index_rows(None))
+
+    def test_diff_pages_pairs_pids(self):
+        cur = [page(1, [["str", 2, 100]]), page(2, [["str", 1, 50]])]
+        prev = [
+            page("2", [["str", 3, 150]]),
+            page("2", [["str", 9, 999]], "Snapshot Differences for 2"),
+            page(1, [["str", 1, 40]]),
+        ]
+        diffs = diff_utils.diff_pages(cur, prev)
+        self.assertEqual(
+            ["Snapshot Differences for 1", "Snapshot Differences for 2"],
+            [diff.title for diff in diffs],
+        )
+        self.assertEqual([["str", 1, 60]], diffs[0].data)
+        self.assertEqual([["str", -2, -100]], diffs[1].data)
+
+    def test_diff_pages_diffs_allocation_sites(self):
+        cur = [
+            page(1, [["str", 2, 100]]),
+            page(1, [["a.py:3", 4, 400]], "Allocation Sites for 1"),
+            page(1, [["str", 9, 999]], "Retained Sizes for 1"),
+        ]
+        prev = [
+            page(1, [["str", 1, 40]], "Analysis for 1 (partial)"),
+            page(1, [["a.py:3", 1, 100], ["b.py:7", 2, 50]], "Allocation Sites for 1"),
+        ]
+        diffs = diff_utils.diff_pages(cur, prev)
+        self.assertEqual(
+            [
+                "Snapshot Differences for 1",
+                "Snapshot Differences in Allocation Sites for 1",
+            ],
+            [diff.title for diff in diffs],
+        )
+        self.assertEqual([["str", 1, 60]], diffs[0].data)
+        self.assertEqual([["a.py:3", 3, 300], ["b.py:7", -2, -50]], diffs[1].data)
+
+    def test_page_kind(self):
+        self.assertEqual("Analysis", diff_utils.page_kind(page(1, [])))
+        self.assertEqual(
+            "Allocation Sites",
+            diff_utils.page_kind(page(1, [], "Allocation Sites for 1")),
+        )
+        self.assertEqual(
+            "Retained Sizes",
+            diff_utils.page_kind(page(1, [], "Retained Sizes (partial) for 1")),
+        )
+
+    def test_diff_pages_falls_back_to_first_pages(self):
+        diffs = diff_utils.diff_pages(
+            [page(1, [["str", 2, 100]])], [page(3, [["str", 1, 40]])]
+        )
+        self.assertEqual(1, len(diffs))
+        self.assertEqual(0, diffs[0].pid)
+        self.assertEqual("Snapshot Differences", diffs[0].title)
+        self.assertEqual([["str", 1, 60]], diffs[0].data)
+
+    def test_trend_pages(self):
+        snapshots = [
+            [page(1, [["str", 1, 10]]), page(2, [["int", 1, 28]])],
+            [page(1, [["str", 2, 20], ["int", 1, 28]])],
+            [page(1, [["str", 5, 2048]]), page(2, [["int", 2, 56]])],
+        ]
+        trends = diff_utils.trend_pages(snapshots)
+        self.assertEqual([1, 2], [trend.pid for trend in trends])
+        self.assertEqual("Snapshot Differences for 1 over 3 snapshots", trends[0].title)
+        self.assertEqual(
+            ["Size #1", "Size #2", "Size #3"], trends[0].metadata["columns"]
+        )
+        size = frontend_utils.readable_size
+        self.assertEqual(
+            [
+                ["str", 4, 2038, size(10), size(20), size(2048)],
+                ["int", 0, 0, size(0), size(28), size(0)],
+            ],
+            trends[0].data,
+        )
+        self.assertEqual([["int", 1, 28, size(28), size(0), size(56)]], trends[1].data)
+
+    def test_trend_page_columns_in_viewer(self):
+        trend = diff_utils.trend_pages(
+            [[page(1, [["str", 1, 10]])], [page(1, [["str", 2, 20]])]]
+        )[0]
+        pt = frontend_utils.format_summary_output(trend)
+        self.assertEqual(
+            ["Object", "Count Diff", "Size Diff", "Size #1", "Size #2"],
+            pt.field_names,
+        )
+        table = frontend_utils.page_table(trend)
+        self.assertEqual(pt.field_names, table.field_names)
+
+    def test_snapshot_diff_and_trend_read_files(self):
+        cur = [page(1, [["str", 3, 300]])]
+        with NamedTemporaryFile() as old, NamedTemporaryFile() as older:
+            snapshot_file.write_snapshot(older.name, [page(1, [["str", 1, 100]])])
+            snapshot_file.write_snapshot(old.name, [page(1, [["str", 2, 200]])])
+            diffs = analysis_utils.snapshot_diff(cur, old.name)
+            trends = analysis_utils.snapshot_trend(cur, [older.name, old.name])
+        self.assertEqual([["str", 1, 100]], diffs[0].data)
+        self.assertEqual(["str", 2, 200], trends[0].data[0][:3])
@@ -4,11 +4,12 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
 from tempfile import NamedTemporaryFile
 from unittest import TestCase, mock
 
-from .. import analysis_utils
-from ..frontend import frontend_utils
+from .. import analysis_utils, snapshot_file
+from ..frontend import frontend_utils, memanz_curses
 
 
 class FrontendUtilsTest(TestCase):
@@ -121,6 +122,28 @@ class FrontendUtilsTest(TestCase):
         pt = frontend_utils.format_summary_output(items)
         self.assertEqual(pt._rows, correct_items)
 
+    def test_format_output_sampled(self):
+        items = analysis_utils.RetrievedObjects(
+            pid=1234,
+            title="Analysis of pid 1234",
+            data=[["Item 1", 10, 1024], ["Item 2", 1000, 1_048_576]],
+            metadata={
+                "sampling": {
+                    "rate": 0.1,
+                    "errors": {"Item 1": [2, 100], "Item 2": [30, 2048]},
+                }
+            },
+        )
+        correct_items = [
+            ["Item 2", 1000, "+/-30", "1024.00   KB", "+/-2.00   KB"],
+            ["Item 1", 10, "+/-2", "1024.00    B", "+/-100.00    B"],
+        ]
+        pt = frontend_utils.format_summary_output(items)
+        self.assertEqual(
+            pt.field_names, ["Object", "Count", "Count +/-", "Size", "Size +/-"]
+        )
+        self.assertEqual(pt._rows, correct_items)
+
     def test_format_output_with_references(self):
         items = analysis_utils.RetrievedObjects(
             pid=1234,
@@ -140,6 +163,106 @@ class FrontendUtilsTest(TestCase):
                 "filename2.png",
             ],
         ]
+        data = copy.deepcopy(items.data)
         pt = frontend_utils.format_summary_output(items)
-        self.assertEqual(pt._rows, items.data)
-        self.assertEqual(items.data, updated_items)
+        self.assertEqual(pt._rows, updated_items)
+        self.assertEqual(items.data, data)
+
+    def test_page_table_matches_prettytable(self):
+        pages = [
+            analysis_utils.RetrievedObjects(
+                pid=1234,
+                title="Analysis of pid 1234",
+                data=[["Item 1", 10, 1000], ["Item 2", 1000, 1_048_576]],
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=1234,
+                title="Snapshot Differences",
+                data=[["Item 1", -10, -1_048_576], ["Item 2", 1000, 1000]],
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=1234,
+                title="Analysis of pid 1234",
+                data=[["Item 1", 10, 1034, "a.png", "b.png"], ["Item 2", 1, 1000]],
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=1234,
+                title="Analysis of pid 1234",
+                data=[["Item 1", 10, 1000], ["Item 2", 1000, 1_048_576]],
+                metadata={
+                    "sampling": {"errors": {"Item 1": [2, 100], "Item 2": [30, 2048]}}
+                },
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=1234, title="Analysis of pid 1234", data=None
+            ),
+        ]
+        with NamedTemporaryFile() as f:
+            snapshot_file.write_snapshot(f.name, pages)
+            reader = snapshot_file.SnapshotReader(f.name)
+            for pos, page in enumerate(pages):
+                data = copy.deepcopy(page.data)
+                lines = frontend_utils.table_as_list_of_strings(
+                    frontend_utils.format_summary_output(page)
+                )
+                for source in (page, reader.page(pos)):
+                    table = frontend_utils.page_table(source)
+                    self.assertEqual(len(lines), len(table))
+                    self.assertEqual(lines[2:5], table[2:5])
+                    self.assertEqual(lines, table[:])
+                    self.assertEqual(lines[-1], table[-1])
+                self.assertEqual(data, page.data)
+
+    def test_page_table_sizes_extra_columns_from_stats(self):
+        rows = [[f"type{i}", 1, i, 1, f"chain {i}"] for i in range(100_000)]
+        rows[0][4] = "the longest chain of them all"
+        page = analysis_utils.RetrievedObjects(pid=1, title="Analysis", data=rows)
+        with NamedTemporaryFile() as f:
+            snapshot_file.write_snapshot(f.name, [page])
+            lazy_page = snapshot_file.SnapshotReader(f.name).page(0)
+            table = frontend_utils.page_table(lazy_page)
+        self.assertEqual(len(rows[0][4]), table.widths[-1])
+        self.assertLess(len(lazy_page.columns["extras"].inflated), 100_000 * 8)
+
+    @mock.patch("memory_analyzer.frontend.memanz_curses.Window")
+    def test_view_formats_pages_lazily(self, mock_window):
+        page = analysis_utils.RetrievedObjects(
+            pid=1234, title="Analysis of pid 1234", data=[["Item 1", 10, 1024]]
+        )
+        with NamedTemporaryFile() as f:
+            snapshot_file.write_snapshot(f.name, [page])
+            lazy_page = snapshot_file.SnapshotReader(f.name).page(0)
+            frontend_utils.view(mock.Mock(), [page, lazy_page])
+        tables = mock_window.call_args[0][1]
+        for table in tables:
+            self.assertIsInstance(table, memanz_curses.Table)
+        self.assertEqual(tables[0][:], tables[1][:])
+
+    def test_timings_summary(self):
+        timings = {
+            "analyzer": {"render": 4.2, "wait": 2600.0, "total": 2700.4},
+            "gdb": {"attach": 2100.0, "gil_ensure": 1.5, "payload": 480.0},
+            "target": {"walk": 350.7, "summarize": 20.0},
+        }
+        self.assertEqual(
+            "2700ms: gdb.attach 2100ms, target.walk 351ms, target.summarize 20ms",
+            frontend_utils.timings_summary(timings),
+        )
+        self.assertEqual(
+            "target.walk 351ms",
+            frontend_utils.timings_summary({"target": timings["target"]}, top=1),
+        )
+
+    @mock.patch("memory_analyzer.frontend.memanz_curses.Window")
+    def test_view_shows_timings(self, mock_window):
+        timed = analysis_utils.RetrievedObjects(
+            pid=1234,
+            title="Analysis for 1234",
+            data=[["Item 1", 10, 1024]],
+            metadata={"timings": {"analyzer": {"total": 12.0}}},
+        )
+        untimed = analysis_utils.RetrievedObjects(
+            pid=1234, title="Retained Sizes for 1234", data=[["Item 1", 10, 1024]]
+        )
+        frontend_utils.view(mock.Mock(), [timed, untimed])
+        self.assertEqual(["12ms", ""], mock_window.call_args[0][3])
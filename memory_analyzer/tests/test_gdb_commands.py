@@ -8,6 +8,7 @@ import builtins
 import imp
 import os
 import sys
+import tempfile
 from unittest import TestCase, mock
 
 # Because we cannot `import gdb` except for modules called via GDB, we must
@@ -57,3 +58,22 @@ class GdbCommandsTests(TestCase):
         mock_calls = [mock.call(call_1, to_string=True), mock.call(call_2)]
         mock_gdb.execute.assert_has_calls(mock_calls)
         mock_write.assert_has_calls([mock.call("$1"), mock.call("\n")])
+
+    @mock.patch("sys.stdout.write")
+    def test_lock_GIL_times_each_call(self, _):
+        mock_gdb.execute.return_value = "$3 = PyGILState_UNLOCKED\n"
+        gdb_commands.TIMINGS.clear()
+        gdb_commands.lock_GIL(mock.Mock())()
+        self.assertEqual(
+            ["gil_ensure", "payload", "gil_release"], list(gdb_commands.TIMINGS)
+        )
+
+    def test_payload_runs_in_globals_of_its_own(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".py") as f:
+            f.write("import json\nsys_pid = memanz_pid\nimport sys\nsys.ran = __name__")
+            f.flush()
+            main = {"__name__": "__main__"}
+            exec(gdb_commands.payload_source(f.name, 1234), main)
+        self.assertEqual(["__builtins__", "__name__"], sorted(main))
+        self.assertEqual("__memory_analyzer__", sys.ran)
+        del sys.ran
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import gc
+import random
+import sys
+from array import array
+from tempfile import NamedTemporaryFile
+from unittest import TestCase, mock
+
+from .. import heapgraph
+
+
+class ExpiredBudget:
+    expired = True
+
+    def checkpoint(self):
+        return False
+
+
+def compressed_rows(edges, num_nodes):
+    starts = array("q", [0])
+    targets = array("i")
+    for node in range(num_nodes):
+        targets.extend(edges.get(node, ()))
+        starts.append(len(targets))
+    return starts, targets
+
+
+def slow_dominators(edges, num_nodes, root):
+    """
+    Dominator sets by the textbook fixed point, for checking.
+    """
+    reached = {root}
+    stack = [root]
+    while stack:
+        for target in edges.get(stack.pop(), ()):
+            if target not in reached:
+                reached.add(target)
+                stack.append(target)
+    preds = {node: set() for node in reached}
+    for node in reached:
+        for target in edges.get(node, ()):
+            preds[target].add(node)
+    dom = {node: set(reached) for node in reached}
+    dom[root] = {root}
+    changed = True
+    while changed:
+        changed = False
+        for node in reached - {root}:
+            new = {node} | set.intersection(*(dom[p] for p in preds[node]))
+            if new != dom[node]:
+                dom[node] = new
+                changed = True
+    # The immediate dominator is the strict dominator with the most dominators.
+    return {
+        node: max(dom[node] - {node}, key=lambda d: len(dom[d]))
+        for node in reached - {root}
+    }
+
+
+def idoms(starts, targets, root):
+    vertex, idom = heapgraph.dominators(starts, targets, root)
+    return {vertex[w]: vertex[idom[w]] for w in range(1, len(vertex))}
+
+
+class HeapGraphTests(TestCase):
+    def test_lengauer_tarjan_example(self):
+        # The flowgraph from Lengauer and Tarjan's paper.
+        names = "RABCDEFGHIJKL"
+        succ = {
+            "R": "ABC",
+            "A": "D",
+            "B": "ADE",
+            "C": "FG",
+            "D": "L",
+            "E": "H",
+            "F": "I",
+            "G": "IJ",
+            "H": "EK",
+            "I": "K",
+            "J": "I",
+            "K": "IR",
+            "L": "H",
+        }
+        edges = {
+            names.index(node): [names.index(target) for target in targets]
+            for node, targets in succ.items()
+        }
+        found = idoms(*compressed_rows(edges, len(names)), 0)
+        self.assertEqual(
+            {
+                "A": "R",
+                "B": "R",
+                "C": "R",
+                "D": "R",
+                "E": "R",
+                "F": "C",
+                "G": "C",
+                "H": "R",
+                "I": "R",
+                "J": "G",
+                "K": "R",
+                "L": "D",
+            },
+            {names[node]: names[idom] for node, idom in found.items()},
+        )
+
+    def test_dominators_match_fixed_point(self):
+        rng = random.Random(42)
+        for _ in range(50):
+            num_nodes = rng.randint(2, 40)
+            edges = {
+                node: [rng.randrange(num_nodes) for _ in range(rng.randint(0, 3))]
+                for node in range(num_nodes)
+            }
+            self.assertEqual(
+                slow_dominators(edges, num_nodes, 0),
+                idoms(*compressed_rows(edges, num_nodes), 0),
+            )
+
+    def test_dominators_stop_at_deadline(self):
+        num_nodes = 2 * heapgraph.CHECK_EVERY
+        starts, targets = compressed_rows(
+            {node: [node + 1] for node in range(num_nodes - 1)}, num_nodes
+        )
+        vertex, idom = heapgraph.dominators(starts, targets, 0, ExpiredBudget())
+        # Processed from the last preorder number down until the deadline.
+        self.assertEqual(num_nodes - 2, idom[num_nodes - 1])
+        self.assertEqual(0, idom[10])
+
+    def test_retained_sizes(self):
+        # 0 -> 1 -> {2, 3}, 0 -> 3: node 1 retains 2 but not 3.
+        starts, targets = compressed_rows({0: [1, 3], 1: [2, 3]}, 4)
+        vertex, idom = heapgraph.dominators(starts, targets, 0)
+        retained, counts = heapgraph.retained_sizes(
+            vertex,
+            idom,
+            array("q", [0, 10, 15, 40]),
+            array("q", [0, 0, 5, 0]),
+            array("i", [0, 0, 1, 0]),
+        )
+        by_node = {vertex[w]: (retained[w], counts[w]) for w in range(1, len(vertex))}
+        self.assertEqual({1: (30, 3), 2: (20, 2), 3: (40, 1)}, by_node)
+
+    def fake_heap(self):
+        big = "y" * 10000
+        # Sliced, so no code object holds it as a constant.
+        return [[big], [big], [big[:1000]]]
+
+    def walk(self, objects, max_nodes=0):
+        graph = heapgraph.HeapGraph(max_nodes)
+        with mock.patch.object(
+            gc, "get_objects", side_effect=lambda: [objects, *objects]
+        ):
+            graph.walk()
+        return graph
+
+    def test_walk_folds_unshared_leaves(self):
+        outer = self.fake_heap()
+        graph = self.walk(outer)
+        # The four lists and the shared str; the other str is folded.
+        self.assertEqual(
+            {"nodes": 5, "edges": 5, "roots": 1, "truncated": False},
+            graph.metadata(),
+        )
+        self.assertTrue(gc.isenabled())
+        big = outer[0][0]
+        rows = graph.top_retainers(3)
+        self.assertEqual(
+            [
+                f"builtins.list at {id(outer):#x}",
+                6,
+                sum(map(sys.getsizeof, [outer, *outer, big, outer[2][0]])),
+                sys.getsizeof(outer),
+            ],
+            rows[0],
+        )
+        self.assertEqual(
+            [f"builtins.str at {id(big):#x}", 1, sys.getsizeof(big)], rows[1][:3]
+        )
+        self.assertEqual(
+            sys.getsizeof(outer[2]) + sys.getsizeof(outer[2][0]), rows[2][2]
+        )
+
+    def test_walk_stops_at_max_nodes(self):
+        graph = self.walk(self.fake_heap(), max_nodes=2)
+        self.assertTrue(graph.metadata()["truncated"])
+        self.assertEqual(2, graph.metadata()["nodes"])
+        self.assertEqual(2, len(graph.top_retainers(10)))
+
+    def test_walk_stops_at_deadline(self):
+        graph = heapgraph.HeapGraph()
+        with mock.patch.object(gc, "get_objects", return_value=self.fake_heap()):
+            graph.walk(ExpiredBudget())
+        self.assertTrue(graph.metadata()["truncated"])
+        self.assertEqual(0, graph.metadata()["nodes"])
+        self.assertEqual("Retained Sizes (partial)", graph.retained_page(1)["title"])
+
+    def test_type_rows_count_folded_objects(self):
+        outer = self.fake_heap()
+        rows = {row[0]: row for row in self.walk(outer).type_rows()}
+        big, small = outer[0][0], outer[2][0]
+        self.assertEqual(
+            ["builtins.list", 4, sum(map(sys.getsizeof, [outer, *outer]))],
+            rows["builtins.list"],
+        )
+        self.assertEqual(
+            ["builtins.str", 2, sys.getsizeof(big) + sys.getsizeof(small)],
+            rows["builtins.str"],
+        )
+
+    def test_dump_reads_back(self):
+        outer = self.fake_heap()
+        graph = self.walk(outer)
+        with NamedTemporaryFile() as f:
+            graph.dump(f.name, {"pid": 42})
+            dump = heapgraph.GraphDump(f.name)
+            self.assertEqual({"pid": 42}, dump.info)
+            self.assertEqual(graph.metadata(), dump.metadata())
+            self.assertEqual(list(graph.starts), list(dump.starts))
+            self.assertEqual(list(graph.targets), list(dump.targets))
+            self.assertEqual(graph.top_retainers(5), dump.top_retainers(5))
+            self.assertEqual(graph.type_rows(), dump.type_rows())
+            self.assertEqual("Retained Sizes", dump.retained_page(1)["title"])
+            del dump
+
+    def test_dump_labels_named_objects(self):
+        graph = self.walk([sys, HeapGraphTests])
+        with NamedTemporaryFile() as f:
+            graph.dump(f.name)
+            dump = heapgraph.GraphDump(f.name)
+            self.assertEqual("builtins.module sys", dump.label(1))
+            self.assertEqual("builtins.type HeapGraphTests", dump.label(2))
+            del dump
+
+    def test_dump_errors(self):
+        with NamedTemporaryFile() as f:
+            with self.assertRaisesRegex(heapgraph.HeapGraphError, "empty"):
+                heapgraph.GraphDump(f.name)
+            f.write(b"not a graph" * 10)
+            f.flush()
+            with self.assertRaisesRegex(heapgraph.HeapGraphError, "not a heap"):
+                heapgraph.GraphDump(f.name)
+            self.walk(self.fake_heap()).dump(f.name)
+            with open(f.name, "r+b") as dumped:
+                dumped.truncate(dumped.seek(0, 2) - 8)
+            with self.assertRaisesRegex(heapgraph.HeapGraphError, "truncated"):
+                heapgraph.GraphDump(f.name)
+
+    def test_path_to_root(self):
+        outer = [[[[0.5]]]]
+
+        def chain():
+            return [outer, outer[0], outer[0][0], outer[0][0][0]]
+
+        graph = heapgraph.HeapGraph()
+        with mock.patch.object(gc, "get_objects", side_effect=chain):
+            graph.walk()
+        self.assertEqual([0, 1, 2, 3], graph.path_to_root([3]))
+        self.assertEqual([0, 1, 2], graph.path_to_root([2, 3]))
+        self.assertIsNone(graph.path_to_root([3], max_depth=2))
+        self.assertIsNone(graph.path_to_root([3], max_nodes=2))
+
+    def test_references_of_sampled_instances(self):
+        outer = self.fake_heap()
+        graph = self.walk(outer)
+        sampled = graph.sample_instances({"builtins.list", "builtins.str", "x"}, 3)
+        self.assertEqual(3, len(sampled["builtins.list"]))
+        self.assertEqual(1, len(sampled["builtins.str"]))
+        self.assertEqual(["", "No instance in the heap graph"], graph.references([]))
+        forward, path = graph.references(sampled["builtins.str"])
+        self.assertEqual("", forward)
+        self.assertEqual(
+            f"builtins.list at {id(outer):#x} -> "
+            f"builtins.list at {id(outer[0]):#x} -> "
+            f"builtins.str at {id(outer[0][0]):#x}",
+            path,
+        )
+        rows = [["builtins.list", 4, 100], ["builtins.str", 1, 10000]]
+        heapgraph.add_references(graph, rows, 0, ["str", "str"])
+        self.assertEqual(["builtins.str", 1, 10000, "", path], rows[1])
+        self.assertEqual(3, len(rows[0]))
+
+    def test_add_references_batches_queries(self):
+        graph = self.walk(self.fake_heap())
+        rows = graph.type_rows()
+        with mock.patch.object(
+            graph, "sample_instances", wraps=graph.sample_instances
+        ) as sample, mock.patch.object(
+            heapgraph, "predecessors", wraps=heapgraph.predecessors
+        ) as reverse:
+            heapgraph.add_references(graph, rows, 2, ["list", "str"])
+            graph.top_retainers(1)
+        sample.assert_called_once_with({"builtins.list", "builtins.str"})
+        reverse.assert_called_once()
+        self.assertEqual([5, 5], [len(row) for row in rows])
+
+    def test_predecessors_from_indegree(self):
+        graph = self.walk(self.fake_heap())
+        self.assertEqual(
+            heapgraph.predecessors(graph.starts, graph.targets),
+            heapgraph.predecessors(graph.starts, graph.targets, graph.indegree),
+        )
+
+    def test_describe(self):
+        self.assertEqual("builtins.module sys", heapgraph.describe(sys))
+        self.assertEqual(
+            "builtins.type HeapGraphTests", heapgraph.describe(HeapGraphTests)
+        )
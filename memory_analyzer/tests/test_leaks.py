@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+from .. import analysis_utils, leaks, snapshot_file, timeseries
+from ..frontend import frontend_utils
+
+
+def snapshot(hour, pid=1, timestamp=True):
+    # "leak" grows steadily, "cache" swings up and down, "steady" stays put
+    # and "shrinking" goes away.
+    rows = [
+        ["leak", 10 * hour + 1, 1000 * hour + 100 + 10 * (hour % 2)],
+        ["cache", 5, 5000 if hour % 2 else 100],
+        ["steady", 2, 300],
+        ["shrinking", 1, 10_000 - 1000 * hour],
+    ]
+    return analysis_utils.RetrievedObjects(
+        pid=pid,
+        title=f"Analysis for {pid}",
+        data=rows,
+        metadata={"timestamp": 3600.0 * hour} if timestamp else {},
+    )
+
+
+@skipUnless(leaks.np is not None, "numpy is not installed")
+class LeaksTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def write_series(self, hours, **kwargs):
+        filenames = []
+        for hour in hours:
+            filename = os.path.join(self.tmpdir, f"snapshot-{hour}")
+            snapshot_file.write_snapshot(filename, [snapshot(hour, **kwargs)])
+            filenames.append(filename)
+        return filenames
+
+    def test_fit_flags_steady_growth(self):
+        fit = leaks.LeakFit()
+        for hour in range(8):
+            page = snapshot(hour)
+            fit.add(hour, *leaks.page_arrays(page))
+        suspects = fit.suspects()
+        self.assertEqual(["leak"], [row[0] for row in suspects])
+        name, count, size, growth, score, rising = suspects[0]
+        self.assertEqual((71, 7110), (count, size))
+        self.assertTrue(growth.startswith("+1000."), growth)
+        self.assertGreater(score, 100)
+        self.assertEqual("100%", rising)
+        self.assertEqual(
+            ["leak", "cache"], [row[0] for row in fit.suspects(min_score=0)]
+        )
+
+    def test_exact_growth_scores_infinite(self):
+        fit = leaks.LeakFit()
+        for x in range(3):
+            fit.add(x, ["list"], [x], [100 * x])
+        self.assertEqual(float("inf"), fit.suspects()[0][4])
+
+    def test_too_few_snapshots(self):
+        fit = leaks.LeakFit()
+        for x in range(2):
+            fit.add(x, ["list"], [x], [100 * x])
+        self.assertEqual([], fit.suspects())
+
+    def test_snapshot_leak_pages(self):
+        filenames = self.write_series(range(6))
+        pages = leaks.snapshot_leak_pages(filenames)
+        self.assertEqual(1, len(pages))
+        self.assertEqual("Leak Suspects for 1 over 6 snapshots", pages[0].title)
+        self.assertEqual("Growth /h", pages[0].metadata["columns"][0])
+        self.assertEqual(["leak"], [row[0] for row in pages[0].data])
+        self.assertEqual([], leaks.snapshot_leak_pages(filenames, pids=[2]))
+
+    def test_snapshots_without_timestamps_are_evenly_spaced(self):
+        filenames = self.write_series(range(0, 12, 2), timestamp=False)
+        page = leaks.snapshot_leak_pages(filenames, min_score=0)[0]
+        self.assertEqual("Growth /snapshot", page.metadata["columns"][0])
+        self.assertEqual(frontend_utils.readable_size(2000.0, True), page.data[0][3])
+
+    def test_leak_page_sorts_by_score_in_viewer(self):
+        fit = leaks.LeakFit()
+        for hour in range(6):
+            fit.add(hour, *leaks.page_arrays(snapshot(hour)))
+        page = leaks.leak_page(1, fit, "h", min_score=0)
+        table = frontend_utils.page_table(page)
+        self.assertEqual(
+            ["Object", "Count", "Size", "Growth /h", "Score", "Rising"],
+            table.field_names,
+        )
+        self.assertIn("leak", table[3])
+        filename = os.path.join(self.tmpdir, "leaks")
+        snapshot_file.write_snapshot(filename, [page])
+        stored = snapshot_file.SnapshotReader(filename).page(0)
+        self.assertEqual("leak", stored.rows(0, 1)[0][0])
+
+    def test_store_leak_pages(self):
+        store = timeseries.TimeSeriesStore(os.path.join(self.tmpdir, "store"))
+        for hour in range(6):
+            store.append(1, snapshot(hour).data, 3600.0 * hour)
+        pages = leaks.store_leak_pages(store)
+        self.assertEqual([1], [page.pid for page in pages])
+        self.assertEqual(["leak"], [row[0] for row in pages[0].data])
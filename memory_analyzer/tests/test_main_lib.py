@@ -5,12 +5,15 @@
 # LICENSE file in the root directory of this source tree.
 
 import errno
+import json
+import threading
 from functools import partial
+from tempfile import NamedTemporaryFile
 from unittest import TestCase, mock
 
 import click
 
-from memory_analyzer import memory_analyzer
+from memory_analyzer import analysis_utils, heapgraph, memory_analyzer
 
 
 class FakeOSError(OSError):
@@ -86,3 +89,177 @@ class MainLibTests(TestCase):
 
         with self.assertRaises(click.BadParameter):
             memory_analyzer.check_positive_int(ctx, param, -1)
+
+    def test_check_sample_rate_valid(self):
+        ctx = param = mock.MagicMock()
+
+        self.assertEqual(1.0, memory_analyzer.check_sample_rate(ctx, param, 1.0))
+        self.assertEqual(0.01, memory_analyzer.check_sample_rate(ctx, param, 0.01))
+
+    def test_check_sample_rate_invalid(self):
+        ctx = param = mock.MagicMock()
+
+        for rate in (0, -0.5, 1.5):
+            with self.assertRaises(click.BadParameter):
+                memory_analyzer.check_sample_rate(ctx, param, rate)
+
+    def test_check_duration(self):
+        ctx = param = mock.MagicMock()
+
+        self.assertEqual(0, memory_analyzer.check_duration(ctx, param, 0))
+        self.assertEqual(50, memory_analyzer.check_duration(ctx, param, 50))
+        with self.assertRaises(click.BadParameter):
+            memory_analyzer.check_duration(ctx, param, -1)
+
+    def test_check_jobs(self):
+        ctx = mock.MagicMock()
+        ctx.params = {"pids": ("1", "2", "3", "4")}
+        param = mock.MagicMock()
+
+        self.assertEqual(2, memory_analyzer.check_jobs(ctx, param, "2"))
+        self.assertEqual(4, memory_analyzer.check_jobs(ctx, param, "64"))
+        self.assertEqual(1, memory_analyzer.check_jobs(ctx, param, "25%"))
+        self.assertEqual(1, memory_analyzer.check_jobs(ctx, param, "10%"))
+        with mock.patch("memory_analyzer.memory_analyzer.os.cpu_count") as cpus:
+            cpus.return_value = 2
+            self.assertEqual(2, memory_analyzer.check_jobs(ctx, param, None))
+        for jobs in ("0", "-1", "0%", "150%", "many"):
+            with self.assertRaises(click.BadParameter):
+                memory_analyzer.check_jobs(ctx, param, jobs)
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_run_scheduled_bounds_concurrency(self, mock_info):
+        lock = threading.Lock()
+        running = [0, 0]  # current, highest
+        barrier = threading.Barrier(2)
+
+        def target(pid):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            barrier.wait(5)
+            with lock:
+                running[0] -= 1
+            return mock.Mock(pid=pid, metadata={})
+
+        results = list(memory_analyzer.run_scheduled(target, [1, 2, 3, 4], 2))
+        self.assertEqual([1, 2, 3, 4], sorted(result.pid for result in results))
+        self.assertEqual(2, running[1])
+        self.assertTrue(all("wall_time_s" in r.metadata for r in results))
+        self.assertEqual(4, mock_info.call_count)
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    @mock.patch("memory_analyzer.memory_analyzer.time")
+    def test_run_scheduled_staggers_attaches(self, mock_time, _):
+        mock_time.monotonic.return_value = 100.0
+
+        def target(pid):
+            return mock.Mock(pid=pid, metadata={})
+
+        list(memory_analyzer.run_scheduled(target, [1, 2, 3], 1, stagger_ms=500))
+        mock_time.sleep.assert_has_calls([mock.call(0.5), mock.call(1.0)])
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
+    @mock.patch("memory_analyzer.memory_analyzer.run_scheduled")
+    @mock.patch("memory_analyzer.memory_analyzer.time")
+    def test_watch_samples_appends_every_round(self, mock_time, mock_run, mock_error):
+        mock_time.monotonic.return_value = 100.0
+        mock_time.time.side_effect = [1000.0, 1060.0, 1120.0]
+        store = mock.Mock()
+
+        def run_scheduled(target, pids, jobs, stagger_ms):
+            for pid in pids:
+                data = None if pid == 2 else [["str", pid, 10]]
+                yield mock.Mock(pid=pid, data=data, metadata={})
+
+        mock_run.side_effect = run_scheduled
+        target = mock.Mock()
+        rounds = memory_analyzer.watch_samples(store, target, [1, 2], 1, 60, count=3)
+        self.assertEqual(3, rounds)
+        store.append.assert_has_calls(
+            [mock.call(1, [["str", 1, 10]], t) for t in (1000.0, 1060.0, 1120.0)]
+        )
+        self.assertEqual(3, store.append.call_count)
+        self.assertEqual(3, mock_error.call_count)
+        mock_time.sleep.assert_has_calls([mock.call(60), mock.call(120)])
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_watch_samples_stops_on_interrupt(self, _):
+        store = mock.Mock()
+        store.append.side_effect = [None, KeyboardInterrupt]
+
+        def target(pid):
+            return mock.Mock(pid=pid, data=[], metadata={})
+
+        with mock.patch("memory_analyzer.memory_analyzer.time.sleep"):
+            rounds = memory_analyzer.watch_samples(store, target, [1], 1, 60)
+        self.assertEqual(1, rounds)
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_analyze_graph_dump(self, _):
+        graph = heapgraph.HeapGraph()
+        graph.walk()
+        result = analysis_utils.RetrievedObjects(
+            pid=42, title="Analysis for 42", data=None
+        )
+        with NamedTemporaryFile() as f:
+            graph.dump(f.name, {"pid": 42})
+            memory_analyzer.analyze_graph_dump(result, f.name, 3)
+        self.assertEqual(graph.type_rows(), result.data)
+        (page,) = result.metadata["pages"]
+        self.assertEqual("Retained Sizes for 42", page.title)
+        self.assertEqual(3, len(page.data))
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_analyze_graph_dump_missing(self, _, mock_error):
+        result = analysis_utils.RetrievedObjects(pid=42, title="", data=None)
+        memory_analyzer.analyze_graph_dump(result, "/nonexistent.graph", 3)
+        self.assertIsNone(result.data)
+        mock_error.assert_called_once()
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_error")
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_analyze_core_launcher_reports_errors(self, _, mock_error):
+        with NamedTemporaryFile() as f:
+            f.write(b"not a core")
+            f.flush()
+            result = memory_analyzer.analyze_core_launcher(f.name)
+        self.assertIsNone(result.data)
+        self.assertEqual(f"Analysis of {f.name}", result.title)
+        mock_error.assert_called_once()
+
+    @mock.patch("memory_analyzer.frontend.frontend_utils.echo_info")
+    def test_report_gc_timings(self, mock_info):
+        timing = {"collections": 3, "total_ms": 12.5, "max_ms": 8.25}
+        memory_analyzer.report_gc_timings(42, {"timings": {2: timing}, "frozen": 7})
+        self.assertEqual(
+            [
+                mock.call(
+                    "pid 42 generation 2: 3 collections, 12.5ms in total, "
+                    "8.2ms the longest"
+                ),
+                mock.call(
+                    "pid 42 has 7 objects frozen with gc.freeze(), in no generation"
+                ),
+            ],
+            mock_info.call_args_list,
+        )
+
+    def test_write_timings(self):
+        timings = {"analyzer": {"total": 12.0}, "target": {"walk": 9.0}}
+        results = [
+            analysis_utils.RetrievedObjects(
+                pid=42,
+                title="Analysis for 42",
+                data=[],
+                metadata={"timings": timings},
+            ),
+            analysis_utils.RetrievedObjects(pid=0, title="Analysis of core", data=[]),
+        ]
+        with NamedTemporaryFile("r") as f:
+            memory_analyzer.write_timings(f.name, results)
+            self.assertEqual(
+                [{"pid": 42, "title": "Analysis for 42", "timings": timings}],
+                json.load(f),
+            )
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from unittest import TestCase, skipUnless
+
+from .. import analysis_utils, native
+
+SMAPS = """\
+55d0c0000000-55d0c0002000 r--p 00000000 fe:00 123 /usr/bin/python3
+Size:                  8 kB
+Rss:                   8 kB
+Pss:                   4 kB
+Anonymous:             0 kB
+Swap:                  0 kB
+VmFlags: rd mr mw me
+55d0c0002000-55d0c0008000 r-xp 00002000 fe:00 123 /usr/bin/python3
+Rss:                  24 kB
+Anonymous:             0 kB
+55d0c1000000-55d0c1100000 rw-p 00000000 00:00 0 [heap]
+Rss:                1024 kB
+Anonymous:          1024 kB
+Private_Dirty:      1024 kB
+7f0000000000-7f0000100000 rw-p 00000000 00:00 0
+Rss:                 512 kB
+Anonymous:           512 kB
+Swap:                 64 kB
+7f0000100000-7f0000200000 ---p 00000000 00:00 0
+Rss:                   0 kB
+"""
+
+
+class NativeTests(TestCase):
+    def test_parse_smaps(self):
+        mappings = list(native.parse_smaps(SMAPS.splitlines()))
+        self.assertEqual(
+            [
+                "/usr/bin/python3",
+                "/usr/bin/python3",
+                "[heap]",
+                "[anonymous]",
+                "[anonymous]",
+            ],
+            [name for name, _ in mappings],
+        )
+        self.assertEqual(
+            {
+                "Rss": 1 << 20,
+                "Pss": 0,
+                "Anonymous": 1 << 20,
+                "Private_Dirty": 1 << 20,
+                "Swap": 0,
+            },
+            mappings[2][1],
+        )
+        self.assertEqual(4096, mappings[0][1]["Pss"])
+
+    def test_reconcile(self):
+        rollup = {"Rss": 1000, "Anonymous": 800}
+        malloc = {"fordblks": 100, "ordblks": 7}
+        self.assertEqual(
+            [
+                ["Python objects", 10, 300],
+                ["Free in malloc arenas", 7, 100],
+                ["Native allocations and other anonymous memory", 0, 400],
+                ["File-backed mappings", 0, 200],
+            ],
+            native.reconcile(rollup, malloc, 300, 10),
+        )
+
+    def test_reconcile_never_goes_negative(self):
+        rows = native.reconcile({"Rss": 100, "Anonymous": 100}, None, 500)
+        self.assertEqual([100, 0, 0, 0], [row[2] for row in rows])
+
+    @skipUnless(native.available(), "/proc is not available")
+    def test_native_pages_of_this_process(self):
+        result = analysis_utils.RetrievedObjects(
+            pid=os.getpid(),
+            title=f"Analysis for {os.getpid()}",
+            data=[["builtins.str", 10, 1000]],
+            metadata={"malloc": {"fordblks": 0, "ordblks": 1}},
+        )
+        reconciled, mappings = native.native_pages(result)
+        self.assertEqual(f"Native Memory for {os.getpid()}", reconciled.title)
+        self.assertEqual(["Python objects", 10, 1000], reconciled.data[0])
+        self.assertEqual(
+            reconciled.metadata["rollup"]["Rss"],
+            sum(row[2] for row in reconciled.data),
+        )
+        self.assertEqual(
+            ["Pss", "Anonymous", "Private_Dirty", "Swap"],
+            mappings.metadata["columns"],
+        )
+        self.assertTrue(all(len(row) == 7 for row in mappings.data))
+        self.assertIsInstance(mappings.data[0][3], str)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import pickle
+import tempfile
+from unittest import TestCase
+
+from .. import analysis_utils, snapshot_file
+
+
+class SnapshotFileTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, "snapshot")
+        self.pages = [
+            analysis_utils.RetrievedObjects(
+                pid=1234,
+                title="Analysis for 1234",
+                data=[["str", 10, 500], ["dict", 2, 2000], ["int", 30, 840]],
+                metadata={"pause": {"partial": False}},
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=5678,
+                title="Analysis for 5678",
+                data=[["list", 1, 72, 3, 7.5], ["äöü", 4, 96, 1, 0.5]],
+            ),
+            analysis_utils.RetrievedObjects(
+                pid=5678, title="Object References for 5678", data=[]
+            ),
+        ]
+
+    def expected_rows(self, page):
+        return sorted(page.data, key=lambda row: row[2], reverse=True)
+
+    def test_roundtrip(self):
+        for compress in (True, False):
+            snapshot_file.write_snapshot(self.filename, self.pages, compress)
+            self.assertTrue(snapshot_file.is_snapshot_file(self.filename))
+            pages = list(snapshot_file.read_pages(self.filename))
+            self.assertEqual(len(self.pages), len(pages))
+            for page, expected in zip(pages, self.pages):
+                self.assertEqual(expected.pid, page.pid)
+                self.assertEqual(expected.title, page.title)
+                self.assertEqual(expected.metadata, page.metadata)
+                self.assertEqual(self.expected_rows(expected), page.data)
+
+    def test_read_top_rows(self):
+        for compress in (True, False):
+            snapshot_file.write_snapshot(self.filename, self.pages, compress)
+            reader = snapshot_file.SnapshotReader(self.filename)
+            self.assertEqual(
+                [["dict", 2, 2000], ["int", 30, 840]], reader.read_page(0, 2).data
+            )
+            self.assertEqual(
+                self.expected_rows(self.pages[1]), reader.read_page(1, 10).data
+            )
+            self.assertEqual([], reader.read_page(0, 0).data)
+
+    def test_page_decodes_row_ranges(self):
+        for compress in (True, False):
+            snapshot_file.write_snapshot(self.filename, self.pages, compress)
+            page = snapshot_file.SnapshotReader(self.filename).page(0)
+            self.assertEqual(3, len(page))
+            self.assertEqual(
+                {
+                    "name_width": 4,
+                    "max_count": 30,
+                    "max_size": 2000,
+                    "extra_widths": [],
+                },
+                page.stats,
+            )
+            rows = self.expected_rows(self.pages[0])
+            self.assertEqual(rows[1:], page.rows(1, 10))
+            self.assertEqual(rows[2:3], page.rows(2, 3))
+            self.assertEqual(rows[:1], page.rows(0, 1))
+            self.assertEqual([], page.rows(3, 5))
+            self.assertEqual(self.pages[0].metadata, page.metadata)
+
+    def test_page_inflates_only_the_rows_read(self):
+        rows = [[f"type{i}", i, i * 8] for i in range(100_000)]
+        page = analysis_utils.RetrievedObjects(pid=1, title="Analysis", data=rows)
+        snapshot_file.write_snapshot(self.filename, [page])
+        page = snapshot_file.SnapshotReader(self.filename).page(0)
+        self.assertEqual([["type99999", 99999, 799_992]], page.rows(0, 1))
+        sizes = page.columns["sizes"]
+        self.assertLess(len(sizes.inflated), 100_000 * 8)
+        self.assertEqual(["type0", 0, 0], page.rows(99_999)[0])
+        self.assertEqual(100_000 * 8, len(sizes.inflated))
+
+    def test_page_decodes_only_the_extras_read(self):
+        rows = [[f"type{i}", i, i * 8, i, f"chain {i}"] for i in range(100_000)]
+        page = analysis_utils.RetrievedObjects(pid=1, title="Analysis", data=rows)
+        snapshot_file.write_snapshot(self.filename, [page])
+        page = snapshot_file.SnapshotReader(self.filename).page(0)
+        self.assertEqual([5, 11], page.extra_widths)
+        self.assertEqual(
+            [["type99999", 99999, 799_992, 99999, "chain 99999"]], page.rows(0, 1)
+        )
+        self.assertLess(len(page.columns["extras"].inflated), 100_000 * 8)
+
+    def test_find_pid(self):
+        snapshot_file.write_snapshot(self.filename, self.pages)
+        reader = snapshot_file.SnapshotReader(self.filename)
+        self.assertEqual([1234, 5678, 5678], reader.pids())
+        self.assertEqual([1, 2], reader.find("5678"))
+        self.assertEqual([], reader.find(1))
+
+    def test_reads_pickled_snapshots(self):
+        with open(self.filename, "wb") as f:
+            for page in self.pages:
+                f.write(pickle.dumps(page))
+        self.assertFalse(snapshot_file.is_snapshot_file(self.filename))
+        self.assertEqual(self.pages, list(snapshot_file.read_pages(self.filename)))
+
+    def test_bad_files(self):
+        with open(self.filename, "wb") as f:
+            f.write(snapshot_file.MAGIC)
+        with self.assertRaises(snapshot_file.SnapshotError):
+            snapshot_file.SnapshotReader(self.filename)
+
+        snapshot_file.write_snapshot(self.filename, self.pages)
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 10)
+        with self.assertRaises(snapshot_file.SnapshotError):
+            snapshot_file.SnapshotReader(self.filename)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from .. import timeseries
+
+
+class TimeSeriesStoreTests(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, "store")
+
+    def test_append_and_read_back(self):
+        store = timeseries.TimeSeriesStore(self.filename)
+        store.append(1, [["str", 2, 100], ["int", 1, 28], ["str", 1, 50]], 10.0)
+        store.append(2, [["dict", 1, 232]], 20.0)
+        size = os.path.getsize(self.filename)
+        store.append(1, [["str", 3, 150], ["int", 1, 28]], 30.0)
+        # Names already seen are not written again.
+        self.assertEqual(
+            size + 5 + timeseries.SAMPLE.size + 2 * 20, os.path.getsize(self.filename)
+        )
+
+        reopened = timeseries.TimeSeriesStore(self.filename)
+        self.assertEqual([1, 2], reopened.pids())
+        self.assertEqual(
+            [
+                timeseries.Sample(
+                    pid=1, time=10.0, rows={"str": (3, 150), "int": (1, 28)}
+                ),
+                timeseries.Sample(
+                    pid=1, time=30.0, rows={"str": (3, 150), "int": (1, 28)}
+                ),
+            ],
+            list(reopened.samples(1)),
+        )
+        reopened.append(2, [["dict", 2, 464], ["list", 1, 72]], 40.0)
+        self.assertEqual(
+            [{"dict": (1, 232)}, {"dict": (2, 464), "list": (1, 72)}],
+            [
+                sample.rows
+                for sample in timeseries.TimeSeriesStore(self.filename).samples(2)
+            ],
+        )
+
+    def test_half_written_record_is_dropped(self):
+        store = timeseries.TimeSeriesStore(self.filename)
+        store.append(1, [["str", 1, 10]], 10.0)
+        store.append(1, [["str", 2, 20]], 20.0)
+        with open(self.filename, "r+b") as f:
+            f.truncate(os.path.getsize(self.filename) - 3)
+        store = timeseries.TimeSeriesStore(self.filename)
+        self.assertEqual([10.0], [sample.time for sample in store.samples()])
+        store.append(1, [["str", 3, 30]], 30.0)
+        self.assertEqual([10.0, 30.0], [sample.time for sample in store.samples()])
+
+    def test_not_a_store(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"not a store")
+        with self.assertRaises(timeseries.TimeSeriesError):
+            timeseries.TimeSeriesStore(self.filename)
+
+    def test_compact_applies_retention_and_downsampling(self):
+        store = timeseries.TimeSeriesStore(
+            self.filename, retention_s=1000, downsample_after_s=300, downsample_s=200
+        )
+        for t in range(0, 1300, 100):
+            store.append(1, [["str", t, t]], float(t))
+        store.compact(now=1200.0)
+        # Older than 1000s dropped, one per 200s bucket older than 300s, and
+        # everything from the last 300s kept.
+        self.assertEqual(
+            [300.0, 500.0, 700.0, 800.0, 900.0, 1000.0, 1100.0, 1200.0],
+            [sample.time for sample in store.samples()],
+        )
+        store.append(1, [["int", 1, 28]], 1300.0)
+        self.assertEqual(
+            {"int": (1, 28)},
+            list(timeseries.TimeSeriesStore(self.filename).samples())[-1].rows,
+        )
+
+    def test_compact_copies_records_without_decoding_them(self):
+        store = timeseries.TimeSeriesStore(self.filename, retention_s=150)
+        store.append(1, [["str", 1, 50]], 0.0)
+        store.append(1, [["int", 2, 56], ["str", 3, 150]], 100.0)
+        with open(self.filename, "ab") as f:
+            f.write(timeseries.RECORD.pack(timeseries.SAMPLE_RECORD, 100))
+        with mock.patch.object(store, "samples", side_effect=AssertionError):
+            store.compact(now=200.0)
+        self.assertEqual(
+            [{"int": (2, 56), "str": (3, 150)}],
+            [sample.rows for sample in store.samples()],
+        )
+
+    def test_growth(self):
+        store = timeseries.TimeSeriesStore(self.filename)
+        for hour in range(4):
+            rows = [["leak", 10 * hour, 1000 * hour], ["steady", 5, 500]]
+            if hour % 2:
+                rows.append(["cache", 3, 300])
+            store.append(1, rows, 3600.0 * hour)
+        store.append(2, [["other", 1, 1]], 0.0)
+        growth = store.growth(1)
+        self.assertEqual(["leak", "cache", "steady"], [g.name for g in growth])
+        self.assertAlmostEqual(1000, growth[0].size_slope)
+        self.assertAlmostEqual(10, growth[0].count_slope)
+        self.assertEqual((3000, 30), (growth[0].size, growth[0].count))
+        self.assertAlmostEqual(0, growth[2].size_slope)
+        self.assertEqual(["leak"], [g.name for g in store.growth(1, top=1)])
+        self.assertEqual([], store.growth(2))
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Append-only store of per-type count/size samples, written by `watch`.
+
+    header   MAGIC, version (u16)
+    records  kind (u8), payload length (u32), payload:
+               NAME    u32 id, utf-8 type name
+               SAMPLE  f64 time, i64 pid, u32 rows, then the u32 name ids,
+                       i64 counts and i64 sizes of the rows
+
+Type names are written once, the first time they are seen, so a sample costs
+20 bytes per type. A record cut short by a crash is ignored. Once the file has
+grown by half it is rewritten without the samples older than the retention,
+keeping only the latest sample of every downsampling bucket for the samples
+older than `downsample_after_s`.
+"""
+
+import os
+import struct
+import time
+from array import array
+from typing import Dict, Tuple
+
+from attr import dataclass
+
+from . import snapshot_file
+
+MAGIC = b"MEMANZTS"
+VERSION = 1
+HEADER = struct.Struct("<8sH")
+RECORD = struct.Struct("<BI")
+SAMPLE = struct.Struct("<dqI")
+NAME_ID = struct.Struct("<I")
+
+NAME = 1
+SAMPLE_RECORD = 2
+
+# Don't bother compacting files smaller than this.
+MIN_COMPACT_SIZE = 1 << 20
+
+
+class TimeSeriesError(Exception):
+    pass
+
+
+@dataclass
+class Sample:
+    pid: int
+    time: float
+    rows: Dict[str, Tuple[int, int]]
+
+
+@dataclass
+class Growth:
+    name: str
+    size_slope: float
+    count_slope: float
+    size: int
+    count: int
+
+
+class TimeSeriesStore:
+    """
+    A store of samples for any number of PIDs in `filename`, created if
+    missing. Retention and downsampling are in seconds; None keeps everything.
+    """
+
+    def __init__(
+        self, filename, retention_s=None, downsample_after_s=None, downsample_s=None
+    ):
+        self.filename = filename
+        self.retention_s = retention_s
+        self.downsample_after_s = downsample_after_s
+        self.downsample_s = downsample_s
+        self.names = []
+        self.ids = {}
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            with open(filename, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+        # Reading once learns the names already written, and where the last
+        # whole record ends.
+        self.valid_end = None
+        for _ in self.samples():
+            pass
+        self.compacted_size = os.path.getsize(filename)
+
+    def _check_header(self, f):
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            raise TimeSeriesError(f"{self.filename} is not a time series store")
+        if HEADER.unpack(header)[1] > VERSION:
+            raise TimeSeriesError(f"{self.filename} is from a newer version")
+
+    def _records(self):
+        with open(self.filename, "rb") as f:
+            self._check_header(f)
+            end = f.tell()
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                kind, length = RECORD.unpack(record)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                end = f.tell()
+                yield kind, payload
+        self.valid_end = end
+
+    def _spans(self):
+        """
+        Yield the start, end and kind of every whole record, and the time and
+        pid of samples, reading nothing else of them.
+        """
+        with open(self.filename, "rb") as f:
+            self._check_header(f)
+            size = os.fstat(f.fileno()).st_size
+            while True:
+                start = f.tell()
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                kind, length = RECORD.unpack(record)
+                end = start + RECORD.size + length
+                if end > size:
+                    break
+                head = None
+                if kind == SAMPLE_RECORD:
+                    head = SAMPLE.unpack(f.read(SAMPLE.size))[:2]
+                f.seek(end)
+                yield start, end, kind, head
+
+    def samples(self, pid=None):
+        """
+        Yield every Sample in the store, oldest first, only those of `pid` if
+        given.
+        """
+        names = []
+        for kind, payload in self._records():
+            if kind == NAME:
+                (name_id,) = NAME_ID.unpack_from(payload)
+                name = payload[NAME_ID.size :].decode()
+                names.append(name)
+                if name_id >= len(self.names):
+                    self.names.append(name)
+                    self.ids[name] = name_id
+            elif kind == SAMPLE_RECORD:
+                timestamp, sample_pid, rows = SAMPLE.unpack_from(payload)
+                if pid is not None and str(sample_pid) != str(pid):
+                    continue
+                offset = SAMPLE.size
+                ids = snapshot_file.from_disk("I", payload[offset : offset + rows * 4])
+                offset += rows * 4
+                counts = snapshot_file.from_disk(
+                    "q", payload[offset : offset + rows * 8]
+                )
+                offset += rows * 8
+                sizes = snapshot_file.from_disk(
+                    "q", payload[offset : offset + rows * 8]
+                )
+                yield Sample(
+                    pid=sample_pid,
+                    time=timestamp,
+                    rows={
+                        names[name_id]: (count, size)
+                        for name_id, count, size in zip(ids, counts, sizes)
+                    },
+                )
+
+    def append(self, pid, rows, timestamp=None):
+        """
+        Add a sample of `rows` ([name, count, size, ...] lists) for `pid`.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.valid_end is not None:
+            # Drop a record left half-written by a previous writer, which only
+            # a writer may do: readers could see one being written.
+            with open(self.filename, "r+b") as f:
+                f.truncate(self.valid_end)
+            self.valid_end = None
+        with open(self.filename, "ab") as f:
+            self._write_sample(f, pid, timestamp, rows)
+        if os.path.getsize(self.filename) > max(
+            self.compacted_size * 3 // 2, MIN_COMPACT_SIZE
+        ):
+            self.compact(timestamp)
+
+    def _write_sample(self, f, pid, timestamp, rows):
+        totals = {}
+        for row in rows:
+            count, size = totals.get(row[0], (0, 0))
+            totals[row[0]] = (count + row[1], size + row[2])
+        ids = array("I")
+        for name in totals:
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+                payload = NAME_ID.pack(self.ids[name]) + name.encode()
+                f.write(RECORD.pack(NAME, len(payload)) + payload)
+            ids.append(self.ids[name])
+        payload = b"".join(
+            [
+                SAMPLE.pack(timestamp, int(pid), len(ids)),
+                snapshot_file.to_disk(ids),
+                snapshot_file.to_disk(
+                    array("q", (count for count, _ in totals.values()))
+                ),
+                snapshot_file.to_disk(
+                    array("q", (size for _, size in totals.values()))
+                ),
+            ]
+        )
+        f.write(RECORD.pack(SAMPLE_RECORD, len(payload)) + payload)
+
+    def compact(self, now=None):
+        """
+        Rewrite the store applying retention and downsampling as of `now`.
+
+        The records to keep are picked first, from the record headers alone,
+        then copied over one at a time, so only one record is ever in memory.
+        Every name is kept, so the samples' name ids stay valid.
+        """
+        now = time.time() if now is None else now
+        names = []
+        kept = {}
+        for start, end, kind, head in self._spans():
+            if kind == NAME:
+                names.append((start, end))
+            if kind != SAMPLE_RECORD:
+                continue
+            timestamp, pid = head
+            age = now - timestamp
+            if self.retention_s is not None and age > self.retention_s:
+                continue
+            key = (pid, timestamp)
+            if (
+                self.downsample_s
+                and self.downsample_after_s is not None
+                and age > self.downsample_after_s
+            ):
+                # Later samples in the bucket replace earlier ones.
+                key = (pid, "bucket", timestamp // self.downsample_s)
+            kept[key] = (start, end)
+        tmp = f"{self.filename}.tmp"
+        with open(self.filename, "rb") as src, open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            for start, end in sorted(names + list(kept.values())):
+                src.seek(start)
+                f.write(src.read(end - start))
+        os.replace(tmp, self.filename)
+        self.valid_end = None
+        self.compacted_size = os.path.getsize(self.filename)
+
+    def growth(self, pid, top=None):
+        """
+        The least-squares growth of every type of `pid` across its samples,
+        per hour, steepest size growth first. Types missing from a sample
+        count as zero there.
+        """
+        num_samples = 0
+        sum_t = sum_tt = 0.0
+        # name -> [sum of sizes, sum of t * size, sum of counts, sum of t * count]
+        sums = {}
+        latest = {}
+        start = None
+        for sample in self.samples(pid):
+            start = sample.time if start is None else start
+            t = (sample.time - start) / 3600
+            num_samples += 1
+            sum_t += t
+            sum_tt += t * t
+            for name, (count, size) in sample.rows.items():
+                acc = sums.setdefault(name, [0, 0.0, 0, 0.0])
+                acc[0] += size
+                acc[1] += t * size
+                acc[2] += count
+                acc[3] += t * count
+            latest = sample.rows
+        spread = sum_tt - sum_t * sum_t / num_samples if num_samples else 0
+        if num_samples < 2 or spread <= 0:
+            return []
+        mean_t = sum_t / num_samples
+        growth = []
+        for name, (size, t_size, count, t_count) in sums.items():
+            now_count, now_size = latest.get(name, (0, 0))
+            growth.append(
+                Growth(
+                    name=name,
+                    size_slope=(t_size - mean_t * size) / spread,
+                    count_slope=(t_count - mean_t * count) / spread,
+                    size=now_size,
+                    count=now_count,
+                )
+            )
+        growth.sort(key=lambda g: g.size_slope, reverse=True)
+        return growth[:top] if top is not None else growth
+
+    def pids(self):
+        return list(dict.fromkeys(sample.pid for sample in self.samples()))
@@ -32,12 +32,13 @@ setup(
         "Programming Language :: Python :: 3.7",
     ],
     license="MIT",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     package_data={"memory_analyzer": ["templates/*.template"]},
     test_suite="memory_analyzer.tests",
     python_requires=">=3.6",
     setup_requires=["setuptools"],
     install_requires=requires,
+    extras_require={"leaks": ["numpy"]},
     entry_points={
         "console_scripts": ["memory_analyzer = memory_analyzer.memory_analyzer:cli"]
     },